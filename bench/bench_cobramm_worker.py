@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+
+# Benchmark of the persistent worker mode of SHARC_COBRAMM.py.
+#
+# Times complete steps as SHARC sees them (process start of SHARC_COBRAMM.py until its exit),
+# once with cold starts and once with a persistent worker (SHARC_COBRAMM.py --server) in the run directory.
+#
+# Usage:
+#   python2 bench_cobramm_worker.py <rundir> <QMin file> [nsteps]
+#       runs nsteps real steps in rundir (needs COBRAMM, AMBER and the QM code as for a normal SHARC step)
+#   python2 bench_cobramm_worker.py [nsteps]
+#       start-up only: runs in a temporary directory with a missing QMin file, so each step ends in readQMin (error code 12);
+#       measures interpreter start-up, imports and set-up of the interface (cold) against the thin client and hand-over (worker)
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess as sp
+
+PYTHON=sys.executable
+INTERFACE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scipts','SHARC_COBRAMM.py')
+SOCKETNAME='SH2CBM.socket'
+
+# ======================================================================= #
+def run_steps(rundir,qmin,nsteps):
+  # runs nsteps steps, returns the wall times and the set of error codes
+  times=[]
+  codes=set()
+  devnull=open(os.devnull,'w')
+  for i in range(nsteps):
+    t0=time.time()
+    codes.add(sp.call([PYTHON,INTERFACE,qmin],cwd=rundir,stdout=devnull,stderr=sp.STDOUT))
+    times.append(time.time()-t0)
+  devnull.close()
+  return times,codes
+
+# ======================================================================= #
+def start_worker(rundir):
+  worker=sp.Popen([PYTHON,INTERFACE,'--server'],cwd=rundir,stdout=open(os.devnull,'w'),stderr=sp.STDOUT)
+  sockname=os.path.join(rundir,SOCKETNAME)
+  for i in range(500):
+    if os.path.exists(sockname):
+      return worker
+    time.sleep(0.01)
+  worker.kill()
+  print 'Worker did not start!'
+  sys.exit(1)
+
+# ======================================================================= #
+def stop_worker(rundir,worker):
+  sp.call([PYTHON,INTERFACE,'--stop'],cwd=rundir,stdout=open(os.devnull,'w'),stderr=sp.STDOUT)
+  worker.wait()
+
+# ======================================================================= #
+def report(label,times,codes):
+  times=sorted(times)
+  print '%-8s  steps: %4i   mean: %8.4f s   median: %8.4f s   min: %8.4f s   error codes: %s' % (label,len(times),sum(times)/len(times),times[len(times)/2],times[0],sorted(codes))
+
+# ======================================================================= #
+def main():
+  args=sys.argv[1:]
+  tmpdir=None
+  if len(args)>=2:
+    rundir=os.path.abspath(args[0])
+    qmin=args[1]
+    nsteps=int(args[2]) if len(args)>2 else 10
+  else:
+    tmpdir=tempfile.mkdtemp(prefix='bench_cobramm_')
+    rundir=tmpdir
+    qmin='QM.in.missing'
+    nsteps=int(args[0]) if args else 50
+    print 'Start-up only (each step ends in readQMin), %i steps in %s' % (nsteps,rundir)
+
+  try:
+    cold,coldcodes=run_steps(rundir,qmin,nsteps)
+    worker=start_worker(rundir)
+    try:
+      warm,warmcodes=run_steps(rundir,qmin,nsteps)
+    finally:
+      stop_worker(rundir,worker)
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir)
+
+  report('cold',cold,coldcodes)
+  report('worker',warm,warmcodes)
+  print 'Saved per step (mean): %.4f s' % (sum(cold)/len(cold)-sum(warm)/len(warm))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+
+# Benchmark of civfl_ana.write_det_file in SHARC_RICC2.py against the former implementation
+# (two sorts with string sort keys, output string grown with +=, KeyError for missing states).
+#
+# Synthetic set: ndets distinct singly-excited determinants (default 10^5), nmos=1200 (100 occupied),
+# 5 states, 3 non-zero coefficients per determinant.
+# Each variant runs in a fresh process; peak memory is the increase of ru_maxrss during the call.
+# The dets files of both variants are compared byte by byte.
+#
+# Usage:
+#   python2 bench_det_file.py [ndets]
+
+import os
+import sys
+import imp
+import ast
+import time
+import random
+import hashlib
+import resource
+import tempfile
+import subprocess as sp
+
+INTERFACE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scipts','SHARC_RICC2.py')
+NMOS=1200
+NOCC=100
+NSTATE=5
+
+# ======================================================================= #
+def load_interface():
+  return imp.load_source('SHARC_RICC2',INTERFACE)
+
+# ======================================================================= #
+def make_dets(ndets):
+  # distinct singly-excited determinants with 3 of NSTATE states non-zero
+  random.seed(1234)
+  ref='d'*NOCC+'e'*(NMOS-NOCC)
+  det_dict={}
+  while len(det_dict)<ndets:
+    i=random.randrange(NOCC)
+    a=random.randrange(NOCC,NMOS)
+    spin=random.choice(['ab','ba'])
+    det=ref[:i]+spin[0]+ref[i+1:a]+spin[1]+ref[a+1:]
+    if det in det_dict:
+      continue
+    det_dict[det]=dict( [ (istate,random.uniform(-1.,1.)) for istate in random.sample(range(1,NSTATE+1),3) ] )
+  return det_dict
+
+# ======================================================================= #
+def run_variant(variant,ndets,filename):
+  # runs in a fresh process: builds the determinant table, then times one write_det_file call
+  mod=load_interface()
+
+  class Dets(mod.civfl_ana):
+    def __init__(self,nmos,det_dict):
+      self.nmos=nmos
+      self.det_dict=det_dict
+
+  class OldDets(Dets):
+    # former implementation, as before the single-pass write_det_file
+    def sort_key(self, key):
+      return key.replace('d', '0').replace('a', '1').replace('b', '1')
+    def sort_key2(self, key):
+      return key.replace('d', '0').replace('a', '0').replace('b', '1').replace('e', '1')
+    def write_det_file(self, nstate, wname='dets', wform=' % 14.10f'):
+      string='%i %i %i\n' % (nstate,self.nmos,len(self.det_dict))
+      for det in sorted(sorted(self.det_dict, key=self.sort_key2), key=self.sort_key):
+        string+=det
+        for istate in xrange(1, nstate+1):
+          try:
+            string+=wform % (self.det_dict[det][istate])
+          except KeyError:
+            string+=wform % (0.)
+        string+='\n'
+      mod.writefile(wname,string)
+
+  cls={'old':OldDets,'new':Dets}[variant]
+  dets=cls(NMOS,make_dets(ndets))
+  rss0=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  t0=time.time()
+  dets.write_det_file(NSTATE,wname=filename)
+  walltime=time.time()-t0
+  rss1=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print '%r' % ((walltime,(rss1-rss0)/1024.),)
+
+# ======================================================================= #
+def md5(filename):
+  f=open(filename,'rb')
+  digest=hashlib.md5(f.read()).hexdigest()
+  f.close()
+  return digest
+
+# ======================================================================= #
+def main():
+  if len(sys.argv)>=3 and sys.argv[1]=='--variant':
+    run_variant(sys.argv[2],int(sys.argv[3]),sys.argv[4])
+    return
+  ndets=int(sys.argv[1]) if len(sys.argv)>1 else 100000
+  tmpdir=tempfile.mkdtemp(prefix='bench_dets_')
+  print 'write_det_file: %i determinants, nmos=%i, %i states' % (ndets,NMOS,NSTATE)
+  files={}
+  for variant in ['old','new']:
+    files[variant]=os.path.join(tmpdir,'dets.%s' % (variant))
+    out=sp.check_output([sys.executable,os.path.abspath(__file__),'--variant',variant,str(ndets),files[variant]])
+    walltime,mem=ast.literal_eval(out.strip().splitlines()[-1])
+    print '%-8s time: %8.2f s   peak memory: %+8.1f MB' % ({'old':'before','new':'after'}[variant],walltime,mem)
+  same=md5(files['old'])==md5(files['new'])
+  print 'dets files identical: %s' % (same)
+  for f in files.values():
+    os.remove(f)
+  os.rmdir(tmpdir)
+  if not same:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
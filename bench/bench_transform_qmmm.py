@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+
+# Benchmark of the QM/MM gradient assembly in transform_QM_QMMM of SHARC_ORCA.py against the former
+# element-wise loops (one += per state, atom and Cartesian component).
+#
+# Synthetic set: natom atoms in the input ordering (default 30000), the first nqm of them QM atoms (default 60),
+# nlink link bonds between the last QM atoms and the following MM atoms (default 4), nstates states (default 20).
+# QM, point charge and MM gradients are random numbers; both variants get identical copies of QMin and QMout.
+# The assembled gradients are compared element by element for exact (bit-for-bit) equality.
+#
+# Usage:
+#   python2 bench_transform_qmmm.py [natom [nstates [nqm [nlink [repeat]]]]]
+
+import os
+import sys
+import imp
+import time
+import random
+from copy import deepcopy
+
+INTERFACE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','scipts','SHARC_ORCA.py')
+
+# ======================================================================= #
+def load_interface():
+  return imp.load_source('SHARC_ORCA',INTERFACE)
+
+# ======================================================================= #
+def old_transform_QM_QMMM(QMin,QMout):
+  # former implementation, as before the index-array assembly (meta data and Hamiltonian parts unchanged)
+  QMin['natom']=QMin['natom_orig']
+  QMin['geo']=QMin['geo_orig']
+  if 'h' in QMout:
+    for i in range(QMin['nmstates']):
+      QMout['h'][i][i]+=QMin['qmmm']['MMEnergy']
+  if 'grad' in QMout:
+    nmstates=QMin['nmstates']
+    natom=QMin['natom_orig']
+    grad=[ [ [ 0. for i in range(3) ] for j in range(natom) ] for k in range(nmstates) ]
+    # QM gradient
+    for iqm in QMin['qmmm']['reorder_QM_input']:
+      iqmmm=QMin['qmmm']['reorder_QM_input'][iqm]
+      if iqmmm<0:
+        ilink=-iqmmm-1
+        link=QMin['qmmm']['linkbonds'][ilink]
+        for istate in range(nmstates):
+          for ixyz in range(3):
+            grad[istate][link['qm']][ixyz]+=QMout['grad'][istate][iqm][ixyz]*link['scaling']['qm']
+            grad[istate][link['mm']][ixyz]+=QMout['grad'][istate][iqm][ixyz]*link['scaling']['mm']
+      else:
+        for istate in range(nmstates):
+          for ixyz in range(3):
+            grad[istate][iqmmm][ixyz]+=QMout['grad'][istate][iqm][ixyz]
+    # PC gradient
+    for iqm,iqmmm in enumerate(QMin['qmmm']['MM_atoms']):
+      for istate in range(nmstates):
+        for ixyz in range(3):
+          grad[istate][iqmmm][ixyz]+=QMout['pcgrad'][istate][iqm][ixyz]
+    # MM gradient
+    for iqmmm in range(QMin['qmmm']['natom_table']):
+      for istate in range(nmstates):
+        for ixyz in range(3):
+          grad[istate][iqmmm][ixyz]+=QMin['qmmm']['MMGradient'][iqmmm][ixyz]
+    QMout['grad']=grad
+  return QMin,QMout
+
+# ======================================================================= #
+def make_system(natom,nstates,nqm,nlink):
+  # QMin and QMout as set up by readQMin/prepare_QMMM and returned by the QM step, with the fields transform_QM_QMMM uses
+  random.seed(1234)
+  rnd=lambda: [ random.uniform(-0.1,0.1) for ixyz in range(3) ]
+  QMMM={}
+  QMMM['natom_table']=natom
+  QMMM['QM_atoms']=range(nqm)
+  QMMM['MM_atoms']=range(nqm,natom)
+  # link bonds between the last nlink QM atoms and the MM atoms right after the QM region
+  QMMM['linkbonds']=[]
+  for ilink in range(nlink):
+    QMMM['linkbonds'].append( {'qm':nqm-nlink+ilink, 'mm':nqm+ilink, 'scaling':{'qm':0.3,'mm':0.7}, 'element':'H'} )
+  # QM ordering (QM atoms, then link atoms), as in prepare_QMMM
+  QMMM['reorder_QM_input']={}
+  for iqm in range(nqm):
+    QMMM['reorder_QM_input'][iqm]=iqm
+  for ilink in range(nlink):
+    QMMM['reorder_QM_input'][nqm+ilink]=-(ilink+1)
+  QMMM['MMEnergy']=random.uniform(-1.,1.)
+  QMMM['MMGradient']=[ rnd() for iatom in range(natom) ]
+  QMin={'nmstates':nstates, 'natom':nqm+nlink, 'natom_orig':natom, 'geo':None, 'geo_orig':None, 'qmmm':QMMM}
+  QMout={}
+  QMout['h']=[ [ complex(random.uniform(-1.,1.)) if i==j else 0j for j in range(nstates) ] for i in range(nstates) ]
+  QMout['grad']=[ [ rnd() for iatom in range(nqm+nlink) ] for istate in range(nstates) ]
+  QMout['pcgrad']=[ [ rnd() for iatom in QMMM['MM_atoms'] ] for istate in range(nstates) ]
+  return QMin,QMout
+
+# ======================================================================= #
+def run(function,QMin,QMout,repeat):
+  # returns the best wall time of repeat calls and the result of the last call
+  best=None
+  for i in range(repeat):
+    QMin1=deepcopy(QMin)
+    QMout1=deepcopy(QMout)
+    t0=time.time()
+    QMin1,QMout1=function(QMin1,QMout1)
+    walltime=time.time()-t0
+    if best is None or walltime<best:
+      best=walltime
+  return best,QMout1
+
+# ======================================================================= #
+def main():
+  args=[ int(i) for i in sys.argv[1:] ]
+  natom,nstates,nqm,nlink,repeat=args+[30000,20,60,4,3][len(args):]
+  mod=load_interface()
+  QMin,QMout=make_system(natom,nstates,nqm,nlink)
+  print 'transform_QM_QMMM: %i atoms (%i QM, %i link bonds), %i states, best of %i' % (natom,nqm,nlink,nstates,repeat)
+  told,outold=run(old_transform_QM_QMMM,QMin,QMout,repeat)
+  tnew,outnew=run(mod.transform_QM_QMMM,QMin,QMout,repeat)
+  print '%-8s time: %8.3f s' % ('before',told)
+  print '%-8s time: %8.3f s' % ('after',tnew)
+  print 'speedup:       %8.2f' % (told/tnew)
+  same=outold['grad']==outnew['grad'] and outold['h']==outnew['h']
+  print 'gradients identical: %s' % (same)
+  if not same:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
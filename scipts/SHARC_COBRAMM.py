@@ -50,13 +50,107 @@
 #             - redotasks
 #             - printtasks
 
-# Modules:
+# ======================================================================= #
+# Thin client of the persistent worker (see run_server):
+# if a worker is listening in the current directory, the step is handed over to it right here,
+# before the modules of the full interface are imported and the rest of this file is set up.
+# Therefore only light modules are imported before the hand-over.
+
+# runtime measurement from the start of the script
+import time
+# holds the system time (seconds since the epoch) when the script was started
+CLIENTSTART=time.time()
 # Operating system, isfile and related routines, move files, create directories
 import os
-# External Calls to MOLPRO
-import subprocess as sp
 # Command line arguments
 import sys
+# local socket for the persistent worker mode
+import socket
+# reading binary files, framing of the worker replies
+import struct
+# requests to the persistent worker
+import marshal
+
+# name of the socket of the persistent worker, created in the directory where SHARC calls the interface
+SOCKETNAME='SH2CBM.socket'
+
+# header of the frames sent by the worker: kind ('L': log text of the given length follows, 'E': end of the step with the given error code) and integer
+FRAMEHEADER='<ci'
+
+# ======================================================================= #
+def recv_exact(conn,n):
+  # reads n bytes from the socket, fewer only if the other side closed the connection
+  data=''
+  while len(data)<n:
+    chunk=conn.recv(n-len(data))
+    if not chunk:
+      break
+    data+=chunk
+  return data
+
+# ======================================================================= #
+def send_to_server(sockname,request):
+  '''Sends a request to the persistent worker and writes the log of the step to stdout while it is running.
+
+  Arguments:
+  1 string: path of the socket
+  2 string: request (marshalled, see run_server)
+
+  Returns:
+  1 integer or None: error code of the step (None if no worker is listening, 112 if the worker died during the step)'''
+
+  client=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+  try:
+    client.connect(sockname)
+  except socket.error:
+    client.close()
+    return None
+  client.sendall(request)
+  client.shutdown(socket.SHUT_WR)
+  size=struct.calcsize(FRAMEHEADER)
+  errorcode=None
+  while True:
+    header=recv_exact(client,size)
+    if len(header)<size:
+      break
+    kind,n=struct.unpack(FRAMEHEADER,header)
+    if kind=='E':
+      errorcode=n
+      break
+    sys.stdout.write(recv_exact(client,n))
+    sys.stdout.flush()
+  client.close()
+  if errorcode is None:
+    # the worker closed the connection before the end of the step (crash, killed, out of memory)
+    print 'Connection to the worker on %s was lost during the step!' % (sockname)
+    return 112
+  return errorcode
+
+# ======================================================================= #
+def hand_over_step():
+  '''Hands the step over to a persistent worker listening in the current directory.
+
+  The request contains the working directory, the name of the QMin file, the environment of this process and CLIENTSTART.
+  Exits with the error code of the step if a worker did the step, returns if no worker is listening (cold start).'''
+
+  if len(sys.argv)!=2 or sys.argv[1].startswith('--'):
+    return
+  sockname=os.path.join(os.getcwd(),SOCKETNAME)
+  if not os.path.exists(sockname):
+    return
+  request=marshal.dumps( (os.getcwd(),sys.argv[1],dict(os.environ),CLIENTSTART) )
+  errorcode=send_to_server(sockname,request)
+  if errorcode is not None:
+    sys.exit(errorcode)
+  print 'No worker listening on %s, doing a cold start.' % (sockname)
+
+if __name__ == '__main__':
+  hand_over_step()
+
+# ======================================================================= #
+# Modules:
+# External Calls to MOLPRO
+import subprocess as sp
 # shell utilities like copy
 import shutil
 # Regular expressions
@@ -72,11 +166,15 @@ import datetime
 from copy import deepcopy
 # gethostname routine
 from socket import gethostname
-# reading binary files
-import struct
+# content hashes for the staging of input files
+import hashlib
+# file patterns for cleaning the kept scratch directory
+import fnmatch
 import copy
 import ast
 import string
+# print exceptions inside the persistent worker
+import traceback
 
 # =========================================================0
 # compatibility stuff
@@ -123,12 +221,23 @@ QM/MM single point calculation:
 
 # ======================================================================= #
 # holds the system time when the script was started
-starttime=datetime.datetime.now()
+starttime=datetime.datetime.fromtimestamp(CLIENTSTART)
 
 # global variables for printing (PRINT gives formatted output, DEBUG gives raw output)
 DEBUG=False
 PRINT=True
 
+# content of the resources and template files, kept between steps in the persistent worker mode
+# absolute filename -> (mtime, size, content), see readfile_cached
+FILECACHE={}
+
+# with keep_scratch, SCRATCH/QMMM is not recreated in every step, only these files (relative to SCRATCH/QMMM) are removed
+# (extended with the scratch_clean keyword in COBRAMM.resources)
+SCRATCH_CLEAN=['cobramm.log','QMMM.in','QMMM.out','QM.log','real.crd','cobram.command']
+
+# restartable files of the QM codes, which are moved to SCRATCH/QMMM/RESTART after a step and back into place before the next
+RESTARTABLE=['*.gbw','*.JobIph','mos','alpha','beta']
+
 NUMBERS = {'H':  1, 'He': 2,
 'Li': 3, 'Be': 4, 'B':  5, 'C':  6,  'N': 7,  'O': 8, 'F':  9, 'Ne':10,
 'Na':11, 'Mg':12, 'Al':13, 'Si':14,  'P':15,  'S':16, 'Cl':17, 'Ar':18,
@@ -185,6 +294,29 @@ def readfile(filename):
     sys.exit(12)
   return out
 
+# ======================================================================= #
+def readfile_cached(filename):
+  '''Like readfile, but keeps the content in memory as long as size and mtime of the file do not change.
+
+  Only useful in the persistent worker mode, where the same resources and template files are read in every step.
+
+  Arguments:
+  1 string: filename
+
+  Returns:
+  1 list of strings: file content'''
+
+  try:
+    st=os.stat(filename)
+  except OSError:
+    print 'File %s does not exist!' % (filename)
+    sys.exit(12)
+  # one entry per file, replaced when the file changes
+  key=os.path.abspath(filename)
+  if not key in FILECACHE or FILECACHE[key][0:2]!=(st.st_mtime,st.st_size):
+    FILECACHE[key]=(st.st_mtime,st.st_size,readfile(filename))
+  return FILECACHE[key][2]
+
 # ======================================================================= #
 def writefile(filename,content):
   # content can be either a string or a list of strings
@@ -511,43 +643,259 @@ def makermatrix(a,b):
 # =============================================================================================== #
 # =============================================================================================== #
 
-# estrapolare cobramm log
+# ======================================================================= #
 def get_COBRAMMout(QMin):
+  '''Extracts the first QM/MM energy block of SCRATCH/QMMM/cobramm.log and parses the energy components of each state.
+
+  The log is read line by line and only up to the end of this block (the line before the "QM/MM ENERGIES" header,
+  the header and 5+12*nstates lines), the block is parsed in the same pass and printed if PRINT is set.
+  Within the block, a line containing "state <i>" (any case) starts the components of state i,
+  and every line "<label> = <number>" or "<label> : <number>" (Fortran "d" exponents allowed) is a component
+  of the current state. Components before the first state line (e.g. the MM energy) are stored under state 0.
+
+  Arguments:
+  1 dictionary: QMin
+
+  Returns:
+  1 dictionary: istate (integer) -> {label (string): energy (float)}, empty if the block is missing'''
+
+  filename=os.path.join(QMin['scratchdir'],'QMMM','cobramm.log')
+  numstates=int(QMin['states'][0])
+  # the line before the header, the header and the block
+  nlines=1+5+numstates*12
+  restate=re.compile('state\s*(\d+)',re.IGNORECASE)
+  recomponent=re.compile('\s*([^=:]*[a-zA-Z][^=:]*?)\s*[=:]\s*([-+]?\d+\.\d*(?:[eEdD][-+]?\d+)?)')
+
+  energies={}
+  istate=0
+  previous=''
+  lines=[]
+  f=open(filename)
+  for line in f:
+    if lines:
+      lines.append(line)
+      m=restate.search(line)
+      if m:
+        istate=int(m.group(1))
+      m=recomponent.match(line)
+      if m:
+        energies.setdefault(istate,{})[m.group(1)]=float(m.group(2).replace('d','e').replace('D','e'))
+      if len(lines)>=nlines:
+        break
+    elif 'QM/MM ENERGIES' in line:
+      lines=[previous,line]
+    else:
+      previous=line
+  f.close()
+
+  if PRINT:
+    print '-----  Summary of QM/MM excited states calculation -----'
+    if not lines:
+      print 'No QM/MM ENERGIES block found in %s!' % (filename)
+    else:
+      sys.stdout.write(''.join(lines))
+      print
+  if DEBUG:
+    pprint.pprint(energies)
+  return energies
 
-    if PRINT:
-         print '-----  Summary of QM/MM excited states calculation -----'
-
-         with open (QMin['scratchdir']+'/QMMM/cobramm.log', 'r') as cobralog:
-           states=QMin['states'][0]
-           numstates=int(states)
-      #nstates=QMin['nstates']
-      #nmstates=QMin['nmstates']
-      #natom=QMin['natom']
-    
-           line_number=0
-           lines=cobralog.readlines()
-           #print lines
-           for line in lines:
-             line_number+=1
-             if 'QM/MM ENERGIES' in line:
-               print "found QM/MM!!!!\n\n"
-               print inizio,fine
-               break
-             inizio=line_number
-             inizio+=-1
-             fine=line_number
-             fine+=5+numstates*12
-           for i in range(inizio,fine):
-             print lines[i]
-    #return QMout
 # =============================================================================================== #
 # =============================================================================================== #
-# =========================================== QMout writing ===================================== #
+# =========================================== QMout reading and writing ========================= #
 # =============================================================================================== #
 # =============================================================================================== #
 
-#  written by cobramm
+# ======================================================================= #
+def read_QMMMout_blocks(filename):
+  '''Splits a file in SHARC QM.out format into its blocks.
+
+  Arguments:
+  1 string: filename
+
+  Returns:
+  1 dictionary: flag (integer) -> list of lines, starting with the "! <flag> ..." line'''
+
+  blocks={}
+  flag=None
+  for line in readfile(filename):
+    if line.startswith('!'):
+      s=line[1:].split()
+      try:
+        flag=int(s[0])
+      except (IndexError,ValueError):
+        # comment lines inside a block (e.g. property labels)
+        if flag is not None:
+          blocks[flag].append(line)
+        continue
+      blocks[flag]=[line]
+    elif flag is not None:
+      blocks[flag].append(line)
+  return blocks
+
+# ======================================================================= #
+def parse_cmatrix(lines,i,n,name):
+  # reads "n n" and n rows of n complex numbers starting at line i, returns the matrix and the next line index
+  try:
+    dim=[ int(x) for x in lines[i].split()[0:2] ]
+    if dim!=[n,n]:
+      print 'Block "%s" in QMMM.out has dimension %s, expected %ix%i!' % (name,dim,n,n)
+      sys.exit(100)
+    matrix=[]
+    for irow in range(n):
+      s=[ float(x) for x in lines[i+1+irow].split() ]
+      if len(s)!=2*n:
+        raise ValueError
+      matrix.append([ complex(s[2*j],s[2*j+1]) for j in range(n) ])
+  except (IndexError,ValueError):
+    print 'Block "%s" in QMMM.out is incomplete or corrupt!' % (name)
+    sys.exit(100)
+  return matrix,i+1+n
+
+# ======================================================================= #
+def getQMMMout(QMin):
+  '''Reads the QM.out written by COBRAMM (SCRATCH/QMMM/QMMM.out) into a QMout dictionary.
+
+  Only the blocks for the requested quantities are parsed, and each of them is checked for completeness and dimension.
+  Blocks not handled here (e.g. NACs or property matrices) are kept as raw lines in QMout['raw'] and written back unchanged.
+
+  Arguments:
+  1 dictionary: QMin
+
+  Returns:
+  1 dictionary: QMout'''
+
+  filename=os.path.join(QMin['scratchdir'],'QMMM','QMMM.out')
+  blocks=read_QMMMout_blocks(filename)
+  nmstates=QMin['nmstates']
+  natom=QMin['natom']
+  QMout={'raw':{}}
+
+  if 'h' in QMin or 'soc' in QMin:
+    if not 1 in blocks:
+      print 'Hamiltonian missing in %s!' % (filename)
+      sys.exit(100)
+    QMout['h'],i=parse_cmatrix(blocks[1],1,nmstates,'Hamiltonian')
+
+  if 'dm' in QMin:
+    if not 2 in blocks:
+      print 'Dipole moments missing in %s!' % (filename)
+      sys.exit(100)
+    QMout['dm']=[]
+    i=1
+    for xyz in range(3):
+      matrix,i=parse_cmatrix(blocks[2],i,nmstates,'Dipole Moment')
+      QMout['dm'].append(matrix)
+
+  if 'grad' in QMin:
+    if not 3 in blocks:
+      print 'Gradients missing in %s!' % (filename)
+      sys.exit(100)
+    lines=blocks[3]
+    QMout['grad']=[]
+    i=1
+    try:
+      for istate in range(nmstates):
+        if int(lines[i].split()[0])!=natom:
+          print 'Gradient %i in QMMM.out has wrong number of atoms!' % (istate+1)
+          sys.exit(100)
+        grad=[]
+        for iatom in range(natom):
+          s=[ float(x) for x in lines[i+1+iatom].split() ]
+          if len(s)!=3:
+            raise ValueError
+          grad.append(s)
+        QMout['grad'].append(grad)
+        i+=1+natom
+    except (IndexError,ValueError):
+      print 'Block "Gradient" in QMMM.out is incomplete or corrupt!'
+      sys.exit(100)
+
+  if 'overlap' in QMin:
+    if not 6 in blocks:
+      print 'Overlap matrix missing in %s!' % (filename)
+      sys.exit(100)
+    QMout['overlap'],i=parse_cmatrix(blocks[6],1,nmstates,'Overlap')
+
+  if 7 in blocks and ('phases' in QMin or 'overlap' in QMin):
+    lines=blocks[7]
+    try:
+      QMout['phases']=[]
+      for istate in range(nmstates):
+        s=[ float(x) for x in lines[2+istate].split()[0:2] ]
+        QMout['phases'].append(complex(s[0],s[1]))
+    except (IndexError,ValueError):
+      print 'Block "Phases" in QMMM.out is incomplete or corrupt!'
+      sys.exit(100)
+
+  # everything else is passed on, if requested
+  requested={5:'nacdr',12:'dmdr',13:'socdr'}
+  for flag in blocks:
+    if flag in [1,2,3,6,7,8]:
+      continue
+    if flag in requested and not requested[flag] in QMin:
+      continue
+    QMout['raw'][flag]=blocks[flag]
 
+  return QMout
+
+# ======================================================================= #
+def writeQMout(QMin,QMout,QMinfilename):
+  '''Writes the requested quantities to the file which SHARC reads in. The filename is QMinfilename with everything after the first dot replaced by "out".
+
+  The whole file is assembled in memory and written at once.
+
+  Arguments:
+  1 dictionary: QMin
+  2 dictionary: QMout
+  3 string: QMinfilename'''
+
+  k=QMinfilename.find('.')
+  if k==-1:
+    outfilename=QMinfilename+'.out'
+  else:
+    outfilename=QMinfilename[:k]+'.out'
+  if PRINT:
+    print '===> Writing output to file %s in SHARC Format\n' % (outfilename)
+  nmstates=QMin['nmstates']
+  natom=QMin['natom']
+
+  def cmatrix(matrix):
+    out=['%i %i\n' % (nmstates,nmstates)]
+    for row in matrix:
+      out.append(' '.join([ '%s %s' % (eformat(x.real,9,3),eformat(x.imag,9,3)) for x in row ])+' \n')
+    return out
+
+  out=[]
+  if 'h' in QMout:
+    out.append('! %i Hamiltonian Matrix (%ix%i, complex)\n' % (1,nmstates,nmstates))
+    out.extend(cmatrix(QMout['h']))
+    out.append('\n')
+  if 'dm' in QMout:
+    out.append('! %i Dipole Moment Matrices (3x%ix%i, complex)\n' % (2,nmstates,nmstates))
+    for xyz in range(3):
+      out.extend(cmatrix(QMout['dm'][xyz]))
+    out.append('\n')
+  if 'grad' in QMout:
+    out.append('! %i Gradient Vectors (%ix%ix3, real)\n' % (3,nmstates,natom))
+    i=0
+    for imult,istate,ims in itnmstates(QMin['states']):
+      out.append('%i %i ! %i %i %i\n' % (natom,3,imult,istate,ims))
+      for g in QMout['grad'][i]:
+        out.append('%s %s %s \n' % (eformat(g[0],9,3),eformat(g[1],9,3),eformat(g[2],9,3)))
+      i+=1
+    out.append('\n')
+  if 'overlap' in QMout:
+    out.append('! %i Overlap matrix (%ix%i, complex)\n' % (6,nmstates,nmstates))
+    out.extend(cmatrix(QMout['overlap']))
+    out.append('\n')
+  for flag in sorted(QMout['raw']):
+    out.extend(QMout['raw'][flag])
+  if 'phases' in QMout:
+    out.append('! 7 Phases\n%i ! for all nmstates\n' % (nmstates))
+    for x in QMout['phases']:
+      out.append('%s %s\n' % (eformat(x.real,9,3),eformat(x.imag,9,3)))
+  out.append('! 8 Runtime\n%s\n' % (eformat(QMout['runtime'],9,3)))
+  writefile(os.path.join(QMin['pwd'],outfilename),''.join(out))
 
 # =============================================================================================== #
 # =============================================================================================== #
@@ -754,6 +1102,19 @@ def readQMin(QMinfilename):
     for ixyz in range(3):
       QMin['geo'][iatom][ixyz+1]*=factor
 
+  # Calculate states, nstates, nmstates
+  if not 'states' in QMin:
+    print 'Keyword "states" not given!'
+    sys.exit(53)
+  for i in range(len(QMin['states'])):
+    QMin['states'][i]=int(QMin['states'][i])
+  nstates=0
+  nmstates=0
+  for i in range(len(QMin['states'])):
+    nstates+=QMin['states'][i]
+    nmstates+=QMin['states'][i]*(i+1)
+  QMin['nstates']=nstates
+  QMin['nmstates']=nmstates
 
 
 
@@ -768,10 +1129,10 @@ def readQMin(QMinfilename):
   # open COBRAMM.resources
   filename='COBRAMM.resources'
   if os.path.isfile(filename):
-    sh2cbm=readfile(filename)
+    sh2cbm=readfile_cached(filename)
   else:
     print 'HINT: reading resources from SH2CBM.inp'
-    sh2cbm=readfile('SH2CBM.inp')
+    sh2cbm=readfile_cached('SH2CBM.inp')
 
   # ncpus for SMP-parallel turbomole and wfoverlap
   # this comes before the turbomole path determination
@@ -791,16 +1152,20 @@ def readQMin(QMinfilename):
 
   # set COBRAMM paths
 
+  # (only prepend once, the persistent worker calls readQMin in every step)
   QMin['cobrammdir']=get_sh2cbm_environ(sh2cbm,'cobrammdir')
   os.environ['COBRAMM_PATH']=QMin['cobrammdir']
-  os.environ['PATH']='%s:' % (QMin['cobrammdir']) +os.environ['PATH'] 
+  if not '%s:' % (QMin['cobrammdir']) in os.environ['PATH']:
+    os.environ['PATH']='%s:' % (QMin['cobrammdir']) +os.environ['PATH'] 
 
   # set AMBER paths
   
   QMin['amberdir']=get_sh2cbm_environ(sh2cbm,'amberdir')
   os.environ['AMBERHOME']=QMin['amberdir']
-  os.environ['PATH']='%s:' % (QMin['amberdir']) +os.environ['PATH']
-  os.environ['LD_LIBRARY_PATH']='%s:' % (QMin['amberdir'])+os.environ['LD_LIBRARY_PATH']
+  if not '%s:' % (QMin['amberdir']) in os.environ['PATH']:
+    os.environ['PATH']='%s:' % (QMin['amberdir']) +os.environ['PATH']
+  if not '%s:' % (QMin['amberdir']) in os.environ.get('LD_LIBRARY_PATH',''):
+    os.environ['LD_LIBRARY_PATH']='%s:' % (QMin['amberdir'])+os.environ.get('LD_LIBRARY_PATH','')
 
   # Set up scratchdir
   line=get_sh2cbm_environ(sh2cbm,'scratchdir',False,False)
@@ -842,6 +1207,17 @@ def readQMin(QMinfilename):
       global PRINT
       PRINT=False
 
+  # keep SCRATCH/QMMM between steps
+  line=getsh2cbmkey(sh2cbm,'keep_scratch')
+  if line[0]:
+    if len(line)<=1 or 'true' in line[1].lower():
+      QMin['keep_scratch']=[]
+
+  QMin['scratch_clean']=list(SCRATCH_CLEAN)
+  line=getsh2cbmkey(sh2cbm,'scratch_clean')
+  if line[0] and len(line)>1:
+    QMin['scratch_clean'].extend(line[1].split())
+
 
   # memory for only COBRAMM and AMBER, no QM
   QMin['memory']=100
@@ -879,7 +1255,7 @@ def readQMin(QMinfilename):
   #QMin['template']['cut']='12'
 
   # open template
-  template=readfile('COBRAMM.template')
+  template=readfile_cached('COBRAMM.template')
 
   QMin['template']={}
 
@@ -981,9 +1357,15 @@ def gettasks(QMin):
   tasks=[]
   # During initialization, create all temporary directories
   # and link them appropriately
-  tasks.append(['mkdir', QMin['scratchdir']])
+  # the scratchdir itself is kept, it holds the staged input files (see stage_file)
+  tasks.append(['mkdir', QMin['scratchdir'],False])
   tasks.append(['link', QMin['scratchdir'],QMin['pwd']+'/SCRATCH',False])
-  tasks.append(['mkdir',QMin['scratchdir']+'/QMMM'])
+  if 'keep_scratch' in QMin:
+    tasks.append(['mkdir',QMin['scratchdir']+'/QMMM',False])
+    tasks.append(['cleanscratch'])
+    tasks.append(['restorerestart'])
+  else:
+    tasks.append(['mkdir',QMin['scratchdir']+'/QMMM'])
   #tasks.append(['mkdir',QMin['scratchdir']+'/QM'])
   #if 'overlap' in QMin:
     #tasks.append(['mkdir',QMin['scratchdir']+'/QMMM/SAVE/'])
@@ -1005,6 +1387,8 @@ def gettasks(QMin):
   tasks.append(['writecrd'])
  #tasks.append(['write_geom',QMin['scratchdir']+'/QMMM'])
   tasks.append(['run_cobramm'])
+  if 'keep_scratch' in QMin:
+    tasks.append(['collectrestart'])
   tasks.append(['save_data'])
   tasks.append(['getcobrammout'])
   tasks.append(['getqmout'])
@@ -1029,13 +1413,13 @@ def gettasks(QMin):
 # =============================================================================================== #
 # =============================================================================================== #
 
-def mkdir(DIR):
-    # mkdir the DIR, or clean it if it exists
+def mkdir(DIR,clean=True):
+    # mkdir the DIR, or clean it if it exists (unless clean=False)
     if os.path.exists(DIR):
         if os.path.isfile(DIR):
             print '%s exists and is a file!' % (DIR)
             sys.exit(89)
-        elif os.path.isdir(DIR):
+        elif os.path.isdir(DIR) and clean:
             if DEBUG:
                 print 'Remake\t%s' % DIR
             shutil.rmtree(DIR)
@@ -1131,6 +1515,59 @@ def cleandir(directory):
   if DEBUG:
     print '\n'
 
+# ======================================================================= #
+def cleanscratch(QMin):
+  '''Removes the files of the last step from the kept SCRATCH/QMMM.
+
+  Only the files matching the patterns in QMin['scratch_clean'] are removed, everything else (intermediate files of COBRAMM and the QM code) stays.'''
+
+  workdir=os.path.join(QMin['scratchdir'],'QMMM')
+  for data in os.listdir(workdir):
+    if any( [ fnmatch.fnmatch(data,pattern) for pattern in QMin['scratch_clean'] ] ):
+      path=os.path.join(workdir,data)
+      if os.path.isfile(path) or os.path.islink(path):
+        if DEBUG:
+          print 'rm %s' % (path)
+        os.remove(path)
+
+# ======================================================================= #
+def collectrestart(QMin):
+  '''Moves the restartable QM files (see RESTARTABLE) from the SCRATCH/QMMM tree to SCRATCH/QMMM/RESTART.
+
+  The relative path of each file is kept, so that restorerestart can put them back to the place where the QM code expects them.'''
+
+  workdir=os.path.join(QMin['scratchdir'],'QMMM')
+  restartdir=os.path.join(workdir,'RESTART')
+  for root,dirs,files in os.walk(workdir):
+    if root.startswith(restartdir):
+      continue
+    for data in files:
+      if any( [ fnmatch.fnmatch(data,pattern) for pattern in RESTARTABLE ] ):
+        fromfile=os.path.join(root,data)
+        tofile=os.path.join(restartdir,os.path.relpath(fromfile,workdir))
+        if not os.path.isdir(os.path.dirname(tofile)):
+          os.makedirs(os.path.dirname(tofile))
+        if DEBUG:
+          print 'Save restart file\t%s' % (fromfile)
+        shutil.move(fromfile,tofile)
+
+# ======================================================================= #
+def restorerestart(QMin):
+  # put the restartable files collected in the last step back into place
+  workdir=os.path.join(QMin['scratchdir'],'QMMM')
+  restartdir=os.path.join(workdir,'RESTART')
+  if not os.path.isdir(restartdir):
+    return
+  for root,dirs,files in os.walk(restartdir):
+    for data in files:
+      fromfile=os.path.join(root,data)
+      tofile=os.path.join(workdir,os.path.relpath(fromfile,restartdir))
+      if not os.path.isdir(os.path.dirname(tofile)):
+        os.makedirs(os.path.dirname(tofile))
+      if DEBUG:
+        print 'Restore restart file\t%s' % (tofile)
+      shutil.move(fromfile,tofile)
+
 # ======================================================================= #
 def movetoold(QMin):
   # rename all files in savedir
@@ -1156,6 +1593,105 @@ def movetoold(QMin):
   #      shutil.copy(ftomove,fin)
 # ======================================================================  #
 
+# ======================================================================= #
+def hashfile(filename):
+  # sha1 of the file content, read in blocks
+  h=hashlib.sha1()
+  f=open(filename,'rb')
+  while True:
+    block=f.read(1048576)
+    if not block:
+      break
+    h.update(block)
+  f.close()
+  return h.hexdigest()
+
+# ======================================================================= #
+def read_stage_manifest(stagedir):
+  '''Reads the manifest of the staging directory.
+
+  Lines are either "source <name> <mtime> <size> <sha1>" for the input files
+  or "staged <sha1> <mtime> <size>" for the copies kept in the staging directory.
+
+  Arguments:
+  1 string: staging directory
+
+  Returns:
+  1 dictionary: {'source': name -> [mtime, size, sha1], 'staged': sha1 -> [mtime, size]}'''
+
+  manifest={'source':{},'staged':{}}
+  filename=os.path.join(stagedir,'manifest')
+  if not os.path.isfile(filename):
+    return manifest
+  for line in readfile(filename):
+    s=line.split()
+    if len(s)==5 and s[0]=='source':
+      manifest['source'][s[1]]=[float(s[2]),int(s[3]),s[4]]
+    elif len(s)==4 and s[0]=='staged':
+      manifest['staged'][s[1]]=[float(s[2]),int(s[3])]
+  return manifest
+
+# ======================================================================= #
+def write_stage_manifest(stagedir,manifest):
+  string=''
+  for name in sorted(manifest['source']):
+    m=manifest['source'][name]
+    string+='source %s %r %i %s\n' % (name,m[0],m[1],m[2])
+  for sha in sorted(manifest['staged']):
+    m=manifest['staged'][sha]
+    string+='staged %s %r %i\n' % (sha,m[0],m[1])
+  writefile(os.path.join(stagedir,'manifest'),string)
+
+# ======================================================================= #
+def stage_file(fromfile,tofile,stagedir,manifest):
+  '''Puts fromfile at tofile through the content-addressed staging directory.
+
+  The source is only hashed if its mtime or size changed since the last step.
+  The content is kept once in stagedir under its sha1 and hardlinked to tofile (copied if linking is not possible).
+  A staged copy which was modified in the meantime (e.g. written through the hardlink) is replaced.
+
+  Arguments:
+  1 string: source file
+  2 string: destination file
+  3 string: staging directory
+  4 dictionary: manifest, updated in place
+
+  Returns:
+  1 integer: number of bytes which did not have to be copied'''
+
+  name=os.path.basename(fromfile)
+  st=os.stat(fromfile)
+  entry=manifest['source'].get(name)
+  if entry and entry[0]==st.st_mtime and entry[1]==st.st_size:
+    sha=entry[2]
+  else:
+    sha=hashfile(fromfile)
+    manifest['source'][name]=[st.st_mtime,st.st_size,sha]
+  staged=os.path.join(stagedir,sha)
+  saved=0
+  if os.path.isfile(staged):
+    stst=os.stat(staged)
+    entry=manifest['staged'].get(sha)
+    if entry and entry[0]==stst.st_mtime and entry[1]==stst.st_size:
+      saved=st.st_size
+    else:
+      os.remove(staged)
+  if not os.path.isfile(staged):
+    shutil.copy(fromfile,staged)
+    stst=os.stat(staged)
+    manifest['staged'][sha]=[stst.st_mtime,stst.st_size]
+    if DEBUG:
+      print 'Staged\t%s -> %s' % (fromfile,staged)
+  if os.path.lexists(tofile):
+    os.remove(tofile)
+  try:
+    os.link(staged,tofile)
+  except OSError:
+    shutil.copy(staged,tofile)
+    saved=0
+  return saved
+
+# ======================================================================= #
 # copia file per cobramm
 def copy_file(QMin):
   currentdir=os.getcwd()
@@ -1164,17 +1700,22 @@ def copy_file(QMin):
   interface_res= '%s.resources' % intername
   tocopy=['real.top', 'model-H.top', 'real_layers.xyz']
   moretocopy=[interface_templ, interface_res]
-  for files in tocopy:
+  stagedir=os.path.join(QMin['scratchdir'],'STAGE')
+  if not os.path.isdir(stagedir):
+    os.makedirs(stagedir)
+  manifest=read_stage_manifest(stagedir)
+  saved=0
+  for files in tocopy+moretocopy:
     fromfile=os.path.join(currentdir, files)
     tofile=os.path.join(QMin['scratchdir'], 'QMMM', files)
-    shutil.copy(fromfile,tofile)
-  for morefiles in moretocopy:
-    morefromfile=os.path.join(currentdir, morefiles)
-    moretofile=os.path.join(QMin['scratchdir'], 'QMMM', morefiles)
-    shutil.copy(morefromfile,moretofile)
+    saved+=stage_file(fromfile,tofile,stagedir,manifest)
+  write_stage_manifest(stagedir,manifest)
+  # QM.in changes every step
   fromqm=os.path.join(currentdir, 'QM.in')
   toqmmm=os.path.join(QMin['scratchdir'], 'QMMM', 'QMMM.in')
   shutil.copy(fromqm,toqmmm)
+  if PRINT or DEBUG:
+    print 'Staging of input files: avoided copying %i bytes' % (saved)
   
 
 # ======================================================================= #
@@ -1195,17 +1736,12 @@ def save_data(QMin):
 
 # ======================================================================= #
 def copy_qmfiles(QMin):
+  # the QM.out is assembled by getQMMMout/writeQMout, only the log of the QM interface is copied
   log='QM.log'
   filelog=os.path.join(QMin['scratchdir'], 'QMMM', log)
   outlog=os.path.join(QMin['pwd'], log)
   shutil.copy(filelog,outlog)
 
-  oldout='QMMM.out'
-  newout='QM.out'
-  oldfileout=os.path.join(QMin['scratchdir'], 'QMMM', oldout)
-  newfileout=os.path.join(QMin['pwd'],newout)
-  shutil.copy(oldfileout,newfileout)
-
 
 
 # ========================================================================  #
@@ -1255,7 +1791,9 @@ def runProgram(string,workdir):
 def run_cobramm(QMin):
   workdir=os.path.join(QMin['scratchdir'],'QMMM')
   string='cobram.py > cobramm.log'
+  cbmstart=datetime.datetime.now()
   runerror=runProgram(string,workdir)
+  QMin['cobramm_runtime']=datetime.datetime.now()-cbmstart
   print 'COBRAMM QM/MM setup and calculation started:'
   if runerror!=0:
     print 'COBRAMM calculation crashed! Error code=%i' % (runerror)
@@ -1290,7 +1828,7 @@ def runeverything(tasks, QMin):
     #if task[0]=='save_data':
     #  movetoold(QMin)
     if task[0]=='mkdir':
-      mkdir(task[1])
+      mkdir(*task[1:])
     if task[0]=='link':
       if len(task)==4:
         link(task[1],task[2],task[3])
@@ -1304,6 +1842,12 @@ def runeverything(tasks, QMin):
       #backupdata(task[1],QMin)
     if task[0]=='cleanup':
       cleandir(task[1])
+    if task[0]=='cleanscratch':
+      cleanscratch(QMin)
+    if task[0]=='restorerestart':
+      restorerestart(QMin)
+    if task[0]=='collectrestart':
+      collectrestart(QMin)
     if task[0]=='writecrd':
       write_crd(QMin)
     if task[0]=='save_data':
@@ -1315,9 +1859,10 @@ def runeverything(tasks, QMin):
     if task[0]=='run_cobramm':
       run_cobramm(QMin)
     if task[0]=='getcobrammout':
-       get_COBRAMMout(QMin)   # da scrivere ancora
+       QMout['qmmm_energies']=get_COBRAMMout(QMin)
     if task[0]=='getqmout':
-       copy_qmfiles(QMin)  
+       copy_qmfiles(QMin)
+       QMout.update(getQMMMout(QMin))
 
 
   return QMin,QMout
@@ -1333,31 +1878,25 @@ def runeverything(tasks, QMin):
 
 
 
-# ========================== Main Code =============================== #
-def main():
+# =============================================================================================== #
+# =============================================================================================== #
+# ========================================= persistent worker =================================== #
+# =============================================================================================== #
+# =============================================================================================== #
 
-  # Retrieve PRINT and DEBUG
-  try:
-    envPRINT=os.getenv('SH2CBM_PRINT')
-    if envPRINT and envPRINT.lower()=='false':
-      global PRINT
-      PRINT=False
-    envDEBUG=os.getenv('SH2CBM_DEBUG')
-    if envDEBUG and envDEBUG.lower()=='true':
-      global DEBUG
-      DEBUG=True
-  except ValueError:
-    print 'PRINT or DEBUG environment variables do not evaluate to logical values!'
-    sys.exit(110)
+def run_step(QMinfilename,clientstart):
+  '''Runs one SHARC time step: reads QMinfilename, plans and executes all tasks.
 
-  # Process Command line arguments
-  if len(sys.argv)!=2:
-    print 'Usage:\n./SHARC_COMBRAMM.py <QMin>\n'
-    print 'version:',version
-    print 'date:',versiondate
-    print 'changelog:\n',changelogstring
-    sys.exit(111)
-  QMinfilename=sys.argv[1]
+  Is called once by the cold-start path and once per request by the persistent worker.
+  The runtime of the step is measured from the start of the script which was called by SHARC (the client in the worker mode),
+  so that it includes the module imports and the set-up of the interface, but not the start-up of the Python interpreter.
+
+  Arguments:
+  1 string: name of the QMin file
+  2 float: time of the start of the calling script (see CLIENTSTART)'''
+
+  global starttime
+  starttime=datetime.datetime.fromtimestamp(clientstart)
 
   # Print header
   printheader()
@@ -1373,18 +1912,178 @@ def main():
   # do all runs
   QMin,QMout=runeverything(Tasks,QMin)
 
-  #printQMout(QMin,QMout)
-
   # Measure time
-  #runtime=measuretime()
-  #QMout['runtime']=runtime
+  runtime=measuretime()
+  QMout['runtime']=runtime
 
   # Write QMout
-  #writeQMout(QMin,QMout,QMinfilename)
+  writeQMout(QMin,QMout,QMinfilename)
 
   if PRINT or DEBUG:
+    runtime=datetime.datetime.now()-starttime
+    if 'cobramm_runtime' in QMin:
+      print 'Interface overhead per step (total since start of the script minus COBRAMM): %s' % (runtime-QMin['cobramm_runtime'])
     print datetime.datetime.now()
     print '#================ END ================#'
 
+# ======================================================================= #
+def set_print_flags(environ):
+  # sets PRINT and DEBUG from the SH2CBM_PRINT and SH2CBM_DEBUG environment variables, default values otherwise
+  global PRINT, DEBUG
+  PRINT=environ.get('SH2CBM_PRINT','').lower()!='false'
+  DEBUG=environ.get('SH2CBM_DEBUG','').lower()=='true'
+
+# ======================================================================= #
+def recv_all(conn):
+  # read from the socket until the other side closes its sending end
+  data=''
+  while True:
+    chunk=conn.recv(65536)
+    if not chunk:
+      break
+    data+=chunk
+  return data
+
+# ======================================================================= #
+class SocketWriter:
+  '''Replaces sys.stdout in the persistent worker: everything written is sent immediately as a log frame to the client.
+
+  If the client is gone, the step continues and the rest of the log is discarded.'''
+
+  def __init__(self,conn):
+    self.conn=conn
+    self.lost=False
+
+  def write(self,string):
+    if self.lost or not string:
+      return
+    string=str(string)
+    try:
+      self.conn.sendall(struct.pack(FRAMEHEADER,'L',len(string))+string)
+    except socket.error:
+      self.lost=True
+
+  def flush(self):
+    pass
+
+# ======================================================================= #
+def serve_step(conn,workdir,QMinfilename,environ,clientstart):
+  '''Executes one step inside the persistent worker.
+
+  Runs in the directory and with the environment of the client, streams everything printed to stdout to the client
+  and converts sys.exit calls into an error code, so that a crashing step does not take the worker down.
+  Afterwards, the directory and the environment of the worker are restored.
+
+  Arguments:
+  1 socket: connection to the client
+  2 string: working directory of the client
+  3 string: name of the QMin file
+  4 dictionary: environment of the client
+  5 float: time of the start of the client
+
+  Returns:
+  1 integer: error code'''
+
+  prevdir=os.getcwd()
+  prevenviron=dict(os.environ)
+  prevstdout=sys.stdout
+  sys.stdout=SocketWriter(conn)
+  errorcode=0
+  try:
+    os.environ.clear()
+    os.environ.update(environ)
+    set_print_flags(environ)
+    os.chdir(workdir)
+    run_step(QMinfilename,clientstart)
+  except SystemExit, e:
+    if e.code is None:
+      errorcode=0
+    elif isinstance(e.code,int):
+      errorcode=e.code
+    else:
+      print e.code
+      errorcode=1
+  except Exception:
+    traceback.print_exc(file=sys.stdout)
+    errorcode=1
+  sys.stdout=prevstdout
+  os.environ.clear()
+  os.environ.update(prevenviron)
+  os.chdir(prevdir)
+  return errorcode
+
+# ======================================================================= #
+def run_server(sockname):
+  '''Starts the persistent worker listening on sockname.
+
+  The worker keeps the interpreter, the imported modules and the parsed resource and template files (see readfile_cached) alive between time steps.
+  COBRAMM itself (cobram.py, AMBER) is still started for every step.
+  Each request is a marshalled tuple (working directory, name of the QMin file, environment, start time of the client), see hand_over_step.
+  The log of the step is sent back in frames while the step is running, the last frame contains the error code (see FRAMEHEADER).
+  The request "stop" shuts the worker down.
+
+  Arguments:
+  1 string: path of the socket'''
+
+  if os.path.exists(sockname):
+    os.remove(sockname)
+  server=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+  server.bind(sockname)
+  server.listen(1)
+  print 'SHARC-COBRAMM worker listening on %s' % (sockname)
+  sys.stdout.flush()
+  try:
+    while True:
+      conn,addr=server.accept()
+      try:
+        request=marshal.loads(recv_all(conn))
+      except (EOFError,ValueError,TypeError):
+        conn.close()
+        continue
+      if request=='stop':
+        conn.sendall(struct.pack(FRAMEHEADER,'E',0))
+        conn.close()
+        break
+      workdir,QMinfilename,environ,clientstart=request
+      errorcode=serve_step(conn,workdir,QMinfilename,environ,clientstart)
+      try:
+        conn.sendall(struct.pack(FRAMEHEADER,'E',errorcode))
+      except socket.error:
+        pass
+      conn.close()
+  finally:
+    server.close()
+    if os.path.exists(sockname):
+      os.remove(sockname)
+  print 'SHARC-COBRAMM worker stopped.'
+
+
+# ========================== Main Code =============================== #
+def main():
+
+  # Retrieve PRINT and DEBUG
+  set_print_flags(os.environ)
+
+  # Process Command line arguments
+  if len(sys.argv)!=2:
+    print 'Usage:\n./SHARC_COMBRAMM.py <QMin>\n'
+    print '        ./SHARC_COMBRAMM.py --server     (start persistent worker in this directory)'
+    print '        ./SHARC_COMBRAMM.py --stop       (stop persistent worker in this directory)\n'
+    print 'version:',version
+    print 'date:',versiondate
+    print 'changelog:\n',changelogstring
+    sys.exit(111)
+  sockname=os.path.join(os.getcwd(),SOCKETNAME)
+
+  if sys.argv[1]=='--server':
+    run_server(sockname)
+    sys.exit(0)
+  if sys.argv[1]=='--stop':
+    send_to_server(sockname,marshal.dumps('stop'))
+    sys.exit(0)
+
+  # a running worker has already been tried in hand_over_step, do a cold start
+  run_step(sys.argv[1],CLIENTSTART)
+
 if __name__ == '__main__':
     main()
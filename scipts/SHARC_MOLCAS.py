@@ -97,6 +97,10 @@ from socket import gethostname
 import itertools
 # write debug traces when in pool threads
 import traceback
+# lookup in the line index of MOLCAS.out
+import bisect
+# list scheduling of the parallel jobs
+import heapq
 
 
 # =========================================================0
@@ -221,6 +225,11 @@ changelogstring='''
 
 11.10.2020:
 - COBRAMM can be used for QM/MM calculation
+
+18.10.2026:
+- new template keywords "numgrad_atoms" and "numgrad_components" restrict the numerical gradients to the given atoms and Cartesian components (all other components are zero)
+- new template keyword "numgrad_onesided" uses one-sided differences with the central point (3N+1 instead of 6N+1 calculations)
+- job wall times are recorded in the savedir (schedule_history.dat) and used to order the parallel jobs
 '''
 
 # ======================================================================= #
@@ -265,6 +274,16 @@ IToPol={
 au2a=0.529177211
 rcm_to_Eh=4.556335e-6
 
+# translation table from packed determinant strings (one byte per orbital, 0:empty, 1:alpha, 2:beta, 3:docc) to the dets file notation
+DETCHARS='eabd'+''.join([ chr(i) for i in range(4,256) ])
+
+# shared base jobs of the numerical gradient displacements (see Displacement), filled by generate_joblist before the Pool is forked
+DISPLACEMENT_BASES={}
+
+# file (in savedir) with the measured wall times of previous jobs and number of measurements kept per job type (see schedule_jobs)
+SCHEDULE_HISTORY_FILE='schedule_history.dat'
+SCHEDULE_HISTORY_LENGTH=20
+
 # =============================================================================================== #
 # =============================================================================================== #
 # =========================================== general routines ================================== #
@@ -912,57 +931,212 @@ def getversion(out,MOLCAS):
         print 'Found MOLCAS version %3.1f\n' % (v)
     return v
 
+# ======================================================================= #
+# strings marking the sections and tables in MOLCAS.out, which are indexed by MOLCASout
+MOLCASOUT_MARKERS=['&RASSCF',
+                   '&CASPT2',
+                   '&RASSI',
+                   'Spin quantum number',
+                   'Final state energy(ies)',
+                   '::    RASSCF root number',
+                   '::    CASPT2 Root',
+                   '::    MS-CASPT2 Root',
+                   'I1  S1  MS1    I2  S2  MS2    Real part    Imag part      Absolute',
+                   'SPIN MULTIPLICITY:',
+                   'The following data are common to all the states',
+                   'Special properties section',
+                   'MATRIX ELEMENTS OF 1-ELECTRON OPERATORS',
+                   'Nr of states:',
+                   'PROPERTY: MLTPL  1   COMPONENT:*',
+                   'OVERLAP MATRIX FOR THE ORIGINAL STATES:']
+
+class MOLCASout:
+    '''Lines of a MOLCAS output together with an index of its section and table markers.
+
+    The index is built in one pass over the output. The CI energies, the spin-orbit matrix and the RASSI sections
+    are then extracted once from the indexed lines only and kept in self.cache, so that the get<quantity> routines
+    are lookups instead of scans over the whole output for every matrix element.
+    The object can be used like the list of lines.'''
+
+    def __init__(self,lines):
+        self.lines=lines
+        self.index=dict( [ (marker,[]) for marker in MOLCASOUT_MARKERS ] )
+        for iline,line in enumerate(lines):
+            for marker in MOLCASOUT_MARKERS:
+                if marker in line:
+                    self.index[marker].append(iline)
+        self.keys={}
+        self.cache={}
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self,i):
+        return self.lines[i]
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def positions(self,string):
+        # line numbers of all lines containing string (string must contain one of the markers)
+        if not string in self.keys:
+            marker=[ m for m in MOLCASOUT_MARKERS if m in string ][0]
+            self.keys[string]=[ i for i in self.index[marker] if string in self.lines[i] ]
+        return self.keys[string]
+
+    def find(self,string,start=0):
+        # first line number >=start of a line containing string, or -1
+        positions=self.positions(string)
+        i=bisect.bisect_left(positions,start)
+        if i==len(positions):
+            return -1
+        return positions[i]
+
+    def find_last(self,string,start,stop):
+        # last line number in [start,stop] of a line containing string, or -1
+        positions=self.positions(string)
+        i=bisect.bisect_right(positions,stop)-1
+        if i<0 or positions[i]<start:
+            return -1
+        return positions[i]
+
+    def merged(self,strings):
+        # sorted line numbers of all lines containing any of the strings
+        return sorted(set( [ i for string in strings for i in self.positions(string) ] ))
+
+    def cienergies(self,method,dkh):
+        '''Extracts the CI energies of all multiplicities, following the same rules as the former line-by-line scan:
+        after the module marker, a multiplicity is active once its spin line was seen, and the first energy of
+        each state (or the first energy table for DKH) after that counts.
+
+        Returns:
+        1 dictionary: (mult,state) -> energy, or mult -> line number of the DKH energy table'''
+        key=('cienergies',method,dkh)
+        if key in self.cache:
+            return self.cache[key]
+        if method==0:
+            modulestring='&RASSCF'
+            spinstring='Spin quantum number'
+            if dkh:
+                energystring='Final state energy(ies)'
+            else:
+                energystring='::    RASSCF root number'
+                stateindex=4
+                enindex=7
+        elif method==1:
+            modulestring='&CASPT2'
+            spinstring='Spin quantum number'
+            energystring='::    CASPT2 Root'
+            stateindex=3
+            enindex=6
+        elif method==2:
+            modulestring='&CASPT2'
+            spinstring='Spin quantum number'
+            energystring='::    MS-CASPT2 Root'
+            stateindex=3
+            enindex=6
+        energies={}
+        module=False
+        mults=[]
+        for i in self.merged([modulestring,spinstring,energystring]):
+            line=self.lines[i]
+            if modulestring in line:
+                module=True
+            elif spinstring in line and module:
+                spin=float(line.split()[3])
+                if not int(2*spin)+1 in mults:
+                    mults.append(int(2*spin)+1)
+            elif energystring in line and module and mults:
+                if method==0 and dkh:
+                    for mult in mults:
+                        energies.setdefault(mult,i)
+                else:
+                    l=line.split()
+                    for mult in mults:
+                        energies.setdefault( (mult,int(l[stateindex])), float(l[enindex]) )
+        self.cache[key]=energies
+        return energies
+
+    def socmatrix(self):
+        '''Extracts the spin-orbit matrix elements from the first SOC table.
+
+        Returns:
+        1 dictionary: (I1,I2) with I1<=I2 -> (real part, imaginary part) as printed for the first listing of the pair,
+          or None if there is no SOC table'''
+        if 'soc' in self.cache:
+            return self.cache['soc']
+        socstring='I1  S1  MS1    I2  S2  MS2    Real part    Imag part      Absolute'
+        stopstring='----------------------------------------------------------------------'
+        iline=self.find(socstring)
+        if iline==-1:
+            table=None
+        else:
+            table={}
+            while True:
+                iline+=1
+                if stopstring in self.lines[iline]:
+                    break
+                l=self.lines[iline].split()
+                I1=int(l[0])
+                I2=int(l[3])
+                table.setdefault( (min(I1,I2),max(I1,I2)), (float(l[6]),float(l[7])) )
+        self.cache['soc']=table
+        return table
+
+    def rassi_sections(self):
+        '''Finds the RASSI runs and the multiplicities of their JOBIPH files.
+
+        Returns:
+        1 list of tuples: (line number of the end of the RASSI input section, list of multiplicities)'''
+        if 'rassi' in self.cache:
+            return self.cache['rassi']
+        modulestring='&RASSI'
+        spinstring='SPIN MULTIPLICITY:'
+        stopstring='The following data are common to all the states'
+        sections=[]
+        module=False
+        jobiphmult=[]
+        for iline in self.merged([modulestring,spinstring,stopstring]):
+            line=self.lines[iline]
+            if modulestring in line:
+                module=True
+                jobiphmult=[]
+            elif module:
+                if spinstring in line:
+                    jobiphmult.append(int(line.split()[-1]))
+                if stopstring in line:
+                    sections.append( (iline,jobiphmult) )
+                    module=False
+        self.cache['rassi']=sections
+        return sections
+
+# ======================================================================= #
+def molcas_output(out):
+    # wraps a list of output lines into a MOLCASout object (if it is not one already)
+    if isinstance(out,MOLCASout):
+        return out
+    return MOLCASout(out)
+
 # ======================================================================= #
 def getcienergy(out,mult,state,version,method,dkh):
-    '''Searches a complete MOLCAS output file for the MRCI energy of (mult,state).
+    '''Looks up the CI energy of (mult,state) in the CI energies extracted from a MOLCAS output (see MOLCASout.cienergies).
 
     Arguments:
-    1 list of strings: MOLCAS output
+    1 list of strings or MOLCASout: MOLCAS output
     2 integer: mult
     3 integer: state
 
     Returns:
     1 float: total CI energy of specified state in hartree'''
 
-    if method==0:
-        modulestring='&RASSCF'
-        spinstring='Spin quantum number'
-        if dkh:
-            energystring='Final state energy(ies)'
-        else:
-            energystring='::    RASSCF root number'
-            stateindex=4
-            enindex=7
-    elif method==1:
-        modulestring='&CASPT2'
-        spinstring='Spin quantum number'
-        energystring='::    CASPT2 Root'
-        stateindex=3
-        enindex=6
-    elif method==2:
-        modulestring='&CASPT2'
-        spinstring='Spin quantum number'
-        energystring='::    MS-CASPT2 Root'
-        stateindex=3
-        enindex=6
-
-    module = False
-    correct_mult = False
-    for i, line in enumerate(out):
-        if modulestring in line:
-            module = True
-        elif spinstring in line and module:
-            spin = float(line.split()[3])
-            if int(2*spin)+1==mult:
-                correct_mult = True
-        elif energystring in line and module and correct_mult:
-            if method==0 and dkh:
-                l=out[i+4+state].split()
-                return float(l[1])
-            else:
-                l=line.split()
-                if int(l[stateindex])==state:
-                    return float(l[enindex])
+    out=molcas_output(out)
+    energies=out.cienergies(method,dkh)
+    if method==0 and dkh:
+        if mult in energies:
+            l=out[energies[mult]+4+state].split()
+            return float(l[1])
+    elif (mult,state) in energies:
+        return energies[(mult,state)]
     print 'CI energy of state %i in mult %i not found!' % (state,mult)
     sys.exit(19)
 
@@ -975,53 +1149,40 @@ def getcidm(out,mult,state1,state2,pol,version):
     if pol=='X' or pol=='Y' or pol=='Z':
         pol=IToPol[pol]
 
-    modulestring='&RASSI'
-    spinstring='SPIN MULTIPLICITY:'
-    stopstring='The following data are common to all the states'
     stop2string='Special properties section'
     statesstring='Nr of states:'
     #matrixstring=' PROPERTY: MLTPL  1   COMPONENT:   %i' % (pol+1)
     matrixstring='PROPERTY: MLTPL  1   COMPONENT:*   %i' % (pol+1)
 
     # first, find the correct RASSI output section for the given multiplicity
-    module=False
-    jobiphmult=[]
-
-    for iline, line in enumerate(out):
-        if modulestring in line:
-            module=True
-            jobiphmult=[]
-        elif module:
-            if spinstring in line:
-                jobiphmult.append(int(line.split()[-1]))
-            if stopstring in line:
-                if all(i==mult for i in jobiphmult):
-                    break
-                else:
-                    module=False
+    out=molcas_output(out)
+    for iline,jobiphmult in out.rassi_sections():
+        if all(i==mult for i in jobiphmult):
+            break
     else:
         print 'DM element not found!', mult,state1,state2,pol
         print 'No RASSI run for multiplicity %i found!' % (mult)
         sys.exit(20)
 
-    # Now start searching at iline, looking for the requested matrix element
-    for jline,line in enumerate(out[iline+1:]):
-        if stop2string in line:
-            print 'DM element not found!', mult,state1,state2,pol
-            print 'Found correct RASSI run, but too few matrix elements!'
-            sys.exit(21)
-        if statesstring in line:
-            nstates=int(line.split()[-1])
-            if len(jobiphmult)==2:
-                stateshift=nstates/2
-            else:
-                stateshift=0
-        if matrixstring in line:
-            block=(stateshift+state2-1)/4
-            rowshift=3+stateshift+state1 + (6+nstates)*block
-            colshift=1+(stateshift+state2-1)%4
+    # Now look for the requested matrix after iline
+    imatrix=out.find(matrixstring,iline+1)
+    istop=out.find(stop2string,iline+1)
+    if istop!=-1 and (imatrix==-1 or istop<=imatrix):
+        print 'DM element not found!', mult,state1,state2,pol
+        print 'Found correct RASSI run, but too few matrix elements!'
+        sys.exit(21)
+    if imatrix==-1:
+        return None
+    nstates=int(out[out.find_last(statesstring,iline+1,imatrix)].split()[-1])
+    if len(jobiphmult)==2:
+        stateshift=nstates/2
+    else:
+        stateshift=0
+    block=(stateshift+state2-1)/4
+    rowshift=3+stateshift+state1 + (6+nstates)*block
+    colshift=1+(stateshift+state2-1)%4
 
-            return float(out[iline+jline+rowshift+1].split()[colshift])
+    return float(out[imatrix+rowshift].split()[colshift])
 
 
 # ======================================================================= #
@@ -1056,8 +1217,6 @@ def getsocme(out, mult1, state1, ms1, mult2, state2, ms2, states, version, metho
     Returns:
     1 complex: SO hamiltonian matrix element in hartree'''
     rcm_to_Eh=4.556335e-6
-    socstring='I1  S1  MS1    I2  S2  MS2    Real part    Imag part      Absolute'
-    stopstring='----------------------------------------------------------------------'
 
     # return diagonal elements
     if mult1==mult2 and state1==state2 and ms1==ms2:
@@ -1073,45 +1232,19 @@ def getsocme(out, mult1, state1, ms1, mult2, state2, ms2, states, version, metho
     s1 = getMOLCASstatenumber(mult1, state1, ms1, states)
     s2 = getMOLCASstatenumber(mult2, state2, ms2, states)
 
-    ## accelerated version of finding the SOC section if it was already found for this particular output file
-    #if SOCME_START_ILINE==-1 or SOCME_FILE_ID!=hash(tuple(out)):
-        ## look for spin-orbit section
-        #for iline,line in enumerate(out):
-            #if socstring in line:
-                #break
-        #else:
-            #print 'No Spin-Orbit section found in output!'
-            #sys.exit(22)
-        #global SOCME_START_ILINE
-        #SOCME_START_ILINE=iline
-        #global SOCME_FILE_ID
-        #SOCME_FILE_ID=hash(tuple(out))
-    #else:
-        #iline=SOCME_START_ILINE
-
-    # look for spin-orbit section
-    for iline,line in enumerate(out):
-        if socstring in line:
-            break
-    else:
+    # look up the matrix element in the spin-orbit section
+    out=molcas_output(out)
+    table=out.socmatrix()
+    if table==None:
         print 'No Spin-Orbit section found in output!'
         sys.exit(23)
-
-    # look for matrix element
     socme=complex(0.0,0.0)
-    while True:
-        iline+=1
-        if stopstring in out[iline]:
-            break
-        l=out[iline].split()
-        I1=int(l[0])
-        I2=int(l[3])
-        if (I1,I2)==(s1,s2) or (I1,I2)==(s2,s1):
-            if s2<=s1:
-                socme=complex( float(l[6]), +float(l[7]))
-            else:
-                socme=complex( float(l[6]), -float(l[7]))
-            break
+    if (min(s1,s2),max(s1,s2)) in table:
+        real,imag=table[(min(s1,s2),max(s1,s2))]
+        if s2<=s1:
+            socme=complex(real,+imag)
+        else:
+            socme=complex(real,-imag)
     return socme*rcm_to_Eh
 
 # ======================================================================= #
@@ -1300,50 +1433,37 @@ def getsmate(out,mult,state1,state2,states):
     # one case:
     # - Dipole moments are in RASSI calculation with two JOBIPH files of same multiplicity
 
-    modulestring='&RASSI'
-    spinstring='SPIN MULTIPLICITY:'
-    stopstring='The following data are common to all the states'
     stop2string='MATRIX ELEMENTS OF 1-ELECTRON OPERATORS'
     statesstring='Nr of states:'
     matrixstring='OVERLAP MATRIX FOR THE ORIGINAL STATES:'
 
     # first, find the correct RASSI output section for the given multiplicity
-    module=False
-    jobiphmult=[]
-
-    for iline, line in enumerate(out):
-        if modulestring in line:
-            module=True
-            jobiphmult=[]
-        elif module:
-            if spinstring in line:
-                jobiphmult.append(int(line.split()[-1]))
-            if stopstring in line:
-                if jobiphmult==[mult,mult]:
-                    break
-                else:
-                    module=False
+    out=molcas_output(out)
+    for iline,jobiphmult in out.rassi_sections():
+        if jobiphmult==[mult,mult]:
+            break
     else:
         print 'Overlap element not found!', mult,state1,state2
         print 'No correct RASSI run for multiplicity %i found!' % (mult)
         sys.exit(26)
 
-    # Now start searching at iline, looking for the requested matrix element
-    for jline,line in enumerate(out[iline+1:]):
-        if stop2string in line:
-            print 'Overlap element not found!', mult,state1,state2
-            print 'Found correct RASSI run, but too few matrix elements!'
-            sys.exit(27)
-        if statesstring in line:
-            nstates=int(line.split()[-1])
-        if matrixstring in line:
-            rowshift=1
-            for i in range(nstates/2+state2-1):
-                rowshift+=i/5+1
-            rowshift+=1+(state1-1)/5
-            colshift=(state1-1)%5
-
-            return float(out[iline+jline+rowshift+1].split()[colshift])
+    # Now look for the overlap matrix after iline
+    imatrix=out.find(matrixstring,iline+1)
+    istop=out.find(stop2string,iline+1)
+    if istop!=-1 and (imatrix==-1 or istop<=imatrix):
+        print 'Overlap element not found!', mult,state1,state2
+        print 'Found correct RASSI run, but too few matrix elements!'
+        sys.exit(27)
+    if imatrix==-1:
+        return None
+    nstates=int(out[out.find_last(statesstring,iline+1,imatrix)].split()[-1])
+    rowshift=1
+    for i in range(nstates/2+state2-1):
+        rowshift+=i/5+1
+    rowshift+=1+(state1-1)/5
+    colshift=(state1-1)%5
+
+    return float(out[imatrix+rowshift].split()[colshift])
 
 # ======================================================================= #
 def getQMout(out,QMin):
@@ -1377,6 +1497,9 @@ def getQMout(out,QMin):
     1 dictionary: QMout'''
 
 
+    # index the output once, all get<quantity> routines use the index
+    out=molcas_output(out)
+
     # get version of MOLCAS
     version=QMin['version']
     method=QMin['method']
@@ -2278,7 +2401,7 @@ def readQMin(QMinfilename):
     integers=['nactel','inactive','ras2','frozen']
     strings =['basis','method','baslib']
     floats=['ipea','imaginary','gradaccumax','gradaccudefault','displ', 'rasscf_thrs_e', 'rasscf_thrs_rot', 'rasscf_thrs_egrd','cholesky_accu']
-    booleans=['cholesky','no-douglas-kroll','qmmm','cholesky_analytical','cobramm']
+    booleans=['cholesky','no-douglas-kroll','qmmm','cholesky_analytical','cobramm','numgrad_onesided']
     for i in booleans:
         QMin['template'][i]=False
     QMin['template']['roots'] = [0 for i in range(8)]
@@ -2297,6 +2420,8 @@ def readQMin(QMinfilename):
     QMin['template']['rasscf_thrs_egrd']=1e-4
     QMin['template']['pcmset']={'solvent':'water', 'aare':0.4,'r-min':1.0,'on':False}
     QMin['template']['pcmstate']=(QMin['statemap'][1][0],QMin['statemap'][1][1])
+    QMin['template']['numgrad_atoms']=[]
+    QMin['template']['numgrad_components']=[]
 
 
     for line in template:
@@ -2332,6 +2457,10 @@ def readQMin(QMinfilename):
                 QMin['template']['pcmset']['r-min']=float(line[3])
         elif 'pcmstate' in line[0]:
             QMin['template']['pcmstate']=(int(line[1]),int(line[2]))
+        elif 'numgrad_atoms' in line[0]:
+            QMin['template']['numgrad_atoms']+=[ int(i) for i in line[1:] ]
+        elif 'numgrad_components' in line[0]:
+            QMin['template']['numgrad_components']+=line[1:]
 
     # roots must be larger or equal to states
     for i,n in enumerate(QMin['template']['roots']):
@@ -2424,6 +2553,22 @@ def readQMin(QMinfilename):
                     QMin['gradmode']=0
         if QMin['gradmode']==2:
             QMin['displ']=QMin['template']['displ']/au2a
+            # displaced coordinates (iatom,ixyz) of the numerical gradients, by default all 3*natom
+            atoms=QMin['template']['numgrad_atoms']
+            if not atoms:
+                atoms=range(1,QMin['natom']+1)
+            for iatom in atoms:
+                if not 1<=iatom<=QMin['natom']:
+                    print 'Atom %i in numgrad_atoms does not exist! Atoms are counted from 1 to %i.' % (iatom,QMin['natom'])
+                    sys.exit(92)
+            components=QMin['template']['numgrad_components']
+            if not components:
+                components=['x','y','z']
+            for xyz in components:
+                if not xyz.upper() in ['X','Y','Z']:
+                    print 'Unknown Cartesian component "%s" in numgrad_components! Use x, y or z.' % (xyz)
+                    sys.exit(93)
+            QMin['numgrad']=[ [iatom-1,ixyz] for iatom in sorted(set(atoms)) for ixyz in sorted(set([ IToPol[xyz.upper()] for xyz in components ])) ]
     else:
         QMin['gradmode']=0
     QMin['ncpu']=max(1,QMin['ncpu'])
@@ -2992,56 +3137,240 @@ def runMOLCAS(WORKDIR,MOLCAS,ncpu,strip=False):
 
 # ======================================================================= #
 def doDisplacement(QMin,idir,displ):
+    # only the geometry differs between displaced jobs, so only the geometry is copied
     iatom,ixyz,isign=tuple(idir)
-    QMin1=deepcopy(QMin)
+    QMin1=dict(QMin)
+    QMin1['geo']=[ list(atom) for atom in QMin['geo'] ]
     QMin1['geo'][iatom][ixyz+1]+=isign*displ
     return QMin1
 
+# ======================================================================= #
+class Displacement:
+    '''Compact descriptor of one displaced single point of a numerical gradient.
+
+    Only the base job name, the displacement (iatom, ixyz, isign, displ) and the number of cores are stored.
+    The full QMin is rebuilt on demand from the read-only base job in DISPLACEMENT_BASES,
+    which is filled once in generate_joblist and inherited by the Pool workers.
+    Hence the job list is cheap to create and only a few numbers are pickled per job.'''
+
+    def __init__(self,base,iatom,ixyz,isign,displ,ncpu):
+        self.base=base
+        self.iatom=iatom
+        self.ixyz=ixyz
+        self.isign=isign
+        self.displ=displ
+        self.ncpu=ncpu
+
+    def __contains__(self,key):
+        return key in DISPLACEMENT_BASES[self.base]
+
+    def __repr__(self):
+        return 'Displacement(%s, iatom=%i, ixyz=%i, isign=%+i, displ=%f, ncpu=%i)' % (self.base,self.iatom,self.ixyz,self.isign,self.displ,self.ncpu)
+
+    def expand(self):
+        '''Builds the QMin dictionary of the displaced job.
+
+        Returns:
+        1 dict: QMin of the displaced job (shares all unchanged entries with the base job)'''
+
+        QMin1=doDisplacement(DISPLACEMENT_BASES[self.base],[self.iatom,self.ixyz,self.isign],self.displ)
+        # run_calc may increase the gradient accuracy in the template
+        QMin1['template']=dict(QMin1['template'])
+        QMin1['ncpu']=self.ncpu
+        return QMin1
 
 # ======================================================================= #
+def jobQMin(job):
+    '''Returns the QMin dictionary of a joblist entry, expanding displacement descriptors.'''
+    if isinstance(job,Displacement):
+        return job.expand()
+    return job
 
-def parallel_speedup(N,scaling):
-    # computes the parallel speedup from Amdahls law
-    # with scaling being the fraction of parallelizable work and (1-scaling) being the serial part
-    return 1./((1-scaling)+scaling/N)
 
 # ======================================================================= #
 
-def divide_slots(ncpu,ntasks,scaling):
-    # this routine figures out the optimal distribution of the tasks over the CPU cores
-    #   returns the number of rounds (how many jobs each CPU core will contribute to),
-    #   the number of slots which should be set in the Pool,
-    #   and the number of cores for each job.
-    minpar=1
-    ntasks_per_round=ncpu/minpar
-    if ncpu==1:
-        ntasks_per_round=1
-    ntasks_per_round=min(ntasks_per_round,ntasks)
-    optimal={}
-    for i in range(1,1+ntasks_per_round):
-        nrounds=int(math.ceil(float(ntasks)/i))
-        ncores=ncpu/i
-        optimal[i]=nrounds/parallel_speedup(ncores,scaling)
-    #print optimal
-    best=min(optimal,key=optimal.get)
-    nrounds=int(math.ceil(float(ntasks)/best))
-    ncores=ncpu/best
-
-    cpu_per_run=[0 for i in range(ntasks)]
-    if nrounds==1:
-        itask=0
-        for icpu in range(ncpu):
-            cpu_per_run[itask]+=1
-            itask+=1
-            if itask>=ntasks:
-                itask=0
-        nslots=ntasks
+# job scheduling from measured wall times (read_schedule_history ... report_schedule)
+# these routines are identical copies in SHARC_ORCA.py and SHARC_MOLCAS.py, keep both files in sync
+
+def read_schedule_history(savedir):
+    '''Reads the measured wall times of previous jobs from SCHEDULE_HISTORY_FILE in savedir.
+
+    Arguments:
+    1 string: path to savedir
+
+    Returns:
+    1 dict: job type -> list of (ncpu, wall time in s), oldest first'''
+
+    history={}
+    filename=os.path.join(savedir,SCHEDULE_HISTORY_FILE)
+    if not os.path.isfile(filename):
+        return history
+    for line in readfile(filename):
+        s=line.split()
+        if len(s)!=3 or s[0].startswith('#'):
+            continue
+        try:
+            history.setdefault(s[0],[]).append( (int(s[1]),float(s[2])) )
+        except ValueError:
+            continue
+    return history
+
+def write_schedule_history(savedir,history):
+    '''Writes the job timing history to SCHEDULE_HISTORY_FILE in savedir,
+    keeping only the last SCHEDULE_HISTORY_LENGTH measurements per job type.
+
+    Arguments:
+    1 string: path to savedir
+    2 dict: job type -> list of (ncpu, wall time in s)'''
+
+    string='# job type, ncpu, wall time (s)\n'
+    for jobtype in sorted(history):
+        for ncpu,walltime in history[jobtype][-SCHEDULE_HISTORY_LENGTH:]:
+            string+='%-20s %4i %14.3f\n' % (jobtype,ncpu,walltime)
+    writefile(os.path.join(savedir,SCHEDULE_HISTORY_FILE),string)
+
+def job_type(job):
+    '''Job type for the cost model: master jobs are distinguished by their name,
+    all other jobs only by the prefix of the job name (e.g., all gradient jobs share one type).'''
+    if job.startswith('master'):
+        return job
+    return job.split('_')[0]
+
+def fit_job_cost(records,scaling):
+    '''Fits the wall time model t(n) = a + b/n (serial part a, parallelizable part b) to measured wall times.
+
+    If the measurements do not determine a and b (only one core count, or an unphysical fit),
+    the split into a and b is taken from scaling, as in Amdahl's law.
+
+    Arguments:
+    1 list of (integer, float): measured (ncpu, wall time)
+    2 float: fraction of parallelizable work
+
+    Returns:
+    1 tuple of float: (a, b)'''
+
+    records=records[-SCHEDULE_HISTORY_LENGTH:]
+    m=len(records)
+    xs=[ 1./n for n,t in records ]
+    ts=[ t for n,t in records ]
+    mx=sum(xs)/m
+    mt=sum(ts)/m
+    sxx=sum( [ (x-mx)**2 for x in xs ] )
+    if sxx>1e-10:
+        b=sum( [ (x-mx)*(t-mt) for x,t in zip(xs,ts) ] )/sxx
+        a=mt-b*mx
+        if a>=0. and b>=0.:
+            return (a,b)
+    t1=sum( [ t/((1.-scaling)+scaling*x) for x,t in zip(xs,ts) ] )/m
+    return ((1.-scaling)*t1,scaling*t1)
+
+def lpt_makespan(times,nslots):
+    # makespan of a list of jobs that are started in the given order on the first free slot
+    slots=[0. for i in range(nslots)]
+    for t in times:
+        heapq.heapreplace(slots,slots[0]+t)
+    return max(slots)
+
+def schedule_jobs(ncpu,jobs,history,scaling,mincpu=1,maxcpu=None):
+    '''Distributes the CPU cores over a set of jobs which can run concurrently.
+
+    The wall time of each job is predicted from the cost model of its job type (see fit_job_cost).
+    Job types without history get the average single-core cost of the known types (or unit cost).
+    Two kinds of schedules are compared:
+    - all jobs at once, each extra core is given to the job with the longest predicted time
+    - k slots with ncpu/k cores each, the jobs being submitted longest first (LPT list scheduling, as done by the Pool)
+    The schedule with the shortest predicted makespan is used.
+
+    Arguments:
+    1 integer: number of CPU cores
+    2 list of strings: job names
+    3 dict: job timing history (see read_schedule_history)
+    4 float: fraction of parallelizable work, used for job types without sufficient history
+    5 integer: minimum number of cores per job
+    6 integer: maximum number of cores per job
+
+    Returns:
+    1 integer: number of slots for the Pool
+    2 dict: job name -> number of cores
+    3 list of strings: order of submission
+    4 float: predicted makespan in seconds (None if not all job types have a history)'''
+
+    if maxcpu==None:
+        maxcpu=ncpu
+    maxcpu=min(maxcpu,ncpu)
+    mincpu=min(mincpu,maxcpu)
+    ntasks=len(jobs)
+    if ntasks==0:
+        return 1,{},[],None
+
+    # cost models
+    costs={}
+    for job in jobs:
+        jobtype=job_type(job)
+        if jobtype in history and history[jobtype]:
+            costs[job]=fit_job_cost(history[jobtype],scaling)
+    known=[ a+b for a,b in costs.values() ]
+    if known:
+        t1=sum(known)/len(known)
     else:
-        for itask in range(ntasks):
-            cpu_per_run[itask]=ncores
-        nslots=ncpu/ncores
-    #print nrounds,nslots,cpu_per_run
-    return nrounds,nslots,cpu_per_run
+        t1=1.
+    for job in jobs:
+        if not job in costs:
+            costs[job]=((1.-scaling)*t1,scaling*t1)
+    def walltime(job,n):
+        return costs[job][0]+costs[job][1]/n
+
+    # longest jobs first
+    order=[ job for t,i,job in sorted( [ (-walltime(job,1),i,job) for i,job in enumerate(jobs) ] ) ]
+
+    best=None
+    for k in range(1,min(ntasks,ncpu/mincpu)+1):
+        if k<ntasks:
+            # k slots with equal number of cores
+            n=min(ncpu/k,maxcpu)
+            cpu_per_run=dict( [ (job,n) for job in jobs ] )
+            makespan=lpt_makespan([ walltime(job,n) for job in order ],k)
+        else:
+            # all jobs at once, give the cores one by one to the currently slowest job (of those, the one with fewest cores)
+            cpu_per_run=dict( [ (job,mincpu) for job in jobs ] )
+            for icpu in range(ncpu-mincpu*ntasks):
+                candidates=[ job for job in order if cpu_per_run[job]<maxcpu ]
+                if not candidates:
+                    break
+                slowest=max(candidates,key=lambda job: (walltime(job,cpu_per_run[job]),-cpu_per_run[job]))
+                cpu_per_run[slowest]+=1
+            makespan=max( [ walltime(job,cpu_per_run[job]) for job in jobs ] )
+        # makespans which only differ by rounding are equal, then prefer more cores per job and then more slots
+        tie=(-min(cpu_per_run.values()),-k)
+        if best==None or makespan<best[4]*(1.-1e-9) or (makespan<=best[4]*(1.+1e-9) and tie<best[0]):
+            best=(tie,k,cpu_per_run,order,makespan)
+
+    tie,nslots,cpu_per_run,order,makespan=best
+    if not all( [ job_type(job) in history and history[job_type(job)] for job in jobs ] ):
+        makespan=None
+    return nslots,cpu_per_run,order,makespan
+
+def report_schedule(QMin,ijobset,ncpus,walltimes,errorcodes,makespan):
+    '''Prints predicted versus actual makespan of a job set and adds the measured wall times to the job timing history.
+
+    Arguments:
+    1 dict: QMin
+    2 integer: index of the job set
+    3 dict: job name -> number of cores of the job
+    4 dict: job name -> measured wall time in s
+    5 dict: job name -> error code
+    6 float: measured makespan in s'''
+
+    predicted=QMin['schedule_makespan'][ijobset]
+    if predicted==None:
+        print 'Job set %i: makespan %.1f s (no timing history for the prediction yet)' % (ijobset+1,makespan)
+    else:
+        print 'Job set %i: makespan %.1f s, predicted %.1f s' % (ijobset+1,makespan,predicted)
+    history=read_schedule_history(QMin['savedir'])
+    for job in ncpus:
+        if errorcodes[job]==0:
+            history.setdefault(job_type(job),[]).append( (ncpus[job],walltimes[job]) )
+    write_schedule_history(QMin['savedir'],history)
 
 
 # ======================================================================= #
@@ -3094,7 +3423,6 @@ def generate_joblist(QMin):
         QMin2['samestep']=[]
         ntasks=len(QMin['gradmap'])+len(QMin['nacmap'])
         if QMin['mpi_parallel']:
-            #nrounds,nslots,cpu_per_run=divide_slots(QMin['ncpu'],ntasks,QMin['schedule_scaling'])
             nrounds=ntasks
             nslots=1
             cpu_per_run=[QMin['ncpu']]*ntasks
@@ -3155,9 +3483,14 @@ def generate_joblist(QMin):
             QMin2=removekey(QMin2,r)
         QMin2['newstep']=[]
         QMin2['gradmap']=[]
-        ntasks=6*QMin['natom']
+        # central differences need two displacements per coordinate,
+        # one-sided differences reuse the central point of the master job (3N+1 calculations)
+        if QMin['template']['numgrad_onesided']:
+            isigns=[1.]
+        else:
+            isigns=[-1.,1.]
+        ntasks=len(isigns)*len(QMin['numgrad'])
         if QMin['mpi_parallel']:
-            #nrounds,nslots,cpu_per_run=divide_slots(QMin['ncpu'],ntasks,QMin['schedule_scaling'])
             nrounds=ntasks
             nslots=1
             cpu_per_run=[QMin['ncpu']]*ntasks
@@ -3167,39 +3500,42 @@ def generate_joblist(QMin):
             cpu_per_run=[1]*ntasks
         QMin['nslots_pool'].append(nslots)
 
-        #if 'socdr' in QMin or 'dmdr' in QMin:
-            #idispl=QMin['ncpu']-1
-        #else:
-            #idispl=0
+        # all displaced jobs share the same input apart from the geometry
+        # the displacement jobs only carry a small descriptor pointing to this base job
+        QMin2['displacement']=[]
+        remove=['always_guess','always_orb_init','init']
+        for r in remove:
+            QMin2=removekey(QMin2,r)
+        if 'socdr' in QMin:
+            QMin2['soc']=[]
+        elif 'grad' in QMin:
+            QMin2['h']=[]
+        if 'dmdr' in QMin:
+            QMin2['dm']=[]
+        QMin2['overlap']=[ [j+1,i+1] for i in range(QMin['nmstates']) for j in range(i+1)]
+        DISPLACEMENT_BASES['displ']=QMin2
+
         icount=0
         joblist.append({})
-        for iatom in range(QMin['natom']):
-            for ixyz in range(3):
-                for isign in [-1.,1.]:
-                    #idispl+=1
-                    #if idispl==QMin['ncpu']:
-                        #joblist.append({})
-                    QMin3=deepcopy(QMin2)
-                    QMin3=doDisplacement(QMin3,[iatom,ixyz,isign],QMin['displ'])
-
-                    #if 'socdr' in QMin or 'dmdr' in QMin or idispl>QMin['ncpu']:
-                    QMin3['displacement']=[]
-                    remove=['always_guess','always_orb_init','init']
-                    for r in remove:
-                        QMin3=removekey(QMin3,r)
-                    if 'socdr' in QMin:
-                        QMin3['soc']=[]
-                    elif 'grad' in QMin:
-                        QMin3['h']=[]
-                    if 'dmdr' in QMin:
-                        QMin3['dm']=[]
-                    #if 'socdr' in QMin or 'dmdr' in QMin:
-                    QMin3['overlap']=[ [j+1,i+1] for i in range(QMin['nmstates']) for j in range(i+1)]
-                    QMin3['ncpu']=cpu_per_run[icount]
-                    icount+=1
-
-                    jobname='displ_%i_%i_%s' % (iatom,ixyz,{-1.:'p',1.:'n'}[isign])
-                    joblist[-1][jobname]=QMin3
+        for iatom,ixyz in QMin['numgrad']:
+            for isign in isigns:
+                jobname='displ_%i_%i_%s' % (iatom,ixyz,{-1.:'p',1.:'n'}[isign])
+                joblist[-1][jobname]=Displacement('displ',iatom,ixyz,isign,QMin['displ'],cpu_per_run[icount])
+                icount+=1
+
+    # the number of cores per job is fixed by the parallelization mode (see above),
+    # the timing history only decides in which order the jobs are submitted to the Pool
+    if QMin['mpi_parallel']:
+        cpu_per_job=QMin['ncpu']
+    else:
+        cpu_per_job=1
+    history=read_schedule_history(QMin['savedir'])
+    QMin['schedule_order']=[]
+    QMin['schedule_makespan']=[]
+    for jobset in joblist:
+        nslots,cpu_per_run,order,makespan=schedule_jobs(QMin['ncpu'],sorted(jobset),history,QMin['schedule_scaling'],cpu_per_job,cpu_per_job)
+        QMin['schedule_order'].append(order)
+        QMin['schedule_makespan'].append(makespan)
 
     if DEBUG:
         pprint.pprint(joblist,depth=3)
@@ -3207,6 +3543,7 @@ def generate_joblist(QMin):
 
 # ======================================================================= #
 def run_calc(WORKDIR,QMin):
+    QMin=jobQMin(QMin)
     err=96
     irun=-1
     while err==96:
@@ -3235,6 +3572,13 @@ def run_calc(WORKDIR,QMin):
             raise problem
     return err
 
+# ======================================================================= #
+def run_calc_timed(WORKDIR,QMin):
+    # runs run_calc and returns the error code and the wall time of the job in seconds
+    starttime=time.time()
+    err=run_calc(WORKDIR,QMin)
+    return err,time.time()-starttime
+
 # ======================================================================= #
 def runjobs(joblist,QMin):
 
@@ -3248,15 +3592,29 @@ def runjobs(joblist,QMin):
         if not jobset:
             continue
         pool = Pool(processes=QMin['nslots_pool'][ijobset])
-        for job in jobset:
+        results={}
+        starttime=time.time()
+        # submit the longest jobs first, the Pool then starts each job on the next free slot
+        for job in QMin['schedule_order'][ijobset]:
             QMin1=jobset[job]
             WORKDIR=os.path.join(QMin['scratchdir'],job)
 
-            errorcodes[job]=pool.apply_async(run_calc , [WORKDIR,QMin1])
-            #errorcodes[job]=run_calc(WORKDIR,QMin1)
+            results[job]=pool.apply_async(run_calc_timed , [WORKDIR,QMin1])
+            #results[job]=run_calc_timed(WORKDIR,QMin1)
             time.sleep(QMin['delay'])
         pool.close()
         pool.join()
+        makespan=time.time()-starttime
+
+        walltimes={}
+        ncpus={}
+        for job in results:
+            errorcodes[job],walltimes[job]=results[job].get()
+            if isinstance(jobset[job],Displacement):
+                ncpus[job]=jobset[job].ncpu
+            else:
+                ncpus[job]=jobset[job]['ncpu']
+        report_schedule(QMin,ijobset,ncpus,walltimes,errorcodes,makespan)
 
         if 'master' in jobset:
             WORKDIR=os.path.join(QMin['scratchdir'],'master')
@@ -3264,9 +3622,6 @@ def runjobs(joblist,QMin):
 
         print ''
 
-    for i in errorcodes:
-        errorcodes[i]=errorcodes[i].get()
-
     if PRINT:
         string='  '+'='*40+'\n'
         string+='||'+' '*40+'||\n'
@@ -3300,16 +3655,17 @@ def collectOutputs(joblist,QMin,errorcodes):
             if errorcodes[job]==0:
                 outfile=os.path.join(QMin['scratchdir'],job,'MOLCAS.out')
                 print 'Reading %s' % (outfile)
-                out=readfile(outfile)
-                QMout[job]=getQMout(out,jobset[job])
-                if 'displacement' in jobset[job]:
-                    QMout[job]=verifyQMout(QMout[job],jobset[job],out)
+                out=MOLCASout(readfile(outfile))
+                QMin1=jobQMin(jobset[job])
+                QMout[job]=getQMout(out,QMin1)
+                if 'displacement' in QMin1:
+                    QMout[job]=verifyQMout(QMout[job],QMin1,out)
             else:
                 if 'master' in job or 'grad' in job:
                     print 'Job %s did not finish sucessfully!' % (job)
                     sys.exit(77)
                 elif 'displ' in job:
-                    QMout[job]=get_zeroQMout(jobset[job])
+                    QMout[job]=get_zeroQMout(jobQMin(jobset[job]))
 
     #if DEBUG:
         #pprint.pprint(QMout,width=130)
@@ -3318,7 +3674,7 @@ def collectOutputs(joblist,QMin,errorcodes):
             QMout1=QMout[i]
             for j in joblist:
                 if i in j:
-                    QMin1=j[i]
+                    QMin1=jobQMin(j[i])
                     break
             print '==============================> %s <==============================' % (i)
             printQMout(QMin1,QMout1)
@@ -3334,27 +3690,98 @@ def overlapsign(x):
         return math.copysign(1,x)
 
 # ======================================================================= #
-def numdiff(enp,enn,enc,displ,o1p,o2p,o1n,o2n,iatom,idir):
-    o1p=overlapsign(o1p)
-    o2p=overlapsign(o2p)
-    o1n=overlapsign(o1n)
-    o2n=overlapsign(o2n)
-
-    enp*=o1p*o2p
-    enn*=o1n*o2n
-
-    if (o1p==0.0 or o2p==0.0) and (o1n==0.0 or o2n==0.0):
-        print 'Numerical differentiation failed, both displacements have bad overlap! iatom=%i, idir=%i' % (iatom,idir)
-        sys.exit(78)
-    if o1p==0.0 or o2p==0.0:
-        print 'Using one-sided NumDiff for iatom=%i, idir=%i. Retaining only negative displacement.' % (iatom,idir)
-        g=(enc-enn)/displ
-    elif o1n==0.0 or o2n==0.0:
-        print 'Using one-sided NumDiff for iatom=%i, idir=%i. Retaining only positive displacement.' % (iatom,idir)
-        g=(enp-enc)/displ
-    else:
-        g=(enp-enn)/2./displ
-    return -g
+def displacement_signs(QMin,QMoutall):
+    '''Computes the phase signs of all states for all displaced calculations.
+
+    The signs are obtained from the diagonal of the overlap matrix with the central point
+    (see overlapsign), 0. denotes a state which could not be tracked or a displacement which was not calculated.
+
+    Arguments:
+    1 dict: QMin
+    2 dict: QMout dictionaries of all jobs
+
+    Returns:
+    1 dict: (iatom,xyz) -> (signs of the positive displacement, signs of the negative displacement)'''
+
+    signs={}
+    for iatom,xyz in QMin['numgrad']:
+        signs[(iatom,xyz)]=[]
+        for name in ['displ_%i_%i_p' % (iatom,xyz),'displ_%i_%i_n' % (iatom,xyz)]:
+            if name in QMoutall:
+                signs[(iatom,xyz)].append( [ overlapsign(QMoutall[name]['overlap'][istate][istate].real) for istate in range(QMin['nmstates']) ] )
+            else:
+                signs[(iatom,xyz)].append( [ 0.0 for istate in range(QMin['nmstates']) ] )
+    return signs
+
+# ======================================================================= #
+def numdiff(QMin,QMoutall,signs,matrix,pairs,label,report):
+    '''Assembles the finite-difference derivatives of a set of matrix elements for all displaced coordinates.
+
+    The displaced matrix elements are phase corrected with the state signs.
+    Central differences are used where both displacements could be phase corrected,
+    otherwise one-sided differences with the central point are used and recorded in the report
+    (unless one-sided differences were requested with numgrad_onesided).
+    Only the coordinates in QMin['numgrad'] are differentiated, all other derivatives are zero.
+
+    Arguments:
+    1 dict: QMin
+    2 dict: QMout dictionaries of all jobs
+    3 dict: state signs from displacement_signs
+    4 function: returns the differentiated matrix of a QMout dictionary
+    5 list of (istate,jstate): matrix elements to differentiate
+    6 string: name of the quantity for the report
+    7 list: report, one-sided components are appended as (label,iatom,xyz,istate,jstate,retained displacement)
+
+    Returns:
+    1 dict: (istate,jstate) -> natom x 3 list of derivatives'''
+
+    natom=QMin['natom']
+    displ=QMin['displ']
+    onesided=QMin['template']['numgrad_onesided']
+    central=matrix(QMoutall['master'])
+    deriv=dict( (pair,[ [ 0.0 for xyz in range(3) ] for iatom in range(natom) ]) for pair in pairs )
+    for iatom,xyz in QMin['numgrad']:
+        sp,sn=signs[(iatom,xyz)]
+        namep='displ_%i_%i_p' % (iatom,xyz)
+        namen='displ_%i_%i_n' % (iatom,xyz)
+        matp=matn=None
+        if namep in QMoutall:
+            matp=matrix(QMoutall[namep])
+        if namen in QMoutall:
+            matn=matrix(QMoutall[namen])
+        for pair in pairs:
+            istate,jstate=pair
+            phasep=sp[istate]*sp[jstate]
+            phasen=sn[istate]*sn[jstate]
+            if phasep and phasen:
+                g=(matp[istate][jstate]*phasep-matn[istate][jstate]*phasen)/2./displ
+            elif phasen:
+                if not onesided:
+                    report.append( (label,iatom,xyz,istate,jstate,'negative') )
+                g=(central[istate][jstate]-matn[istate][jstate]*phasen)/displ
+            elif phasep:
+                report.append( (label,iatom,xyz,istate,jstate,'positive') )
+                g=(matp[istate][jstate]*phasep-central[istate][jstate])/displ
+            else:
+                print_numdiff_report(report)
+                if onesided:
+                    print 'Numerical differentiation failed, displacement has bad overlap! iatom=%i, idir=%i (%s, states %i %i)' % (iatom,xyz,label,istate+1,jstate+1)
+                else:
+                    print 'Numerical differentiation failed, both displacements have bad overlap! iatom=%i, idir=%i (%s, states %i %i)' % (iatom,xyz,label,istate+1,jstate+1)
+                sys.exit(78)
+            deriv[pair][iatom][xyz]=-g
+    return deriv
+
+# ======================================================================= #
+def print_numdiff_report(report):
+    '''Prints which components of the numerical derivatives fell back to one-sided differences.'''
+    if not report:
+        return
+    print 'Using one-sided NumDiff for %i components:' % (len(report))
+    print '  %-10s %6s %4s %7s %7s   %s' % ('Quantity','iatom','idir','istate','jstate','retained displacement')
+    for label,iatom,xyz,istate,jstate,side in report:
+        print '  %-10s %6i %4i %7i %7i   %s' % (label,iatom,xyz,istate+1,jstate+1,side)
+    print ''
 
 # ======================================================================= #
 def arrangeQMout(QMin,QMoutall,QMoutDyson):
@@ -3377,6 +3804,11 @@ def arrangeQMout(QMin,QMoutall,QMoutDyson):
                 if QMout['overlap'][i][i].real<0.:
                     QMout['phases'][i]=complex(-1.,0.)
 
+    # phase signs and one-sided fallbacks of the numerical derivatives
+    if QMin['gradmode']==2:
+        signs=displacement_signs(QMin,QMoutall)
+    report=[]
+
     if 'grad' in QMin:
         if QMin['gradmode']==0:
             QMout['grad']=QMoutall['master']['grad']
@@ -3394,25 +3826,9 @@ def arrangeQMout(QMin,QMoutall,QMoutDyson):
             QMout['grad']=grad
 
         elif QMin['gradmode']==2:
-            grad=[ [ [ 0.0 for xyz in range(3) ] for iatom in range(QMin['natom']) ] for istate in range(QMin['nmstates'])]
-            for iatom in range(QMin['natom']):
-                for xyz in range(3):
-                    namep='displ_%i_%i_p' % (iatom,xyz)
-                    namen='displ_%i_%i_n' % (iatom,xyz)
-                    displ=QMin['displ']
-                    for istate in range(QMin['nmstates']):
-
-                        enc=QMoutall['master']['h'][istate][istate].real
-
-                        enp=QMoutall[namep]['h'][istate][istate].real
-                        ovp=QMoutall[namep]['overlap'][istate][istate].real
-
-                        enn=QMoutall[namen]['h'][istate][istate].real
-                        ovn=QMoutall[namen]['overlap'][istate][istate].real
-
-                        g=numdiff(enp,enn,enc,displ,ovp,ovp,ovn,ovn,iatom,xyz)
-                        grad[istate][iatom][xyz]=g
-            QMout['grad']=grad
+            pairs=[ (istate,istate) for istate in range(QMin['nmstates']) ]
+            deriv=numdiff(QMin,QMoutall,signs,lambda Q: [ [ x.real for x in row ] for row in Q['h'] ],pairs,'grad',report)
+            QMout['grad']=[ deriv[pair] for pair in pairs ]
 
     if 'grad' in QMin and QMin['template']['cobramm']:
         if QMin['gradmode'] == 1:
@@ -3446,56 +3862,25 @@ def arrangeQMout(QMin,QMoutall,QMoutDyson):
                     QMout['nacdr'][j-1][i-1]=deepcopy(QMoutall[name]['nacdr'][j-1][i-1])
 
     if 'socdr' in QMin:
-        socdr=[ [ [ [ 0.0 for xyz in range(3) ] for iatom in range(QMin['natom']) ] for istate in range(QMin['nmstates'])] for jstate in range(QMin['nmstates'])]
-        displ=QMin['displ']
-        for iatom in range(QMin['natom']):
-            for xyz in range(3):
-                namep='displ_%i_%i_p' % (iatom,xyz)
-                namen='displ_%i_%i_n' % (iatom,xyz)
-                for istate in range(QMin['nmstates']):
-                    for jstate in range(QMin['nmstates']):
-                        if istate==jstate:
-                            continue
-
-                        enc=QMoutall['master']['h'][istate][jstate]
-
-                        enp=QMoutall[namep]['h'][istate][jstate]
-                        o1p=QMoutall[namep]['overlap'][istate][istate].real
-                        o2p=QMoutall[namep]['overlap'][jstate][jstate].real
-
-                        enn=QMoutall[namen]['h'][istate][jstate]
-                        o1n=QMoutall[namen]['overlap'][istate][istate].real
-                        o2n=QMoutall[namen]['overlap'][jstate][jstate].real
-
-                        g=numdiff(enp,enn,enc,displ,o1p,o2p,o1n,o2n,iatom,xyz)
-                        socdr[istate][jstate][iatom][xyz]=g
+        nmstates=QMin['nmstates']
+        pairs=[ (istate,jstate) for istate in range(nmstates) for jstate in range(nmstates) if istate!=jstate ]
+        deriv=numdiff(QMin,QMoutall,signs,lambda Q: Q['h'],pairs,'socdr',report)
+        socdr=[ [ [ [ 0.0 for xyz in range(3) ] for iatom in range(QMin['natom']) ] for istate in range(nmstates)] for jstate in range(nmstates)]
+        for istate,jstate in pairs:
+            socdr[istate][jstate]=deriv[(istate,jstate)]
         QMout['socdr']=socdr
 
     if 'dmdr' in QMin:
-        dmdr=[ [ [ [ [ 0.0 for xyz in range(3) ] for iatom in range(QMin['natom']) ] for istate in range(QMin['nmstates'])] for jstate in range(QMin['nmstates'])] for ipol in range(3) ]
-        displ=QMin['displ']
-        for iatom in range(QMin['natom']):
-            for xyz in range(3):
-                namep='displ_%i_%i_p' % (iatom,xyz)
-                namen='displ_%i_%i_n' % (iatom,xyz)
-                for ipol in range(3):
-                    for istate in range(QMin['nmstates']):
-                        for jstate in range(QMin['nmstates']):
-
-                            enc=QMoutall['master']['dm'][ipol][istate][jstate].real
-
-                            enp=QMoutall[namep]['dm'][ipol][istate][jstate].real
-                            o1p=QMoutall[namep]['overlap'][istate][istate].real
-                            o2p=QMoutall[namep]['overlap'][jstate][jstate].real
-
-                            enn=QMoutall[namen]['dm'][ipol][istate][jstate].real
-                            o1n=QMoutall[namen]['overlap'][istate][istate].real
-                            o2n=QMoutall[namen]['overlap'][jstate][jstate].real
-
-                            g=numdiff(enp,enn,enc,displ,o1p,o2p,o1n,o2n,iatom,xyz)
-                            dmdr[ipol][istate][jstate][iatom][xyz]=g
+        nmstates=QMin['nmstates']
+        pairs=[ (istate,jstate) for istate in range(nmstates) for jstate in range(nmstates) ]
+        dmdr=[]
+        for ipol in range(3):
+            deriv=numdiff(QMin,QMoutall,signs,lambda Q: [ [ x.real for x in row ] for row in Q['dm'][ipol] ],pairs,'dmdr_%s' % (IToPol[ipol]),report)
+            dmdr.append( [ [ deriv[(istate,jstate)] for jstate in range(nmstates) ] for istate in range(nmstates) ] )
         QMout['dmdr']=dmdr
 
+    print_numdiff_report(report)
+
     if 'ion' in QMin:
         QMout['prop']=QMoutDyson
 
@@ -3944,31 +4329,20 @@ def format_ci_vectors(ci_vectors):
     nvirt=ci_vectors['nvirt']
 
     # sort determinant strings
+    # packed byte strings sort like the tuples and are converted to the "eabd" notation with a single translate call
     dets=[]
     for key in ci_vectors:
         if key!='ndocc' and key!='nvirt':
-            dets.append(key)
+            dets.append( (str(bytearray(key)),key) )
     dets.sort(reverse=True)
 
-    string='%i %i %i\n' % (nstates,norb+ndocc+nvirt,ndets)
-    for det in dets:
-        for i in range(ndocc):
-            string+='d'
-        for o in det:
-            if o==0:
-                string+='e'
-            elif o==1:
-                string+='a'
-            elif o==2:
-                string+='b'
-            elif o==3:
-                string+='d'
-        for i in range(nvirt):
-            string+='e'
-        for c in ci_vectors[det]:
-            string+=' %16.12f ' % c
-        string+='\n'
-    return string
+    front='d'*ndocc
+    back='e'*nvirt
+    fmt=' %16.12f '*nstates+'\n'
+    string=[ '%i %i %i\n' % (nstates,norb+ndocc+nvirt,ndets) ]
+    for p,det in dets:
+        string.append(front+p.translate(DETCHARS)+back+fmt % tuple(ci_vectors[det]))
+    return ''.join(string)
 
 # ======================================================================= #
 def runWFOVERLAPS(WORKDIR,wfoverlaps,memory=100,ncpu=1):
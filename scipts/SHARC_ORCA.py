@@ -55,6 +55,15 @@ import traceback
 # parse Python literals from input
 import ast
 import struct
+# memory-mapped reading of binary files
+import mmap
+# content hashes of gbw files and QM/MM table files
+import hashlib
+# cached QM/MM topology
+import marshal
+import gc
+# list scheduling of the parallel jobs
+import heapq
 
 # =========================================================0
 # compatibility stuff
@@ -105,6 +114,9 @@ Update for Orca 4.1, after revisions:
 
 11.10.2020:
 - COBRAMM can be used for QM/MM calculations
+
+18.10.2026:
+- job wall times are recorded in the savedir (schedule_history.dat) and used to distribute the CPU cores over the jobs
 '''
 
 # ======================================================================= #
@@ -211,6 +223,20 @@ D2au=0.393430307
 au2eV=27.2113987622
 kcal_to_Eh=0.0015936011
 
+# parsed orca_fragovl outputs, keyed by the content hashes of the two gbw files (see run_fragovl)
+FRAGOVL_CACHE={}
+
+# cache file (in savedir) and format version of the geometry-independent QM/MM topology (see get_QMMM_topology)
+QMMM_TOPOLOGY_FILE='QMMM.topology'
+QMMM_TOPOLOGY_VERSION=3
+
+# file (in savedir) with the measured wall times of previous jobs and number of measurements kept per job type (see schedule_jobs)
+SCHEDULE_HISTORY_FILE='schedule_history.dat'
+SCHEDULE_HISTORY_LENGTH=20
+
+# translation table from packed determinant strings (one byte per orbital, 0:empty, 1:alpha, 2:beta, 3:docc) to the dets file notation
+DETCHARS='eabd'+''.join([ chr(i) for i in range(4,256) ])
+
 # =============================================================================================== #
 # =============================================================================================== #
 # =========================================== general routines ================================== #
@@ -894,35 +920,26 @@ def writeQMoutgrad(QMin,QMout):
 # =================================== #
 
 def writeQMoutgradcobramm(QMin,QMout):
-    '''Generates a string with the Gradient vectors in SHARC format.
+    '''Writes the point charge gradients for COBRAMM.
 
-    The string starts with a ! followed by a flag specifying the type of data. On the next line, natom and 3 are written, followed by the gradient, with one line per atom and a blank line at the end. Each MS component shows up (nmstates gradients are written).
+    The file "grad_charges" is written in the format of the Gradient vectors in SHARC format (without the leading ! line), which is read by COBRAMM.
 
     Arguments:
     1 dictionary: QMin
-    2 dictionary: QMout
-
-    Returns:
-    1 string: multiline string with the Gradient vectors'''
+    2 dictionary: QMout'''
 
     states=QMin['states']
-    nstates=QMin['nstates']
-    nmstates=QMin['nmstates']
     natom=len(QMout['pcgrad'][0])
-    string=''
-    #string+='! %i Gradient Vectors (%ix%ix3, real)\n' % (3,nmstates,natom)
+    string=[]
     i=0
     for imult,istate,ims in itnmstates(states):
-        string+='%i %i ! %i %i %i\n' % (natom,3,imult,istate,ims)
-        for atom in range(natom):
-            for xyz in range(3):
-		print((eformat(QMout['pcgrad'][i][atom][xyz],9,3)), i, atom)
-                string+='%s ' % (eformat(QMout['pcgrad'][i][atom][xyz],9,3))
-            string+='\n'
-        #string+='\n'
+        string.append('%i %i ! %i %i %i\n' % (natom,3,imult,istate,ims))
+        for g in QMout['pcgrad'][i]:
+            string.append('%s %s %s \n' % (eformat(g[0],9,3),eformat(g[1],9,3),eformat(g[2],9,3)))
         i+=1
-    string+='\n'
-    writefile("grad_charges", string)
+    string.append('\n')
+    writefile("grad_charges", ''.join(string))
+
 # ======================================================================= #
 def writeQMoutnacsmat(QMin,QMout):
     '''Generates a string with the adiabatic-diabatic transformation matrix in SHARC format.
@@ -1105,6 +1122,52 @@ def writeQMouttime(QMin,QMout):
 # =============================================================================================== #
 # =============================================================================================== #
 
+def csr_from_rows(rows):
+    '''Converts a sparse matrix given as per-row lists of (factor, column) into CSR format.
+    Entries with zero factor are dropped, the order of the entries within a row is kept.
+
+    Arguments:
+    1 list of lists of (float,int): matrix rows
+
+    Returns:
+    1 tuple of lists: (indptr, indices, data), row i holds data[indptr[i]:indptr[i+1]] in columns indices[indptr[i]:indptr[i+1]]'''
+
+    indptr=[0]
+    indices=[]
+    data=[]
+    for row in rows:
+        for factor,icol in row:
+            if factor!=0.:
+                indices.append(icol)
+                data.append(factor)
+        indptr.append(len(indices))
+    return (indptr,indices,data)
+
+# ======================================================================= #
+
+def csr_matvec(matrix,vector):
+    '''Sparse matrix-vector product for a matrix in CSR format (see csr_from_rows).
+
+    Arguments:
+    1 tuple of lists: (indptr, indices, data)
+    2 list of float: vector
+
+    Returns:
+    1 list of float: matrix*vector'''
+
+    indptr,indices,data=matrix
+    result=[]
+    start=0
+    for end in indptr[1:]:
+        s=0.
+        for k in xrange(start,end):
+            s+=data[k]*vector[indices[k]]
+        result.append(s)
+        start=end
+    return result
+
+# ======================================================================= #
+
 def prepare_QMMM(QMin,table_file):
     ''' creates dictionary with:
     MM coordinates (including connectivity and atom types)
@@ -1115,14 +1178,107 @@ def prepare_QMMM(QMin,table_file):
     is only allowed to read the following keys from QMin:
     geo
     natom
+    savedir
     QM/MM related infos from template
+
+    the geometry-independent topology is taken from get_QMMM_topology
     '''
 
+    print '===== Running QM/MM preparation ===='
+    QMMM=get_QMMM_topology(QMin,table_file)
+
+
+    # check geometry and connection table
+    if not QMMM['natom_table']==QMin['natom']:
+        print 'Number of atoms in table file does not match number of atoms in QMin!'
+        sys.exit(19)
+
+
+    # link atom positions
+    for link in QMMM['linkbonds']:
+        link['atom']=[ link['element'], 0.,0.,0.]
+        for xyz in range(3):
+            link['atom'][xyz+1]+=link['scaling']['mm'] * QMin['geo'][link['mm']][xyz+1]
+            link['atom'][xyz+1]+=link['scaling']['qm'] * QMin['geo'][link['qm']][xyz+1]
+
+
+    # process MM geometry (and convert to angstrom!)
+    QMMM['MM_coords']=[]
+    for atom in QMin['geo']:
+        QMMM['MM_coords'].append( [atom[0]]+[i*au2a for i in atom[1:4]] )
+    for ilink,link in enumerate(QMMM['linkbonds']):
+        QMMM['MM_coords'].append(['HLA']+link['atom'][1:4])
+
+
+    # process QM geometry (including link atoms), QM coords in bohr!
+    QMMM['QM_coords']=[]
+    for iatom in QMMM['QM_atoms']:
+        QMMM['QM_coords'].append( deepcopy(QMin['geo'][iatom]) )
+    for link in QMMM['linkbonds']:
+        QMMM['QM_coords'].append(link['atom'])
+
+    #pprint.pprint(QMMM)
+    return QMMM
+
+# ======================================================================= #
+
+def get_QMMM_topology(QMin,table_file):
+    '''Returns the geometry-independent part of the QM/MM setup (see build_QMMM_topology).
+
+    The topology only depends on the table file, hence it is stored in QMMM_TOPOLOGY_FILE in savedir
+    together with the hash of the table file and only rebuilt if the table file changes.
+    The file is written with marshal, which only contains builtin types and loads several times faster than a pickle
+    (the garbage collector is switched off while loading the many small containers).
+
+    Arguments:
+    1 dict: QMin (only savedir is used)
+    2 string: path to the table file
+
+    Returns:
+    1 dict: QMMM topology'''
+
+    key=(QMMM_TOPOLOGY_VERSION,sys.version,hashfile(table_file))
+    cachefile=os.path.join(QMin['savedir'],QMMM_TOPOLOGY_FILE)
+    if os.path.isfile(cachefile):
+        gc.disable()
+        try:
+            f=open(cachefile,'rb')
+            cachekey,QMMM=marshal.load(f)
+            f.close()
+            if cachekey==key:
+                print 'Reading cached topology ...    ',datetime.datetime.now()
+                return QMMM
+        except Exception:
+            print 'Could not read cached QM/MM topology %s, rebuilding it.' % (cachefile)
+        finally:
+            gc.enable()
+
+    QMMM=build_QMMM_topology(table_file)
+    try:
+        f=open(cachefile+'.tmp','wb')
+        marshal.dump((key,QMMM),f)
+        f.close()
+        os.rename(cachefile+'.tmp',cachefile)
+    except (IOError,OSError):
+        print 'Could not write cached QM/MM topology %s!' % (cachefile)
+    return QMMM
+
+# ======================================================================= #
+
+def build_QMMM_topology(table_file):
+    '''Builds the geometry-independent part of the QM/MM setup from the connection table file:
+    atom types and connectivity, bonds, link bonds, reorder arrays and the point charge redistribution matrix.
+
+    Arguments:
+    1 string: path to the table file
+
+    Returns:
+    1 dict: QMMM topology (see prepare_QMMM)'''
+
     table=readfile(table_file)
 
 
     # read table file
-    print '===== Running QM/MM preparation ===='
     print 'Reading table file ...         ',datetime.datetime.now()
     QMMM={}
     QMMM['qmmmtype']=[]
@@ -1179,10 +1335,6 @@ def prepare_QMMM(QMin,table_file):
                 link['mm']=i
             link['scaling']={'qm':0.3,'mm':0.7}
             link['element']='H'
-            link['atom']=[ link['element'], 0.,0.,0.]
-            for xyz in range(3):
-                link['atom'][xyz+1]+=link['scaling']['mm'] * QMin['geo'][link['mm']][xyz+1]
-                link['atom'][xyz+1]+=link['scaling']['qm'] * QMin['geo'][link['qm']][xyz+1]
             QMMM['linkbonds'].append( link )
             QMMM['LI_atoms'].append( QMMM['natom_table']-1+len(QMMM['linkbonds']) )
             QMMM['atomtype'].append('999')
@@ -1214,20 +1366,6 @@ def prepare_QMMM(QMin,table_file):
         sys.exit(18)
 
 
-    # check geometry and connection table
-    if not QMMM['natom_table']==QMin['natom']:
-        print 'Number of atoms in table file does not match number of atoms in QMin!'
-        sys.exit(19)
-
-
-    # process MM geometry (and convert to angstrom!)
-    QMMM['MM_coords']=[]
-    for atom in QMin['geo']:
-        QMMM['MM_coords'].append( [atom[0]]+[i*au2a for i in atom[1:4]] )
-    for ilink,link in enumerate(QMMM['linkbonds']):
-        QMMM['MM_coords'].append(['HLA']+link['atom'][1:4])
-
-
     # create reordering dicts
     print 'Creating reorder mappings ...  ',datetime.datetime.now()
     QMMM['reorder_input_MM']={}
@@ -1247,20 +1385,26 @@ def prepare_QMMM(QMin,table_file):
     for i in QMMM['reorder_MM_input']:
         QMMM['reorder_input_MM'][QMMM['reorder_MM_input'][i]]=i
 
+    # atom type and connectivity columns of TINKER.xyz (in MM ordering), only the coordinates change between steps
+    QMMM['tinker_xyz_tail']=[]
+    for iatom_MM in range(len(QMMM['reorder_MM_input'])):
+        iatom_input=QMMM['reorder_MM_input'][iatom_MM]
+        QMMM['tinker_xyz_tail'].append( '  %4s  %s\n' % (
+                QMMM['atomtype'][iatom_input],
+                ' '.join( [ str(QMMM['reorder_input_MM'][i]+1) for i in sorted(QMMM['connect'][iatom_input]) ] )
+                ) )
 
-    # process QM geometry (including link atoms), QM coords in bohr!
-    QMMM['QM_coords']=[]
+
+    # QM ordering (QM atoms, then link atoms)
     QMMM['reorder_input_QM']={}
     QMMM['reorder_QM_input']={}
     j=-1
     for iatom in range(QMMM['natom_table']):
         if QMMM['qmmmtype'][iatom]=='qm':
-            QMMM['QM_coords'].append( deepcopy(QMin['geo'][iatom]) )
             j+=1
             QMMM['reorder_input_QM'][iatom]=j
             QMMM['reorder_QM_input'][j]=iatom
     for ilink,link in enumerate(QMMM['linkbonds']):
-        QMMM['QM_coords'].append(link['atom'])
         j+=1
         QMMM['reorder_input_QM'][-(ilink+1)]=j
         QMMM['reorder_QM_input'][j]=-(ilink+1)
@@ -1268,16 +1412,19 @@ def prepare_QMMM(QMin,table_file):
 
     # process charge redistribution around link bonds
     # point charges are in input geometry ordering
+    # the charge of an MM link atom is moved to its MM neighbors, QM charges are removed
+    # charge_matrix maps the raw MM charges to the redistributed charges (see csr_matvec)
     print 'Charge redistribution ...      ',datetime.datetime.now()
-    QMMM['charge_distr']=[]
+    mm_in_links_set=set(mm_in_links)
+    charge_distr=[]
     for iatom in range(QMMM['natom_table']):
         if QMMM['qmmmtype'][iatom]=='qm':
-            QMMM['charge_distr'].append( [(0.,0)] )
+            charge_distr.append( [(0.,0)] )
         elif QMMM['qmmmtype'][iatom]=='mm':
-            if iatom in mm_in_links:
-                QMMM['charge_distr'].append( [(0.,0)] )
+            if iatom in mm_in_links_set:
+                charge_distr.append( [(0.,0)] )
             else:
-                QMMM['charge_distr'].append( [(1.,iatom)] )
+                charge_distr.append( [(1.,iatom)] )
     for link in QMMM['linkbonds']:
         mm_neighbors=[]
         for j in QMMM['connect'][link['mm']]:
@@ -1287,9 +1434,9 @@ def prepare_QMMM(QMin,table_file):
             factor=1./len(mm_neighbors)
             for j in QMMM['connect'][link['mm']]:
                 if QMMM['qmmmtype'][j]=='mm':
-                    QMMM['charge_distr'][j].append( (factor,link['mm']) )
+                    charge_distr[j].append( (factor,link['mm']) )
+    QMMM['charge_matrix']=csr_from_rows(charge_distr)
 
-    #pprint.pprint(QMMM)
     return QMMM
 
 # ======================================================================= #
@@ -1355,30 +1502,22 @@ def execute_tinker(QMin,ff_file_path):
     writefile(filename,string)
 
 
-    # xyz/type/connection file
-    string='%i\n' % (len(QMMM['MM_coords']))
-    for iatom_MM in range(len(QMMM['MM_coords'])):
-        iatom_input=QMMM['reorder_MM_input'][iatom_MM]
-        string+='% 5i  %3s  % 16.12f % 16.12f % 16.12f  %4s  %s\n' % (
-                iatom_MM+1,
-                QMMM['MM_coords'][iatom_input][0],
-                QMMM['MM_coords'][iatom_input][1],
-                QMMM['MM_coords'][iatom_input][2],
-                QMMM['MM_coords'][iatom_input][3],
-                QMMM['atomtype'][iatom_input],
-                ' '.join( [ str(QMMM['reorder_input_MM'][i]+1) for i in sorted(QMMM['connect'][iatom_input]) ] )
-                )
+    # xyz/type/connection file (type and connection columns are precomputed in the topology)
+    MM_coords=[ QMMM['MM_coords'][QMMM['reorder_MM_input'][iatom_MM]] for iatom_MM in range(len(QMMM['MM_coords'])) ]
+    string=['%i\n' % (len(QMMM['MM_coords']))]
+    for iatom_MM,atom in enumerate(MM_coords):
+        string.append( '% 5i  %3s  % 16.12f % 16.12f % 16.12f' % (iatom_MM+1,atom[0],atom[1],atom[2],atom[3]) )
+        string.append( QMMM['tinker_xyz_tail'][iatom_MM] )
     filename=os.path.join(WORKDIR,'TINKER.xyz')
-    writefile(filename,string)
+    writefile(filename,''.join(string))
 
 
     # communication file
-    string='SHARC 0 -1\n'
-    for iatom_MM in range(len(QMMM['MM_coords'])):
-        iatom_input=QMMM['reorder_MM_input'][iatom_MM]
-        string+='% 16.12f % 16.12f % 16.12f\n' % tuple( QMMM['MM_coords'][iatom_input][1:4] )
+    string=['SHARC 0 -1\n']
+    for atom in MM_coords:
+        string.append( '% 16.12f % 16.12f % 16.12f\n' % tuple( atom[1:4] ) )
     filename=os.path.join(WORKDIR,'TINKER.qmmm')
-    writefile(filename,string)
+    writefile(filename,''.join(string))
 
 
     # standard input file
@@ -1404,61 +1543,23 @@ def execute_tinker(QMin,ff_file_path):
     print 'Searching MMEnergy ...         ',datetime.datetime.now()
     QMMM['MMEnergy']=float(output[1].split()[-1])*kcal_to_Eh
 
-    # get MM gradient (convert from kcal/mole/A to Eh/bohr)
-    print 'Searching MMGradient ...       ',datetime.datetime.now()
-    QMMM['MMGradient']={}
-    for line in output:
-        if 'MMGradient' in line:
-            s=line.split()
-            iatom_MM=int(s[1])-1
-            iatom_input=QMMM['reorder_MM_input'][iatom_MM]
-            grad=[ float(i)*kcal_to_Eh*au2a for i in s[2:5] ]
-            QMMM['MMGradient'][iatom_input]=grad
-        if 'MMq' in line:
-          break
-
-    # get MM point charges
-    print 'Searching MMpc_raw ...         ',datetime.datetime.now()
-    QMMM['MMpc_raw']={}
-    for i in range(QMMM['natom_table']):
-        QMMM['MMpc_raw'][i]=0.
-    iline=0
-    while True:
-        iline+=1
-        line=output[iline]
-        if 'MMq' in line:
-            break
-    iatom_MM=len(QMMM['QM_atoms'])+len(QMMM['LI_atoms'])-1
-    while True:
-        iline+=1
-        iatom_MM+=1
-        line=output[iline]
-        if 'NMM' in line:
-            break
-        s=line.split()
-        q=float(s[-1])
-        QMMM['MMpc_raw'][QMMM['reorder_MM_input'][iatom_MM]]=q
+    # get MM gradient (convert from kcal/mole/A to Eh/bohr) and MM point charges
+    print 'Searching MMGradient, MMq ...  ',datetime.datetime.now()
+    QMMM['MMGradient'],QMMM['MMpc_raw']=parse_tinker_qmmm(output,QMMM)
 
     # compute actual charges (including redistribution)
     print 'Redistributing charges ...     ',datetime.datetime.now()
-    QMMM['MMpc']={}
-    for i in range(QMMM['natom_table']):
-        s=0.
-        for factor,iatom in QMMM['charge_distr'][i]:
-            s+=factor * QMMM['MMpc_raw'][iatom]
-        QMMM['MMpc'][i]=s
+    QMMM['MMpc']=csr_matvec(QMMM['charge_matrix'],QMMM['MMpc_raw'])
 
     # make list of pointcharges without QM atoms
     print 'Finalizing charges ...         ',datetime.datetime.now()
     QMMM['pointcharges']=[]
     QMMM['reorder_pc_input']={}
-    ipc=0
-    for iatom_input in QMMM['MM_atoms']:
+    for ipc,iatom_input in enumerate(QMMM['MM_atoms']):
         atom=QMMM['MM_coords'][iatom_input]
         q=QMMM['MMpc'][iatom_input]
         QMMM['pointcharges'].append( atom[1:4]+[q] )
-        QMMM['reorder_pc_input'][ipc]=iatom
-        ipc+=1
+        QMMM['reorder_pc_input'][ipc]=iatom_input
 
 
 
@@ -1510,6 +1611,44 @@ def execute_tinker(QMin,ff_file_path):
     #sys.exit(21)
     return QMMM
 
+# ======================================================================= #
+def parse_tinker_qmmm(output,QMMM):
+    '''Reads the MM gradient and the raw MM point charges from TINKER.qmmm in a single pass.
+
+    The "MMGradient" lines are followed by the "MMq" line,
+    after which there is one charge line per MM atom (in MM ordering, after the QM and link atoms) until the "NMM" line.
+    The garbage collector is paused while the many small gradient lists are created.
+
+    Arguments:
+    1 list of strings: content of TINKER.qmmm
+    2 dict: QMMM
+
+    Returns:
+    1 dict: MM gradient in Eh/bohr (input ordering)
+    2 list of float: raw MM point charges (input ordering)'''
+
+    reorder=QMMM['reorder_MM_input']
+    gradient={}
+    charges=[ 0. for i in range(QMMM['natom_table']) ]
+    lines=iter(output)
+    gc.disable()
+    try:
+        for line in lines:
+            if 'MMGradient' in line:
+                s=line.split()
+                gradient[reorder[int(s[1])-1]]=[ float(i)*kcal_to_Eh*au2a for i in s[2:5] ]
+            if 'MMq' in line:
+                break
+        iatom_MM=len(QMMM['QM_atoms'])+len(QMMM['LI_atoms'])
+        for line in lines:
+            if 'NMM' in line:
+                break
+            charges[reorder[iatom_MM]]=float(line.split()[-1])
+            iatom_MM+=1
+    finally:
+        gc.enable()
+    return gradient,charges
+
 # ======================================================================= #
 def coords_same(coord1,coord2):
     thres=1e-5
@@ -1524,20 +1663,24 @@ def coords_same(coord1,coord2):
 def runTINKER(WORKDIR,tinker,savedir,strip=False,ncpu=1):
     prevdir=os.getcwd()
     os.chdir(WORKDIR)
+    # tkr2qm_s is started directly (no shell), with TINKER.in as standard input
     string=os.path.join(tinker,'bin','tkr2qm_s')+' '
     string+=' < TINKER.in'
+    command=[os.path.join(tinker,'bin','tkr2qm_s')]
     os.environ['OMP_NUM_THREADS']=str(ncpu)
     if PRINT or DEBUG:
         starttime=datetime.datetime.now()
         sys.stdout.write('START:\t%s\t%s\t"%s"\n' % (shorten_DIR(WORKDIR),starttime,shorten_DIR(string)))
         sys.stdout.flush()
+    stdinfile=open(os.path.join(WORKDIR,'TINKER.in'))
     stdoutfile=open(os.path.join(WORKDIR,'TINKER.out'),'w')
     stderrfile=open(os.path.join(WORKDIR,'TINKER.err'),'w')
     try:
-        runerror=sp.call(string,shell=True,stdout=stdoutfile,stderr=stderrfile)
+        runerror=sp.call(command,stdin=stdinfile,stdout=stdoutfile,stderr=stderrfile)
     except OSError:
         print 'Call have had some serious problems:',OSError
         sys.exit(22)
+    stdinfile.close()
     stdoutfile.close()
     stderrfile.close()
     if PRINT or DEBUG:
@@ -1574,31 +1717,48 @@ def transform_QM_QMMM(QMin,QMout):
     if 'grad' in QMout:
         nmstates=QMin['nmstates']
         natom=QMin['natom_orig']
-        grad=[ [ [ 0. for i in range(3) ] for j in range(natom) ] for k in range(nmstates) ]
-        # QM gradient
-        for iqm in QMin['qmmm']['reorder_QM_input']:
-            iqmmm=QMin['qmmm']['reorder_QM_input'][iqm]
+        QMMM=QMin['qmmm']
+        # index arrays for the scatter-add of the QM gradient:
+        # QM atoms (QM ordering -> input ordering) and link atoms (QM ordering -> QM and MM atom, scaling)
+        # the order of the additions is the same as in the element-wise loops before
+        direct=[]
+        links=[]
+        for iqm in sorted(QMMM['reorder_QM_input']):
+            iqmmm=QMMM['reorder_QM_input'][iqm]
             if iqmmm<0:
-                ilink=-iqmmm-1
-                link=QMin['qmmm']['linkbonds'][ilink]
-                for istate in range(nmstates):
-                    for ixyz in range(3):
-                        grad[istate][link['qm']][ixyz]+=QMout['grad'][istate][iqm][ixyz]*link['scaling']['qm']
-                        grad[istate][link['mm']][ixyz]+=QMout['grad'][istate][iqm][ixyz]*link['scaling']['mm']
+                link=QMMM['linkbonds'][-iqmmm-1]
+                links.append( (iqm,link['qm'],link['mm'],link['scaling']['qm'],link['scaling']['mm']) )
             else:
-                for istate in range(nmstates):
-                    for ixyz in range(3):
-                        grad[istate][iqmmm][ixyz]+=QMout['grad'][istate][iqm][ixyz]
-        # PC gradient
-        for iqm,iqmmm in enumerate(QMin['qmmm']['MM_atoms']):
-            for istate in range(nmstates):
-                for ixyz in range(3):
-                    grad[istate][iqmmm][ixyz]+=QMout['pcgrad'][istate][iqm][ixyz]
-        # MM gradient
-        for iqmmm in range(QMin['qmmm']['natom_table']):
-            for istate in range(nmstates):
-                for ixyz in range(3):
-                    grad[istate][iqmmm][ixyz]+=QMin['qmmm']['MMGradient'][iqmmm][ixyz]
+                direct.append( (iqm,iqmmm) )
+        mmgrad=[ QMMM['MMGradient'][iqmmm] for iqmmm in range(QMMM['natom_table']) ]
+        # index array for the point charge gradient (input ordering -> point charge, -1 if the atom is no point charge)
+        pcindex=[ -1 for j in range(natom) ]
+        for ipc,iqmmm in enumerate(QMMM['MM_atoms']):
+            pcindex[iqmmm]=ipc
+        zero=[ 0. for i in range(3) ]
+        grad=[]
+        for istate in range(nmstates):
+            # rows are replaced, never modified in place, so they can share the zero row
+            g=[ zero for j in range(natom) ]
+            # QM gradient
+            qmgrad=QMout['grad'][istate]
+            for iqm,iqmmm in direct:
+                a=g[iqmmm]
+                b=qmgrad[iqm]
+                g[iqmmm]=[ a[0]+b[0], a[1]+b[1], a[2]+b[2] ]
+            for iqm,iq,im,sq,sm in links:
+                b=qmgrad[iqm]
+                a=g[iq]
+                g[iq]=[ a[0]+b[0]*sq, a[1]+b[1]*sq, a[2]+b[2]*sq ]
+                a=g[im]
+                g[im]=[ a[0]+b[0]*sm, a[1]+b[1]*sm, a[2]+b[2]*sm ]
+            # PC gradient and MM gradient in one pass
+            pcgrad=QMout['pcgrad'][istate]
+            pcrows=[ pcgrad[ipc] if ipc>=0 else None for ipc in pcindex ]
+            g=[ [ a[0]+p[0]+m[0], a[1]+p[1]+m[1], a[2]+p[2]+m[2] ] if p is not None else
+                [ a[0]+m[0], a[1]+m[1], a[2]+m[2] ]
+                for a,p,m in zip(g,pcrows,mmgrad) ]
+            grad.append(g)
         QMout['grad']=grad
     
     #pprint.pprint(QMout)
@@ -2616,46 +2776,188 @@ def readQMin(QMinfilename):
 # =============================================================================================== #
 # =============================================================================================== #
 
-def parallel_speedup(N,scaling):
-    # computes the parallel speedup from Amdahls law
-    # with scaling being the fraction of parallelizable work and (1-scaling) being the serial part
-    return 1./((1-scaling)+scaling/N)
-
-def divide_slots(ncpu,ntasks,scaling):
-    # this routine figures out the optimal distribution of the tasks over the CPU cores
-    #   returns the number of rounds (how many jobs each CPU core will contribute to),
-    #   the number of slots which should be set in the Pool,
-    #   and the number of cores for each job.
-    minpar=1
-    ntasks_per_round=ncpu/minpar
-    if ncpu==1:
-        ntasks_per_round=1
-    ntasks_per_round=min(ntasks_per_round,ntasks)
-    optimal={}
-    for i in range(1,1+ntasks_per_round):
-        nrounds=int(math.ceil(float(ntasks)/i))
-        ncores=ncpu/i
-        optimal[i]=nrounds/parallel_speedup(ncores,scaling)
-    #print optimal
-    best=min(optimal,key=optimal.get)
-    nrounds=int(math.ceil(float(ntasks)/best))
-    ncores=ncpu/best
-
-    cpu_per_run=[0 for i in range(ntasks)]
-    if nrounds==1:
-        itask=0
-        for icpu in range(ncpu):
-            cpu_per_run[itask]+=1
-            itask+=1
-            if itask>=ntasks:
-                itask=0
-        nslots=ntasks
+# job scheduling from measured wall times (read_schedule_history ... report_schedule)
+# these routines are identical copies in SHARC_ORCA.py and SHARC_MOLCAS.py, keep both files in sync
+
+def read_schedule_history(savedir):
+    '''Reads the measured wall times of previous jobs from SCHEDULE_HISTORY_FILE in savedir.
+
+    Arguments:
+    1 string: path to savedir
+
+    Returns:
+    1 dict: job type -> list of (ncpu, wall time in s), oldest first'''
+
+    history={}
+    filename=os.path.join(savedir,SCHEDULE_HISTORY_FILE)
+    if not os.path.isfile(filename):
+        return history
+    for line in readfile(filename):
+        s=line.split()
+        if len(s)!=3 or s[0].startswith('#'):
+            continue
+        try:
+            history.setdefault(s[0],[]).append( (int(s[1]),float(s[2])) )
+        except ValueError:
+            continue
+    return history
+
+def write_schedule_history(savedir,history):
+    '''Writes the job timing history to SCHEDULE_HISTORY_FILE in savedir,
+    keeping only the last SCHEDULE_HISTORY_LENGTH measurements per job type.
+
+    Arguments:
+    1 string: path to savedir
+    2 dict: job type -> list of (ncpu, wall time in s)'''
+
+    string='# job type, ncpu, wall time (s)\n'
+    for jobtype in sorted(history):
+        for ncpu,walltime in history[jobtype][-SCHEDULE_HISTORY_LENGTH:]:
+            string+='%-20s %4i %14.3f\n' % (jobtype,ncpu,walltime)
+    writefile(os.path.join(savedir,SCHEDULE_HISTORY_FILE),string)
+
+def job_type(job):
+    '''Job type for the cost model: master jobs are distinguished by their name,
+    all other jobs only by the prefix of the job name (e.g., all gradient jobs share one type).'''
+    if job.startswith('master'):
+        return job
+    return job.split('_')[0]
+
+def fit_job_cost(records,scaling):
+    '''Fits the wall time model t(n) = a + b/n (serial part a, parallelizable part b) to measured wall times.
+
+    If the measurements do not determine a and b (only one core count, or an unphysical fit),
+    the split into a and b is taken from scaling, as in Amdahl's law.
+
+    Arguments:
+    1 list of (integer, float): measured (ncpu, wall time)
+    2 float: fraction of parallelizable work
+
+    Returns:
+    1 tuple of float: (a, b)'''
+
+    records=records[-SCHEDULE_HISTORY_LENGTH:]
+    m=len(records)
+    xs=[ 1./n for n,t in records ]
+    ts=[ t for n,t in records ]
+    mx=sum(xs)/m
+    mt=sum(ts)/m
+    sxx=sum( [ (x-mx)**2 for x in xs ] )
+    if sxx>1e-10:
+        b=sum( [ (x-mx)*(t-mt) for x,t in zip(xs,ts) ] )/sxx
+        a=mt-b*mx
+        if a>=0. and b>=0.:
+            return (a,b)
+    t1=sum( [ t/((1.-scaling)+scaling*x) for x,t in zip(xs,ts) ] )/m
+    return ((1.-scaling)*t1,scaling*t1)
+
+def lpt_makespan(times,nslots):
+    # makespan of a list of jobs that are started in the given order on the first free slot
+    slots=[0. for i in range(nslots)]
+    for t in times:
+        heapq.heapreplace(slots,slots[0]+t)
+    return max(slots)
+
+def schedule_jobs(ncpu,jobs,history,scaling,mincpu=1,maxcpu=None):
+    '''Distributes the CPU cores over a set of jobs which can run concurrently.
+
+    The wall time of each job is predicted from the cost model of its job type (see fit_job_cost).
+    Job types without history get the average single-core cost of the known types (or unit cost).
+    Two kinds of schedules are compared:
+    - all jobs at once, each extra core is given to the job with the longest predicted time
+    - k slots with ncpu/k cores each, the jobs being submitted longest first (LPT list scheduling, as done by the Pool)
+    The schedule with the shortest predicted makespan is used.
+
+    Arguments:
+    1 integer: number of CPU cores
+    2 list of strings: job names
+    3 dict: job timing history (see read_schedule_history)
+    4 float: fraction of parallelizable work, used for job types without sufficient history
+    5 integer: minimum number of cores per job
+    6 integer: maximum number of cores per job
+
+    Returns:
+    1 integer: number of slots for the Pool
+    2 dict: job name -> number of cores
+    3 list of strings: order of submission
+    4 float: predicted makespan in seconds (None if not all job types have a history)'''
+
+    if maxcpu==None:
+        maxcpu=ncpu
+    maxcpu=min(maxcpu,ncpu)
+    mincpu=min(mincpu,maxcpu)
+    ntasks=len(jobs)
+    if ntasks==0:
+        return 1,{},[],None
+
+    # cost models
+    costs={}
+    for job in jobs:
+        jobtype=job_type(job)
+        if jobtype in history and history[jobtype]:
+            costs[job]=fit_job_cost(history[jobtype],scaling)
+    known=[ a+b for a,b in costs.values() ]
+    if known:
+        t1=sum(known)/len(known)
     else:
-        for itask in range(ntasks):
-            cpu_per_run[itask]=ncores
-        nslots=ncpu/ncores
-    #print nrounds,nslots,cpu_per_run
-    return nrounds,nslots,cpu_per_run
+        t1=1.
+    for job in jobs:
+        if not job in costs:
+            costs[job]=((1.-scaling)*t1,scaling*t1)
+    def walltime(job,n):
+        return costs[job][0]+costs[job][1]/n
+
+    # longest jobs first
+    order=[ job for t,i,job in sorted( [ (-walltime(job,1),i,job) for i,job in enumerate(jobs) ] ) ]
+
+    best=None
+    for k in range(1,min(ntasks,ncpu/mincpu)+1):
+        if k<ntasks:
+            # k slots with equal number of cores
+            n=min(ncpu/k,maxcpu)
+            cpu_per_run=dict( [ (job,n) for job in jobs ] )
+            makespan=lpt_makespan([ walltime(job,n) for job in order ],k)
+        else:
+            # all jobs at once, give the cores one by one to the currently slowest job (of those, the one with fewest cores)
+            cpu_per_run=dict( [ (job,mincpu) for job in jobs ] )
+            for icpu in range(ncpu-mincpu*ntasks):
+                candidates=[ job for job in order if cpu_per_run[job]<maxcpu ]
+                if not candidates:
+                    break
+                slowest=max(candidates,key=lambda job: (walltime(job,cpu_per_run[job]),-cpu_per_run[job]))
+                cpu_per_run[slowest]+=1
+            makespan=max( [ walltime(job,cpu_per_run[job]) for job in jobs ] )
+        # makespans which only differ by rounding are equal, then prefer more cores per job and then more slots
+        tie=(-min(cpu_per_run.values()),-k)
+        if best==None or makespan<best[4]*(1.-1e-9) or (makespan<=best[4]*(1.+1e-9) and tie<best[0]):
+            best=(tie,k,cpu_per_run,order,makespan)
+
+    tie,nslots,cpu_per_run,order,makespan=best
+    if not all( [ job_type(job) in history and history[job_type(job)] for job in jobs ] ):
+        makespan=None
+    return nslots,cpu_per_run,order,makespan
+
+def report_schedule(QMin,ijobset,ncpus,walltimes,errorcodes,makespan):
+    '''Prints predicted versus actual makespan of a job set and adds the measured wall times to the job timing history.
+
+    Arguments:
+    1 dict: QMin
+    2 integer: index of the job set
+    3 dict: job name -> number of cores of the job
+    4 dict: job name -> measured wall time in s
+    5 dict: job name -> error code
+    6 float: measured makespan in s'''
+
+    predicted=QMin['schedule_makespan'][ijobset]
+    if predicted==None:
+        print 'Job set %i: makespan %.1f s (no timing history for the prediction yet)' % (ijobset+1,makespan)
+    else:
+        print 'Job set %i: makespan %.1f s, predicted %.1f s' % (ijobset+1,makespan,predicted)
+    history=read_schedule_history(QMin['savedir'])
+    for job in ncpus:
+        if errorcodes[job]==0:
+            history.setdefault(job_type(job),[]).append( (ncpus[job],walltimes[job]) )
+    write_schedule_history(QMin['savedir'],history)
 
 # =============================================================================================== #
 
@@ -2707,61 +3009,56 @@ def generate_joblist(QMin):
 
     schedule=[]
     QMin['nslots_pool']=[]
+    QMin['schedule_order']=[]
+    QMin['schedule_makespan']=[]
+    history=read_schedule_history(QMin['savedir'])
 
     # add the master calculations
-    ntasks=0
-    for i in gradjob:
-        if 'master' in i:
-            ntasks+=1
-    nrounds,nslots,cpu_per_run=divide_slots(QMin['ncpu'],ntasks,QMin['schedule_scaling'])
+    jobs=[ i for i in sorted(gradjob) if 'master' in i ]
+    nslots,cpu_per_run,order,makespan=schedule_jobs(QMin['ncpu'],jobs,history,QMin['schedule_scaling'])
     QMin['nslots_pool'].append(nslots)
+    QMin['schedule_order'].append(order)
+    QMin['schedule_makespan'].append(makespan)
     schedule.append({})
-    icount=0
-    for i in sorted(gradjob):
-        if 'master' in i:
+    for i in jobs:
+        QMin1=deepcopy(QMin)
+        QMin1['master']=True
+        QMin1['IJOB']=int(i.split('_')[1])
+        remove=['gradmap','ncpu']
+        for r in remove:
+            QMin1=removekey(QMin1,r)
+        QMin1['gradmap']=list(gradjob[i])
+        QMin1['ncpu']=cpu_per_run[i]
+        if QMin['OrcaVersion']<(4,1):
+          if 3 in QMin['multmap'][-QMin1['IJOB']] and QMin['jobs'][QMin1['IJOB']]['restr']:
+            QMin1['states'][0]=1
+            QMin1['states_to_do'][0]=1
+        if QMin1['qmmm']:
+          QMin1['qmmm']=True
+        schedule[-1][i]=QMin1
+
+    # add the gradient calculations
+    jobs=[ i for i in sorted(gradjob) if 'grad' in i ]
+    if len(jobs)>0:
+        nslots,cpu_per_run,order,makespan=schedule_jobs(QMin['ncpu'],jobs,history,QMin['schedule_scaling'])
+        QMin['nslots_pool'].append(nslots)
+        QMin['schedule_order'].append(order)
+        QMin['schedule_makespan'].append(makespan)
+        schedule.append({})
+        for i in jobs:
             QMin1=deepcopy(QMin)
-            QMin1['master']=True
-            QMin1['IJOB']=int(i.split('_')[1])
-            remove=['gradmap','ncpu']
+            mult=list(gradjob[i])[0][0]
+            QMin1['IJOB']=QMin['multmap'][mult]
+            remove=['gradmap','ncpu','h','soc','dm','overlap','ion','always_guess','always_orb_init','init']
             for r in remove:
                 QMin1=removekey(QMin1,r)
             QMin1['gradmap']=list(gradjob[i])
-            QMin1['ncpu']=cpu_per_run[icount]
-            if QMin['OrcaVersion']<(4,1):
-              if 3 in QMin['multmap'][-QMin1['IJOB']] and QMin['jobs'][QMin1['IJOB']]['restr']:
-                QMin1['states'][0]=1
-                QMin1['states_to_do'][0]=1
+            QMin1['ncpu']=cpu_per_run[i]
+            QMin1['gradonly']=[]
             if QMin1['qmmm']:
               QMin1['qmmm']=True
-            icount+=1
             schedule[-1][i]=QMin1
 
-    # add the gradient calculations
-    ntasks=0
-    for i in gradjob:
-        if 'grad' in i:
-            ntasks+=1
-    if ntasks>0:
-        nrounds,nslots,cpu_per_run=divide_slots(QMin['ncpu'],ntasks,QMin['schedule_scaling'])
-        QMin['nslots_pool'].append(nslots)
-        schedule.append({})
-        icount=0
-        for i in gradjob:
-            if 'grad' in i:
-                QMin1=deepcopy(QMin)
-                mult=list(gradjob[i])[0][0]
-                QMin1['IJOB']=QMin['multmap'][mult]
-                remove=['gradmap','ncpu','h','soc','dm','overlap','ion','always_guess','always_orb_init','init']
-                for r in remove:
-                    QMin1=removekey(QMin1,r)
-                QMin1['gradmap']=list(gradjob[i])
-                QMin1['ncpu']=cpu_per_run[icount]
-                QMin1['gradonly']=[]
-                if QMin1['qmmm']:
-                  QMin1['qmmm']=True
-                icount+=1
-                schedule[-1][i]=QMin1
-
     return QMin,schedule
 
 
@@ -2783,17 +3080,27 @@ def runjobs(schedule,QMin):
         if not jobset:
             continue
         pool = Pool(processes=QMin['nslots_pool'][ijobset])
-        for job in jobset:
+        results={}
+        starttime=time.time()
+        # submit the longest jobs first, the Pool then starts each job on the next free slot
+        for job in QMin['schedule_order'][ijobset]:
             QMin1=jobset[job]
             WORKDIR=os.path.join(QMin['scratchdir'],job)
 
-            errorcodes[job]=pool.apply_async(run_calc , [WORKDIR,QMin1])
+            results[job]=pool.apply_async(run_calc_timed , [WORKDIR,QMin1])
             time.sleep(QMin['delay'])
         pool.close()
         pool.join()
+        makespan=time.time()-starttime
+
+        walltimes={}
+        ncpus={}
+        for job in results:
+            errorcodes[job],walltimes[job]=results[job].get()
+            ncpus[job]=jobset[job]['ncpu']
+        report_schedule(QMin,ijobset,ncpus,walltimes,errorcodes,makespan)
+    print
 
-    for i in errorcodes:
-        errorcodes[i]=errorcodes[i].get()
     j=0
     string='Error Codes:\n'
     for i in errorcodes:
@@ -2848,6 +3155,13 @@ def run_calc(WORKDIR,QMin):
 
     return err
 
+# ======================================================================= #
+def run_calc_timed(WORKDIR,QMin):
+    # runs run_calc and returns the error code and the wall time of the job in seconds
+    starttime=time.time()
+    err=run_calc(WORKDIR,QMin)
+    return err,time.time()-starttime
+
 # ======================================================================= #
 def setupWORKDIR(WORKDIR,QMin):
     # mkdir the WORKDIR, or clean it if it exists, then copy all necessary files from pwd and savedir
@@ -3336,71 +3650,21 @@ def saveMolden(WORKDIR,QMin):
 # ======================================================================= #
 def get_MO_from_gbw(filename,QMin):
 
-    # run orca_fragovl
-    string='orca_fragovl %s %s' % (filename,filename)
-    try:
-      proc=sp.Popen(string,shell=True,stdout=sp.PIPE,stderr=sp.PIPE)
-    except OSError:
-      print 'Call have had some serious problems:',OSError
-      sys.exit(80)
-    comm=proc.communicate()
-    data=comm[0].split('\n')
-
-    # get size of matrix
-    for line in reversed(data):
-      #print line
-      s=line.split()
-      if len(s)>=1:
-        NAO=int(line.split()[0])+1
-        break
+    # run orca_fragovl (or take it from the cache)
+    fragovl=run_fragovl(filename,filename)
+    NAO=fragovl['NAO']
 
     job=QMin['IJOB']
     restr=QMin['jobs'][job]['restr']
 
-    # find MO block
-    iline=-1
-    while True:
-      iline+=1
-      if len(data)<=iline:
-        print 'MOs not found!'
-        sys.exit(81)
-      line=data[iline]
-      if 'FRAGMENT A MOs MATRIX' in line:
-        break
-    iline+=3
-
-    # formatting
-    nblock=6
-    npre=11
-    ndigits=16
-
-    # get coefficients for alpha
+    # get coefficients for alpha (and beta)
+    if not 'MO_A' in fragovl or (not restr and not 'MO_B' in fragovl):
+      parse_fragovl_MOs(fragovl,restr)
+    MO_A=fragovl['MO_A']
     NMO_A=NAO
-    MO_A=[ [ 0. for i in range(NAO) ] for j in range(NMO_A) ]
-    for imo in range(NMO_A):
-      jblock=imo/nblock
-      jcol =imo%nblock
-      for iao in range(NAO):
-        shift=max(0,len(str(iao))-3)
-        jline=iline + jblock*(NAO+1) + iao
-        line=data[jline]
-        val=float( line[npre+shift+jcol*ndigits : npre+shift+ndigits+jcol*ndigits] )
-        MO_A[imo][iao]=val
-    iline+=(NAO/nblock+1)*(NAO+1)
-
-    # coefficients for beta
     if not restr:
+      MO_B=fragovl['MO_B']
       NMO_B=NAO
-      MO_B=[ [ 0. for i in range(NAO) ] for j in range(NMO_B) ]
-      for imo in range(NMO_B):
-        jblock=imo/nblock
-        jcol =imo%nblock
-        for iao in range(NAO):
-          shift=max(0,len(str(iao))-3)
-          jline=iline + jblock*(NAO+1) + iao
-          line=data[jline]
-          val=float( line[npre+shift+jcol*ndigits : npre+shift+ndigits+jcol*ndigits] )
-          MO_B[imo][iao]=val
 
 
     NMO=NMO_A      -  QMin['frozcore']
@@ -3420,44 +3684,31 @@ MO-coefficients from Orca
 mocoef
 (*)
 ''' % (NAO,NMO)
-    x=0
+    string=[string]
     for imo,mo in enumerate(MO_A):
         if imo<QMin['frozcore']:
             continue
-        for c in mo:
-            if x>=3:
-                string+='\n'
-                x=0
-            string+='% 6.12e ' % c
-            x+=1
-        if x>0:
-            string+='\n'
-            x=0
+        string.append(format_three_per_line(mo))
     if not restr:
-        x=0
         for imo,mo in enumerate(MO_B):
             if imo<QMin['frozcore']:
                 continue
-            for c in mo:
-                if x>=3:
-                    string+='\n'
-                    x=0
-                string+='% 6.12e ' % c
-                x+=1
-            if x>0:
-                string+='\n'
-                x=0
-    string+='orbocc\n(*)\n'
-    x=0
-    for i in range(NMO):
-        if x>=3:
-            string+='\n'
-            x=0
-        string+='% 6.12e ' % (0.0)
-        x+=1
+            string.append(format_three_per_line(mo))
+    string.append('orbocc\n(*)\n')
+    string.append(format_three_per_line([ 0.0 for i in range(NMO) ]).rstrip('\n'))
+    string=''.join(string)
 
     return string
 
+# ======================================================================= #
+def format_three_per_line(values):
+    # formats a vector in the mocoef format, three values per line
+    string=[]
+    for i in range(0,len(values),3):
+        chunk=values[i:i+3]
+        string.append(('% 6.12e '*len(chunk)) % tuple(chunk)+'\n')
+    return ''.join(string)
+
 # ======================================================================= #
 def get_dets_from_cis(filename,QMin):
 
@@ -3496,6 +3747,7 @@ def get_dets_from_cis(filename,QMin):
           infos['NOB']=int(s[4])-int(s[3])+1
           infos['NVB']=int(s[7])-int(s[6])+1
 
+    CCfile=None
     if not 'NOA' in  infos:
       nstates_onfile=0
       charge=QMin['chargemap'][gsmult]
@@ -3508,8 +3760,10 @@ def get_dets_from_cis(filename,QMin):
     else:
       # get all info from cis file
       CCfile=open(filename,'rb')
-      nvec  =struct.unpack('i', CCfile.read(4))[0]
-      header=[ struct.unpack('i', CCfile.read(4))[0] for i in range(8) ]
+      data=mmap.mmap(CCfile.fileno(),0,access=mmap.ACCESS_READ)
+      nvec  =struct.unpack_from('i', data, 0)[0]
+      header=list(struct.unpack_from('8i', data, 4))
+      offset=36
       #print infos
       #print header
       if infos['NOA']!=header[1]-header[0]+1:
@@ -3560,36 +3814,7 @@ def get_dets_from_cis(filename,QMin):
                 key=tuple(occ_A[QMin['frozcore']:]+occ_B[QMin['frozcore']:])
             eigenvectors[mult].append( {key:1.0} )
         for istate in range(nstates_to_extract[mult-1]):
-            CCfile.read(40)
-            dets={}
-            for iocc in range(header[0],header[1]+1):
-              for ivirt in range(header[2],header[3]+1):
-                dets[ (iocc,ivirt,1) ]=struct.unpack('d', CCfile.read(8))[0]
-            if not restr:
-              for iocc in range(header[4],header[5]+1):
-                for ivirt in range(header[6],header[7]+1):
-                  dets[ (iocc,ivirt,2) ]=struct.unpack('d', CCfile.read(8))[0]
-            if QMin['template']['no_tda']:
-              CCfile.read(40)
-              for iocc in range(header[0],header[1]+1):
-                for ivirt in range(header[2],header[3]+1):
-                  dets[ (iocc,ivirt,1) ]+=struct.unpack('d', CCfile.read(8))[0]
-                  dets[ (iocc,ivirt,1) ]/=2.
-              if not restr:
-                for iocc in range(header[4],header[5]+1):
-                  for ivirt in range(header[6],header[7]+1):
-                    dets[ (iocc,ivirt,2) ]+=struct.unpack('d', CCfile.read(8))[0]
-                    dets[ (iocc,ivirt,2) ]/=2.
-
-            #pprint.pprint(dets)
-            # truncate vectors
-            norm=0.
-            for k in sorted(dets,key=lambda x: dets[x]**2,reverse=True):
-                factor=1.
-                if norm>factor*QMin['wfthres']:
-                    del dets[k]
-                    continue
-                norm+=dets[k]**2
+            dets,offset=read_cis_root(data,offset,header,restr,QMin['template']['no_tda'],QMin['wfthres'])
             #pprint.pprint(dets)
             # create strings and expand singlets
             dets2={}
@@ -3650,25 +3875,10 @@ def get_dets_from_cis(filename,QMin):
             # append
             eigenvectors[mult].append(dets3)
         # skip extra roots
-        for istate in range(nstates_to_skip[mult-1]):
-            CCfile.read(40)
-            for iocc in range(header[0],header[1]+1):
-              for ivirt in range(header[2],header[3]+1):
-                CCfile.read(8)
-            if not restr:
-              for iocc in range(header[4],header[5]+1):
-                for ivirt in range(header[6],header[7]+1):
-                  CCfile.read(8)
-            if QMin['template']['no_tda']:
-              CCfile.read(40)
-              for iocc in range(header[0],header[1]+1):
-                for ivirt in range(header[2],header[3]+1):
-                  CCfile.read(8)
-              if not restr:
-                for iocc in range(header[4],header[5]+1):
-                  for ivirt in range(header[6],header[7]+1):
-                    CCfile.read(8)
-
+        offset+=nstates_to_skip[mult-1]*cis_root_size(header,restr,QMin['template']['no_tda'])
+    if CCfile:
+        data.close()
+        CCfile.close()
 
     strings={}
     for imult,mult in enumerate(mults):
@@ -3677,36 +3887,107 @@ def get_dets_from_cis(filename,QMin):
 
     return strings
 
+# ======================================================================= #
+def cis_root_size(header,restr,no_tda):
+    # size in bytes of one root in the .cis file: 40 bytes record header and the amplitudes (twice without TDA)
+    n=(header[1]-header[0]+1)*(header[3]-header[2]+1)
+    if not restr:
+        n+=(header[5]-header[4]+1)*(header[7]-header[6]+1)
+    size=40+8*n
+    if no_tda:
+        size*=2
+    return size
+
+# ======================================================================= #
+def read_cis_root(data,offset,header,restr,no_tda,wfthres):
+    '''Reads one root from the (memory-mapped) content of an ORCA .cis file and truncates it.
+
+    All amplitudes of a spin block are unpacked at once. The amplitudes are sorted by their squared value
+    and added up until the norm exceeds wfthres, only those are turned into determinant keys.
+
+    Arguments:
+    1 buffer: content of the .cis file
+    2 integer: byte offset of the root
+    3 list of integers: orbital ranges from the file header
+    4 boolean: restricted
+    5 boolean: no_tda (X and Y vectors are averaged)
+    6 float: wfthres
+
+    Returns:
+    1 dictionary: (iocc, ivirt, spin) -> coefficient
+    2 integer: byte offset of the next root'''
+
+    blocks=[ (header[0],header[1],header[2],header[3],1) ]
+    if not restr:
+        blocks.append( (header[4],header[5],header[6],header[7],2) )
+    n=sum( [ (b[1]-b[0]+1)*(b[3]-b[2]+1) for b in blocks ] )
+    offset+=40
+    coefs=list(struct.unpack_from('%id' % (n), data, offset))
+    offset+=8*n
+    if no_tda:
+        offset+=40
+        coefs2=struct.unpack_from('%id' % (n), data, offset)
+        offset+=8*n
+        coefs=[ (x+y)/2. for x,y in zip(coefs,coefs2) ]
+
+    # truncate vectors
+    order=sorted(range(n),key=lambda k: coefs[k]**2,reverse=True)
+    keep=[]
+    norm=0.
+    for k in order:
+        if norm>wfthres:
+            break
+        norm+=coefs[k]**2
+        keep.append(k)
+
+    dets={}
+    for k in keep:
+        start=0
+        for iocc0,iocc1,ivirt0,ivirt1,spin in blocks:
+            nvirt=ivirt1-ivirt0+1
+            size=(iocc1-iocc0+1)*nvirt
+            if k<start+size:
+                iocc=iocc0+(k-start)/nvirt
+                ivirt=ivirt0+(k-start)%nvirt
+                dets[ (iocc,ivirt,spin) ]=coefs[k]
+                break
+            start+=size
+    return dets,offset
+
 # ======================================================================= #
 def format_ci_vectors(ci_vectors):
+    '''Formats a list of CI vectors (one dict determinant tuple -> coefficient per state) as dets file.
 
-    # get nstates, norb and ndets
+    The determinants are packed into byte strings, which sort like the tuples and are converted to the
+    "eabd" notation with a single translate call. The coefficients are collected in a dense ndets x nstates matrix.'''
+
+    # pack the determinants of each state (the hash of a string is cached, that of a tuple is not)
+    packed=[]
     alldets=set()
     for dets in ci_vectors:
-        for key in dets:
-            alldets.add(key)
+        packed.append( [ (str(bytearray(det)),dets[det]) for det in dets ] )
+        alldets.update( [ p for p,c in packed[-1] ] )
+
+    # get nstates, norb and ndets
     ndets=len(alldets)
     nstates=len(ci_vectors)
     norb=len(next(iter(alldets)))
 
-    string='%i %i %i\n' % (nstates,norb,ndets)
-    for det in sorted(alldets,reverse=True):
-        for o in det:
-            if o==0:
-                string+='e'
-            elif o==1:
-                string+='a'
-            elif o==2:
-                string+='b'
-            elif o==3:
-                string+='d'
-        for istate in range(len(ci_vectors)):
-            if det in ci_vectors[istate]:
-                string+=' %11.7f ' % ci_vectors[istate][det]
-            else:
-                string+=' %11.7f ' % 0.
-        string+='\n'
-    return string
+    alldets=sorted(alldets,reverse=True)
+    row={}
+    for irow,p in enumerate(alldets):
+        row[p]=irow*nstates
+    # dense coefficient matrix, stored row-wise in a flat list
+    coef=[ 0. ]*(ndets*nstates)
+    for istate,dets in enumerate(packed):
+        for p,c in dets:
+            coef[row[p]+istate]=c
+
+    fmt=' %11.7f '*nstates+'\n'
+    string=[ '%i %i %i\n' % (nstates,norb,ndets) ]
+    for irow,p in enumerate(alldets):
+        string.append(p.translate(DETCHARS)+fmt % tuple(coef[irow*nstates:(irow+1)*nstates]))
+    return ''.join(string)
 
 # ======================================================================= #
 def saveAOmatrix(WORKDIR,QMin):
@@ -3717,13 +3998,12 @@ def saveAOmatrix(WORKDIR,QMin):
     filename=os.path.join(WORKDIR,'ORCA.gbw')
     NAO,Smat=get_smat_from_gbw(filename)
 
-    string='%i %i\n' % (NAO,NAO)
+    string=['%i %i\n' % (NAO,NAO)]
+    fmt='% .7e '*NAO+'\n'
     for irow in range(NAO):
-        for icol in range(NAO):
-            string+='% .7e ' % (Smat[icol][irow])
-        string+='\n'
+        string.append(fmt % tuple( [ Smat[icol][irow] for icol in range(NAO) ] ))
     filename=os.path.join(QMin['savedir'],'AO_overl')
-    writefile(filename,string)
+    writefile(filename,''.join(string))
     if PRINT:
         print shorten_DIR(filename)
 
@@ -3767,7 +4047,45 @@ def get_smat_from_gbw(file1, file2=''):
     if not file2:
       file2=file1
 
-    # run orca_fragovl
+    # run orca_fragovl (or take it from the cache)
+    fragovl=run_fragovl(file1,file2)
+    if not 'S' in fragovl:
+      parse_fragovl_overlap(fragovl)
+
+    return fragovl['NAO'],fragovl['S']
+
+# ======================================================================= #
+def hashfile(filename):
+    # sha1 of the file content, read in blocks
+    h=hashlib.sha1()
+    f=open(filename,'rb')
+    while True:
+        block=f.read(1048576)
+        if not block:
+            break
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+# ======================================================================= #
+def run_fragovl(file1,file2):
+    '''Runs orca_fragovl for two gbw files and returns the split output.
+
+    The result is kept in FRAGOVL_CACHE, keyed by the content hashes of both files, so that the MO coefficients
+    and the AO overlap of the same gbw file are obtained from one call of orca_fragovl.
+    The matrices are only parsed on request (parse_fragovl_MOs, parse_fragovl_overlap) and then also kept in the cache.
+
+    Arguments:
+    1 string: first gbw file
+    2 string: second gbw file
+
+    Returns:
+    1 dictionary: 'data' (output lines), 'NAO' and the parsed matrices'''
+
+    key=(hashfile(file1),hashfile(file2))
+    if key in FRAGOVL_CACHE:
+      return FRAGOVL_CACHE[key]
+
     string='orca_fragovl %s %s' % (file1,file2)
     try:
       proc=sp.Popen(string,shell=True,stdout=sp.PIPE,stderr=sp.PIPE)
@@ -3775,31 +4093,79 @@ def get_smat_from_gbw(file1, file2=''):
       print 'Call have had some serious problems:',OSError
       sys.exit(89)
     comm=proc.communicate()
-    out=comm[0].split('\n')
+    data=comm[0].split('\n')
 
     # get size of matrix
-    for line in reversed(out):
-      #print line
+    for line in reversed(data):
       s=line.split()
       if len(s)>=1:
         NAO=int(line.split()[0])+1
         break
 
-    # read matrix
+    FRAGOVL_CACHE[key]={'data':data,'NAO':NAO}
+    return FRAGOVL_CACHE[key]
+
+# ======================================================================= #
+def parse_fragovl_overlap(fragovl):
+    '''Parses the AO overlap matrix from the orca_fragovl output.
+
+    Each line is split once, all values of a line are distributed over the columns of its block.
+    Stores fragovl['S'][x][y].'''
+
+    data=fragovl['data']
+    NAO=fragovl['NAO']
     nblock=6
     ao_ovl=[ [ 0. for i in range(NAO) ] for j in range(NAO) ]
-    for x in range(NAO):
+    for block in range(0,(NAO-1)/nblock+1):
+      ncol=min(nblock,NAO-block*nblock)
       for y in range(NAO):
-        block=x/nblock
-        xoffset=x%nblock+1
-        yoffset=block*(NAO+1)+y+10
-        ao_ovl[x][y]=float( out[yoffset].split()[xoffset])
+        s=data[block*(NAO+1)+y+10].split()
+        for k in range(ncol):
+          ao_ovl[block*nblock+k][y]=float(s[k+1])
+    fragovl['S']=ao_ovl
 
-    return NAO,ao_ovl
+# ======================================================================= #
+def parse_fragovl_MOs(fragovl,restr):
+    '''Parses the MO coefficients of fragment A from the orca_fragovl output.
+
+    The values are in fixed-width columns, which are sliced from each line at once.
+    Stores fragovl['MO_A'] and, for unrestricted wavefunctions, fragovl['MO_B'].'''
 
+    data=fragovl['data']
+    NAO=fragovl['NAO']
+
+    # find MO block
+    iline=-1
+    while True:
+      iline+=1
+      if len(data)<=iline:
+        print 'MOs not found!'
+        sys.exit(81)
+      line=data[iline]
+      if 'FRAGMENT A MOs MATRIX' in line:
+        break
+    iline+=3
 
+    # formatting
+    nblock=6
+    npre=11
+    ndigits=16
 
+    def read_block(iline):
+      MO=[ [ 0. for i in range(NAO) ] for j in range(NAO) ]
+      for jblock in range(0,(NAO-1)/nblock+1):
+        ncol=min(nblock,NAO-jblock*nblock)
+        for iao in range(NAO):
+          start=npre+max(0,len(str(iao))-3)
+          line=data[iline + jblock*(NAO+1) + iao]
+          for jcol in range(ncol):
+            MO[jblock*nblock+jcol][iao]=float( line[start+jcol*ndigits : start+(jcol+1)*ndigits] )
+      return MO
 
+    fragovl['MO_A']=read_block(iline)
+    iline+=(NAO/nblock+1)*(NAO+1)
+    if not restr:
+      fragovl['MO_B']=read_block(iline)
 
 # ======================================================================= #
 #def get_smat_from_Molden(file1, file2=''):
@@ -4237,13 +4603,12 @@ def get_Double_AOovl_gbw(QMin):
 
   ## Smat is already off-diagonal block matrix NAO*NAO
   ## we want the lower left quarter, but transposed
-  string='%i %i\n' % (NAO,NAO)
+  string=['%i %i\n' % (NAO,NAO)]
+  fmt='% .15e '*NAO+'\n'
   for irow in range(0,NAO):
-      for icol in range(0,NAO):
-          string+='% .15e ' % (Smat[irow][icol])          # note the exchanged indices => transposition
-      string+='\n'
+      string.append(fmt % tuple(Smat[irow]))          # note the exchanged indices => transposition
   filename=os.path.join(QMin['savedir'],'AO_overl.mixed')
-  writefile(filename,string)
+  writefile(filename,''.join(string))
   return
 
 
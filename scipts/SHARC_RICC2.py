@@ -96,6 +96,18 @@ from socket import gethostname
 import struct
 import copy
 import ast
+# diffs of edited control files in debug mode
+import difflib
+# parallel execution of independent ricc2 jobs
+from multiprocessing import Pool
+import time
+import traceback
+# lookup in the line index of ricc2.out
+import bisect
+# cached QM/MM topology, keyed by the content hash of the table file
+import hashlib
+import marshal
+import gc
 
 
 # =========================================================0
@@ -193,6 +205,17 @@ IToPol={
         'Z': 2
         }
 
+# translation tables for the integer-encoded determinant sort keys (see civfl_ana.det_sort_key)
+DETSORTKEY1=''.join([ {'d':'0','a':'1','b':'1','e':'3'}.get(chr(i),chr(i)) for i in range(256) ])
+DETSORTKEY2=''.join([ {'d':'0','a':'0','b':'1','e':'1'}.get(chr(i),chr(i)) for i in range(256) ])
+
+# cache file (in savedir) and format version of the geometry-independent QM/MM topology (see get_QMMM_topology)
+QMMM_TOPOLOGY_FILE='QMMM.topology'
+QMMM_TOPOLOGY_VERSION=3
+
+# input files which ricc2 only reads, hard-linked instead of copied into the work directories of concurrent ricc2 jobs (see setup_ricc2_workdir)
+RICC2_LINKED_FILES=['coord','basis','auxbasis','mos','alpha','beta']
+
 
 NUMBERS = {'H':  1, 'He': 2,
 'Li': 3, 'Be': 4, 'B':  5, 'C':  6,  'N': 7,  'O': 8, 'F':  9, 'Ne':10,
@@ -342,6 +365,19 @@ def readfile(filename):
     sys.exit(12)
   return out
 
+# ======================================================================= #
+def hashfile(filename):
+  # sha1 of the file content, read in blocks
+  h=hashlib.sha1()
+  f=open(filename,'rb')
+  while True:
+    block=f.read(1048576)
+    if not block:
+      break
+    h.update(block)
+  f.close()
+  return h.hexdigest()
+
 # ======================================================================= #
 def writefile(filename,content):
   # content can be either a string or a list of strings
@@ -877,10 +913,12 @@ def makermatrix(a,b):
 # =============================================================================================== #
 
 # ======================================================================= #
-def get_RICC2out(QMin,QMout,job):
+def get_RICC2out(QMin,QMout,job,workdir=''):
   # job contains: 'tmexc_soc','tmexc_dm', 'spectrum','exprop_dm','static_dm','gsgrad','exgrad', 'E'
   # reads ricc2.out and adds matrix elements to QMout
-  ricc2=readfile(QMin['scratchdir']+'/JOB/ricc2.out')
+  if not workdir:
+    workdir=os.path.join(QMin['scratchdir'],'JOB')
+  ricc2=RICC2out(readfile(os.path.join(workdir,'ricc2.out')))
 
   states=QMin['states']
   nstates=QMin['nstates']
@@ -968,14 +1006,14 @@ def get_RICC2out(QMin,QMout,job):
       if tup in job:
         QMout['grad'][i]=getgrad(ricc2,QMin,i+1)
         if QMin['qmmm']:
-          QMout['pcgrad'][i-1]=getpcgrad(QMin)
+          QMout['pcgrad'][i-1]=getpcgrad(QMin,workdir)
         if QMin['cobramm']:
-          logfile=os.path.join(QMin['scratchdir'],'JOB','pc_grad')
+          logfile=os.path.join(workdir,'pc_grad')
           getcobrammpcgrad(logfile,QMin)
           #gpc=getcobrammpcgrad(logfile,QMin)
           #QMout['pcgrad'][i]=gpc
           #print QMout['pcgrad'][i]
-          pcgradold=os.path.join(QMin['scratchdir'],'JOB','pc_grad')
+          pcgradold=os.path.join(workdir,'pc_grad')
           specify_state=os.path.join(QMin['scratchdir'],'JOB','pc_grad.%s.%s') % (m1,s1)#% (mult,nexc)
     #shutil.copy(pcbrad,specify_state)
           shutil.copy(pcgradold,specify_state)
@@ -1005,6 +1043,79 @@ def get_RICC2out(QMin,QMout,job):
 
   return QMout
 
+# ======================================================================= #
+# strings marking the tables and sections in ricc2.out, which are indexed by RICC2out
+RICC2OUT_MARKERS=['Final CC2 energy',
+                  'Final MP2 energy',
+                  '| sym | multi | state |          CC2 excitation energies       |  %t1   |  %t2   |',
+                  '| sym | multi | state |          ADC(2) excitation energies    |  %t1   |  %t2   |',
+                  '|        States           Operator    Excitation                 Transition             |',
+                  '<<<<<<<<<<  GROUND STATE FIRST-ORDER PROPERTIES  >>>>>>>>>>>',
+                  '<<<<<<<<<<<<<<<  EXCITED STATE PROPERTIES  >>>>>>>>>>>>>>>>',
+                  '<<<<<<<<<<<<  ONE-PHOTON ABSORPTION STRENGTHS  >>>>>>>>>>>>>',
+                  '<<<<<<<<<<<  EXCITED STATE TRANSITION MOMENTS  >>>>>>>>>>>>',
+                  'number, symmetry, multiplicity:',
+                  'Transition moments for pair',
+                  'Transition and Operator of different multiplicity.',
+                  '     dipole moment:',
+                  'Analysis of unrelaxed properties',
+                  'cartesian gradient of the energy (hartree/bohr)',
+                  'Model:',
+                  'total wall-time']
+
+class RICC2out:
+  '''Lines of ricc2.out together with an index of the table and section markers.
+
+  The index is built in one pass over the file. find() then only looks at the indexed lines of a marker,
+  instead of scanning the file from the top for every matrix element.'''
+
+  def __init__(self,lines):
+    self.lines=lines
+    self.index=dict( [ (marker,[]) for marker in RICC2OUT_MARKERS ] )
+    for iline,line in enumerate(lines):
+      for marker in RICC2OUT_MARKERS:
+        if marker in line:
+          self.index[marker].append(iline)
+    self.keys={}
+
+  def __len__(self):
+    return len(self.lines)
+
+  def __getitem__(self,i):
+    return self.lines[i]
+
+  def __iter__(self):
+    return iter(self.lines)
+
+  def find(self,string,start=0):
+    # returns the first line number >=start of a line containing string, or -1
+    if not string in self.keys:
+      self.keys[string]=None
+      for marker in RICC2OUT_MARKERS:
+        if marker in string:
+          self.keys[string]=marker
+          break
+    marker=self.keys[string]
+    if marker is None:
+      # not an indexed string, scan the file
+      for iline in xrange(start,len(self.lines)):
+        if string in self.lines[iline]:
+          return iline
+      return -1
+    positions=self.index[marker]
+    for i in xrange(bisect.bisect_left(positions,start),len(positions)):
+      if string in self.lines[positions[i]]:
+        return positions[i]
+    return -1
+
+  def find_before(self,string,stopstring,start=0):
+    # like find, but returns -2 if a line containing stopstring comes first (or is the same line)
+    iline=self.find(string,start)
+    istop=self.find(stopstring,start)
+    if istop!=-1 and (iline==-1 or istop<=iline):
+      return -2
+    return iline
+
 # ======================================================================= #
 def getenergy(ricc2,QMin,istate):
   mult,state,ms=tuple(QMin['statemap'][istate])
@@ -1014,13 +1125,11 @@ def getenergy(ricc2,QMin,istate):
     string='Final CC2 energy'
   elif QMin['template']['method']=='adc(2)':
     string='Final MP2 energy'
-  for line in ricc2:
-    if string in line:
-      e=float(line.split()[5])
-      break
-  else:
+  iline=ricc2.find(string)
+  if iline==-1:
     print '"%s" not found in ricc2.out' % (string)
     sys.exit(14)
+  e=float(ricc2[iline].split()[5])
 
   # return gs energy if requested
   if mult==1 and state==1:
@@ -1033,15 +1142,10 @@ def getenergy(ricc2,QMin,istate):
     string='| sym | multi | state |          ADC(2) excitation energies    |  %t1   |  %t2   |'
 
   # find correct table
-  iline=-1
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print '"%s" not found in ricc2.out' % (string)
-      sys.exit(15)
-    line=ricc2[iline]
-    if string in line:
-      break
+  iline=ricc2.find(string)
+  if iline==-1:
+    print '"%s" not found in ricc2.out' % (string)
+    sys.exit(15)
   iline+=3
 
   # find correct line
@@ -1080,18 +1184,14 @@ def getsocme(ricc2,QMin,istate,jstate):
 
   # find the correct table
   string='|        States           Operator    Excitation                 Transition             |'
-  iline=0
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print '"%s" not found in ricc2.out' % (string)
-      sys.exit(17)
-    line=ricc2[iline]
-    if string in line:
-      break
+  iline=ricc2.find(string,1)
+  if iline==-1:
+    print '"%s" not found in ricc2.out' % (string)
+    sys.exit(17)
   iline+=7
 
   # find the correct line
+  # the table lists all pairs i<j of the ntot excited states, row by row
   if istate>jstate:
     m1,s1,ms1,m2,s2,ms2=m2,s2,ms2,m1,s1,ms1
   nsing=QMin['states'][0]-1
@@ -1105,17 +1205,16 @@ def getsocme(ricc2,QMin,istate,jstate):
     x2=s2-1
   else:
     x2=nsing+s2
-  for i in range(1,1+ntot):
-    for j in range(i+1,1+ntot):
-      iline+=1
-      if i==x1 and j==x2:
-        try:
-          s=ricc2[iline].split()
-          idx=int(10+2*ms2)
-          soc=float(s[idx])*rcm_to_Eh
-        except IndexError:
-          print 'Could not find SOC matrix element with istate=%i, jstate=%i, line=%i' % (istate,jstate,iline)
-        return complex(soc,0.)
+  if not 1<=x1<x2<=ntot:
+    return
+  iline+=(x1-1)*ntot-(x1-1)*x1/2+(x2-x1)
+  try:
+    s=ricc2[iline].split()
+    idx=int(10+2*ms2)
+    soc=float(s[idx])*rcm_to_Eh
+  except IndexError:
+    print 'Could not find SOC matrix element with istate=%i, jstate=%i, line=%i' % (istate,jstate,iline)
+  return complex(soc,0.)
 
 # ======================================================================= #
 def getdiagdm(ricc2,QMin,istate,pol):
@@ -1132,38 +1231,25 @@ def getdiagdm(ricc2,QMin,istate,pol):
   stopstring='Analysis of unrelaxed properties'
 
   # find correct section
-  iline=-1
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print 'Could not find dipole moment of istate=%i, Fail=0' % (istate)
-      sys.exit(18)
-    line=ricc2[iline]
-    if start1string in line:
-      break
+  iline=ricc2.find(start1string)
+  if iline==-1:
+    print 'Could not find dipole moment of istate=%i, Fail=0' % (istate)
+    sys.exit(18)
 
   # find correct state
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print 'Could not find dipole moment of istate=%i, Fail=1' % (istate)
-      sys.exit(19)
-    line=ricc2[iline]
-    if start2string in line:
-      break
+  iline=ricc2.find(start2string,iline+1)
+  if iline==-1:
+    print 'Could not find dipole moment of istate=%i, Fail=1' % (istate)
+    sys.exit(19)
 
   # find correct line
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print 'Could not find dipole moment of istate=%i, Fail=2' % (istate)
-      sys.exit(20)
-    line=ricc2[iline]
-    if stopstring in line:
-      print 'Could not find dipole moment of istate=%i, Fail=3' % (istate)
-      sys.exit(21)
-    if findstring in line:
-      break
+  iline=ricc2.find_before(findstring,stopstring,iline+1)
+  if iline==-1:
+    print 'Could not find dipole moment of istate=%i, Fail=2' % (istate)
+    sys.exit(20)
+  if iline==-2:
+    print 'Could not find dipole moment of istate=%i, Fail=3' % (istate)
+    sys.exit(21)
 
   iline+=3+pol
   s=ricc2[iline].split()
@@ -1186,28 +1272,19 @@ def gettransdm(ricc2,QMin,istate,jstate,pol):
     stopstring='<<<<<<<<<<<<<<<  EXCITED STATE PROPERTIES  >>>>>>>>>>>>>>>>'
 
     # find correct section
-    iline=-1
-    while True:
-      iline+=1
-      if iline==len(ricc2):
-        print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=0' % (istate,jstate)
-        sys.exit(22)
-      line=ricc2[iline]
-      if start1string in line:
-        break
+    iline=ricc2.find(start1string)
+    if iline==-1:
+      print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=0' % (istate,jstate)
+      sys.exit(22)
 
     # find correct state
-    while True:
-      iline+=1
-      if iline==len(ricc2):
-        print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=1' % (istate,jstate)
-        sys.exit(23)
-      line=ricc2[iline]
-      if stopstring in line:
-        print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=2' % (istate,jstate)
-        sys.exit(24)
-      if start2string in line:
-        break
+    iline=ricc2.find_before(start2string,stopstring,iline+1)
+    if iline==-1:
+      print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=1' % (istate,jstate)
+      sys.exit(23)
+    if iline==-2:
+      print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=2' % (istate,jstate)
+      sys.exit(24)
 
     # find element
     iline+=7+pol
@@ -1223,28 +1300,21 @@ def gettransdm(ricc2,QMin,istate,jstate,pol):
     nostring='Transition and Operator of different multiplicity.'
 
     # find correct section
-    iline=-1
-    while True:
-      iline+=1
-      if iline==len(ricc2):
-        print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=4' % (istate,jstate)
-        sys.exit(25)
-      line=ricc2[iline]
-      if start1string in line:
-        break
+    iline=ricc2.find(start1string)
+    if iline==-1:
+      print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=4' % (istate,jstate)
+      sys.exit(25)
 
     # find correct state
     while True:
-      iline+=1
-      if iline+2==len(ricc2):
+      iline=ricc2.find_before(start2string,stopstring,iline+1)
+      if iline==-1 or iline+2>=len(ricc2):
         print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=5' % (istate,jstate)
         sys.exit(26)
-      line=ricc2[iline]
-      line2=ricc2[iline+2]
-      if stopstring in line:
+      if iline==-2:
         print 'Could not find transition dipole moment of istate=%i,jstate=%i, Fail=6' % (istate,jstate)
         sys.exit(27)
-      if start2string in line and not nostring in line2:
+      if not nostring in ricc2[iline+2]:
         break
 
     # find element
@@ -1271,28 +1341,20 @@ def getgrad(ricc2,QMin,istate):
   findstring='cartesian gradient of the energy (hartree/bohr)'
 
   # find correct section
-  iline=-1
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print 'Could not find gradient of istate=%i, Fail=0' % (istate)
-      sys.exit(29)
-    line=ricc2[iline]
-    if start1string in line:
-      break
-    if stop1string in line:
-      print 'Could not find gradient of istate=%i, Fail=1' % (istate)
-      sys.exit(30)
+  iline=ricc2.find(start1string)
+  istop=ricc2.find(stop1string)
+  if istop!=-1 and (iline==-1 or istop<iline):
+    print 'Could not find gradient of istate=%i, Fail=1' % (istate)
+    sys.exit(30)
+  if iline==-1:
+    print 'Could not find gradient of istate=%i, Fail=0' % (istate)
+    sys.exit(29)
 
   # find gradient
-  while True:
-    iline+=1
-    if iline==len(ricc2):
-      print 'Could not find gradient of istate=%i, Fail=2' % (istate)
-      sys.exit(31)
-    line=ricc2[iline]
-    if findstring in line:
-      break
+  iline=ricc2.find(findstring,iline+1)
+  if iline==-1:
+    print 'Could not find gradient of istate=%i, Fail=2' % (istate)
+    sys.exit(31)
   iline+=3
 
   # get grad
@@ -1313,8 +1375,10 @@ def getgrad(ricc2,QMin,istate):
   return grad
 
 # ======================================================================= #
-def getpcgrad(QMin):
-  pcgrad=readfile(os.path.join(QMin['scratchdir'],'JOB','pc_grad') )
+def getpcgrad(QMin,workdir=''):
+  if not workdir:
+    workdir=os.path.join(QMin['scratchdir'],'JOB')
+  pcgrad=readfile(os.path.join(workdir,'pc_grad') )
 
   grad=[]
   iline=0
@@ -1875,6 +1939,52 @@ def writeQmoutPhases(QMin,QMout):
 # =============================================================================================== #
 # =============================================================================================== #
 
+def csr_from_rows(rows):
+    '''Converts a sparse matrix given as per-row lists of (factor, column) into CSR format.
+    Entries with zero factor are dropped, the order of the entries within a row is kept.
+
+    Arguments:
+    1 list of lists of (float,int): matrix rows
+
+    Returns:
+    1 tuple of lists: (indptr, indices, data), row i holds data[indptr[i]:indptr[i+1]] in columns indices[indptr[i]:indptr[i+1]]'''
+
+    indptr=[0]
+    indices=[]
+    data=[]
+    for row in rows:
+        for factor,icol in row:
+            if factor!=0.:
+                indices.append(icol)
+                data.append(factor)
+        indptr.append(len(indices))
+    return (indptr,indices,data)
+
+# ======================================================================= #
+
+def csr_matvec(matrix,vector):
+    '''Sparse matrix-vector product for a matrix in CSR format (see csr_from_rows).
+
+    Arguments:
+    1 tuple of lists: (indptr, indices, data)
+    2 list of float: vector
+
+    Returns:
+    1 list of float: matrix*vector'''
+
+    indptr,indices,data=matrix
+    result=[]
+    start=0
+    for end in indptr[1:]:
+        s=0.
+        for k in xrange(start,end):
+            s+=data[k]*vector[indices[k]]
+        result.append(s)
+        start=end
+    return result
+
+# ======================================================================= #
+
 def prepare_QMMM(QMin,table_file):
     ''' creates dictionary with:
     MM coordinates (including connectivity and atom types)
@@ -1885,14 +1995,107 @@ def prepare_QMMM(QMin,table_file):
     is only allowed to read the following keys from QMin:
     geo
     natom
+    savedir
     QM/MM related infos from template
+
+    the geometry-independent topology is taken from get_QMMM_topology
     '''
 
+    print '===== Running QM/MM preparation ===='
+    QMMM=get_QMMM_topology(QMin,table_file)
+
+
+    # check geometry and connection table
+    if not QMMM['natom_table']==QMin['natom']:
+        print 'Number of atoms in table file does not match number of atoms in QMin!'
+        sys.exit(38)
+
+
+    # link atom positions
+    for link in QMMM['linkbonds']:
+        link['atom']=[ link['element'], 0.,0.,0.]
+        for xyz in range(3):
+            link['atom'][xyz+1]+=link['scaling']['mm'] * QMin['geo'][link['mm']][xyz+1]
+            link['atom'][xyz+1]+=link['scaling']['qm'] * QMin['geo'][link['qm']][xyz+1]
+
+
+    # process MM geometry (and convert to angstrom!)
+    QMMM['MM_coords']=[]
+    for atom in QMin['geo']:
+        QMMM['MM_coords'].append( [atom[0]]+[i*au2a for i in atom[1:4]] )
+    for ilink,link in enumerate(QMMM['linkbonds']):
+        QMMM['MM_coords'].append(['HLA']+link['atom'][1:4])
+
+
+    # process QM geometry (including link atoms), QM coords in bohr!
+    QMMM['QM_coords']=[]
+    for iatom in QMMM['QM_atoms']:
+        QMMM['QM_coords'].append( deepcopy(QMin['geo'][iatom]) )
+    for link in QMMM['linkbonds']:
+        QMMM['QM_coords'].append(link['atom'])
+
+    #pprint.pprint(QMMM)
+    return QMMM
+
+# ======================================================================= #
+
+def get_QMMM_topology(QMin,table_file):
+    '''Returns the geometry-independent part of the QM/MM setup (see build_QMMM_topology).
+
+    The topology only depends on the table file, hence it is stored in QMMM_TOPOLOGY_FILE in savedir
+    together with the hash of the table file and only rebuilt if the table file changes.
+    The file is written with marshal, which only contains builtin types and loads several times faster than a pickle
+    (the garbage collector is switched off while loading the many small containers).
+
+    Arguments:
+    1 dict: QMin (only savedir is used)
+    2 string: path to the table file
+
+    Returns:
+    1 dict: QMMM topology'''
+
+    key=(QMMM_TOPOLOGY_VERSION,sys.version,hashfile(table_file))
+    cachefile=os.path.join(QMin['savedir'],QMMM_TOPOLOGY_FILE)
+    if os.path.isfile(cachefile):
+        gc.disable()
+        try:
+            f=open(cachefile,'rb')
+            cachekey,QMMM=marshal.load(f)
+            f.close()
+            if cachekey==key:
+                print 'Reading cached topology ...    ',datetime.datetime.now()
+                return QMMM
+        except Exception:
+            print 'Could not read cached QM/MM topology %s, rebuilding it.' % (cachefile)
+        finally:
+            gc.enable()
+
+    QMMM=build_QMMM_topology(table_file)
+    try:
+        f=open(cachefile+'.tmp','wb')
+        marshal.dump((key,QMMM),f)
+        f.close()
+        os.rename(cachefile+'.tmp',cachefile)
+    except (IOError,OSError):
+        print 'Could not write cached QM/MM topology %s!' % (cachefile)
+    return QMMM
+
+# ======================================================================= #
+
+def build_QMMM_topology(table_file):
+    '''Builds the geometry-independent part of the QM/MM setup from the connection table file:
+    atom types and connectivity, bonds, link bonds, reorder arrays and the point charge redistribution matrix.
+
+    Arguments:
+    1 string: path to the table file
+
+    Returns:
+    1 dict: QMMM topology (see prepare_QMMM)'''
+
     table=readfile(table_file)
 
 
     # read table file
-    print '===== Running QM/MM preparation ===='
     print 'Reading table file ...         ',datetime.datetime.now()
     QMMM={}
     QMMM['qmmmtype']=[]
@@ -1949,10 +2152,6 @@ def prepare_QMMM(QMin,table_file):
                 link['mm']=i
             link['scaling']={'qm':0.3,'mm':0.7}
             link['element']='H'
-            link['atom']=[ link['element'], 0.,0.,0.]
-            for xyz in range(3):
-                link['atom'][xyz+1]+=link['scaling']['mm'] * QMin['geo'][link['mm']][xyz+1]
-                link['atom'][xyz+1]+=link['scaling']['qm'] * QMin['geo'][link['qm']][xyz+1]
             QMMM['linkbonds'].append( link )
             QMMM['LI_atoms'].append( QMMM['natom_table']-1+len(QMMM['linkbonds']) )
             QMMM['atomtype'].append('999')
@@ -1984,20 +2183,6 @@ def prepare_QMMM(QMin,table_file):
         sys.exit(37)
 
 
-    # check geometry and connection table
-    if not QMMM['natom_table']==QMin['natom']:
-        print 'Number of atoms in table file does not match number of atoms in QMin!'
-        sys.exit(38)
-
-
-    # process MM geometry (and convert to angstrom!)
-    QMMM['MM_coords']=[]
-    for atom in QMin['geo']:
-        QMMM['MM_coords'].append( [atom[0]]+[i*au2a for i in atom[1:4]] )
-    for ilink,link in enumerate(QMMM['linkbonds']):
-        QMMM['MM_coords'].append(['HLA']+link['atom'][1:4])
-
-
     # create reordering dicts
     print 'Creating reorder mappings ...  ',datetime.datetime.now()
     QMMM['reorder_input_MM']={}
@@ -2017,20 +2202,26 @@ def prepare_QMMM(QMin,table_file):
     for i in QMMM['reorder_MM_input']:
         QMMM['reorder_input_MM'][QMMM['reorder_MM_input'][i]]=i
 
+    # atom type and connectivity columns of TINKER.xyz (in MM ordering), only the coordinates change between steps
+    QMMM['tinker_xyz_tail']=[]
+    for iatom_MM in range(len(QMMM['reorder_MM_input'])):
+        iatom_input=QMMM['reorder_MM_input'][iatom_MM]
+        QMMM['tinker_xyz_tail'].append( '  %4s  %s\n' % (
+                QMMM['atomtype'][iatom_input],
+                ' '.join( [ str(QMMM['reorder_input_MM'][i]+1) for i in sorted(QMMM['connect'][iatom_input]) ] )
+                ) )
 
-    # process QM geometry (including link atoms), QM coords in bohr!
-    QMMM['QM_coords']=[]
+
+    # QM ordering (QM atoms, then link atoms)
     QMMM['reorder_input_QM']={}
     QMMM['reorder_QM_input']={}
     j=-1
     for iatom in range(QMMM['natom_table']):
         if QMMM['qmmmtype'][iatom]=='qm':
-            QMMM['QM_coords'].append( deepcopy(QMin['geo'][iatom]) )
             j+=1
             QMMM['reorder_input_QM'][iatom]=j
             QMMM['reorder_QM_input'][j]=iatom
     for ilink,link in enumerate(QMMM['linkbonds']):
-        QMMM['QM_coords'].append(link['atom'])
         j+=1
         QMMM['reorder_input_QM'][-(ilink+1)]=j
         QMMM['reorder_QM_input'][j]=-(ilink+1)
@@ -2038,16 +2229,19 @@ def prepare_QMMM(QMin,table_file):
 
     # process charge redistribution around link bonds
     # point charges are in input geometry ordering
+    # the charge of an MM link atom is moved to its MM neighbors, QM charges are removed
+    # charge_matrix maps the raw MM charges to the redistributed charges (see csr_matvec)
     print 'Charge redistribution ...      ',datetime.datetime.now()
-    QMMM['charge_distr']=[]
+    mm_in_links_set=set(mm_in_links)
+    charge_distr=[]
     for iatom in range(QMMM['natom_table']):
         if QMMM['qmmmtype'][iatom]=='qm':
-            QMMM['charge_distr'].append( [(0.,0)] )
+            charge_distr.append( [(0.,0)] )
         elif QMMM['qmmmtype'][iatom]=='mm':
-            if iatom in mm_in_links:
-                QMMM['charge_distr'].append( [(0.,0)] )
+            if iatom in mm_in_links_set:
+                charge_distr.append( [(0.,0)] )
             else:
-                QMMM['charge_distr'].append( [(1.,iatom)] )
+                charge_distr.append( [(1.,iatom)] )
     for link in QMMM['linkbonds']:
         mm_neighbors=[]
         for j in QMMM['connect'][link['mm']]:
@@ -2057,9 +2251,9 @@ def prepare_QMMM(QMin,table_file):
             factor=1./len(mm_neighbors)
             for j in QMMM['connect'][link['mm']]:
                 if QMMM['qmmmtype'][j]=='mm':
-                    QMMM['charge_distr'][j].append( (factor,link['mm']) )
+                    charge_distr[j].append( (factor,link['mm']) )
+    QMMM['charge_matrix']=csr_from_rows(charge_distr)
 
-    #pprint.pprint(QMMM)
     return QMMM
 
 # ======================================================================= #
@@ -2125,30 +2319,22 @@ def execute_tinker(QMin,ff_file_path):
     writefile(filename,string)
 
 
-    # xyz/type/connection file
-    string='%i\n' % (len(QMMM['MM_coords']))
-    for iatom_MM in range(len(QMMM['MM_coords'])):
-        iatom_input=QMMM['reorder_MM_input'][iatom_MM]
-        string+='% 5i  %3s  % 16.12f % 16.12f % 16.12f  %4s  %s\n' % (
-                iatom_MM+1,
-                QMMM['MM_coords'][iatom_input][0],
-                QMMM['MM_coords'][iatom_input][1],
-                QMMM['MM_coords'][iatom_input][2],
-                QMMM['MM_coords'][iatom_input][3],
-                QMMM['atomtype'][iatom_input],
-                ' '.join( [ str(QMMM['reorder_input_MM'][i]+1) for i in sorted(QMMM['connect'][iatom_input]) ] )
-                )
+    # xyz/type/connection file (type and connection columns are precomputed in the topology)
+    MM_coords=[ QMMM['MM_coords'][QMMM['reorder_MM_input'][iatom_MM]] for iatom_MM in range(len(QMMM['MM_coords'])) ]
+    string=['%i\n' % (len(QMMM['MM_coords']))]
+    for iatom_MM,atom in enumerate(MM_coords):
+        string.append( '% 5i  %3s  % 16.12f % 16.12f % 16.12f' % (iatom_MM+1,atom[0],atom[1],atom[2],atom[3]) )
+        string.append( QMMM['tinker_xyz_tail'][iatom_MM] )
     filename=os.path.join(WORKDIR,'TINKER.xyz')
-    writefile(filename,string)
+    writefile(filename,''.join(string))
 
 
     # communication file
-    string='SHARC 0 -1\n'
-    for iatom_MM in range(len(QMMM['MM_coords'])):
-        iatom_input=QMMM['reorder_MM_input'][iatom_MM]
-        string+='% 16.12f % 16.12f % 16.12f\n' % tuple( QMMM['MM_coords'][iatom_input][1:4] )
+    string=['SHARC 0 -1\n']
+    for atom in MM_coords:
+        string.append( '% 16.12f % 16.12f % 16.12f\n' % tuple( atom[1:4] ) )
     filename=os.path.join(WORKDIR,'TINKER.qmmm')
-    writefile(filename,string)
+    writefile(filename,''.join(string))
 
 
     # standard input file
@@ -2174,57 +2360,20 @@ def execute_tinker(QMin,ff_file_path):
     print 'Searching MMEnergy ...         ',datetime.datetime.now()
     QMMM['MMEnergy']=float(output[1].split()[-1])*kcal_to_Eh
 
-    # get MM gradient (convert from kcal/mole/A to Eh/bohr)
-    print 'Searching MMGradient ...       ',datetime.datetime.now()
-    QMMM['MMGradient']={}
-    for line in output:
-        if 'MMGradient' in line:
-            s=line.split()
-            iatom_MM=int(s[1])-1
-            iatom_input=QMMM['reorder_MM_input'][iatom_MM]
-            grad=[ float(i)*kcal_to_Eh*au2a for i in s[2:5] ]
-            QMMM['MMGradient'][iatom_input]=grad
-        if 'MMq' in line:
-          break
-
-    # get MM point charges
-    print 'Searching MMpc_raw ...         ',datetime.datetime.now()
-    QMMM['MMpc_raw']={}
-    for i in range(QMMM['natom_table']):
-        QMMM['MMpc_raw'][i]=0.
-    iline=0
-    while True:
-        iline+=1
-        line=output[iline]
-        if 'MMq' in line:
-            break
-    iatom_MM=len(QMMM['QM_atoms'])+len(QMMM['LI_atoms'])-1
-    while True:
-        iline+=1
-        iatom_MM+=1
-        line=output[iline]
-        if 'NMM' in line:
-            break
-        s=line.split()
-        q=float(s[-1])
-        QMMM['MMpc_raw'][QMMM['reorder_MM_input'][iatom_MM]]=q
+    # get MM gradient (convert from kcal/mole/A to Eh/bohr) and MM point charges
+    print 'Searching MMGradient, MMq ...  ',datetime.datetime.now()
+    QMMM['MMGradient'],QMMM['MMpc_raw']=parse_tinker_qmmm(output,QMMM)
 
     # compute actual charges (including redistribution)
     print 'Redistributing charges ...     ',datetime.datetime.now()
-    QMMM['MMpc']={}
-    for i in range(QMMM['natom_table']):
-        s=0.
-        for factor,iatom in QMMM['charge_distr'][i]:
-            s+=factor * QMMM['MMpc_raw'][iatom]
-        QMMM['MMpc'][i]=s
+    QMMM['MMpc']=csr_matvec(QMMM['charge_matrix'],QMMM['MMpc_raw'])
 
     # make list of pointcharges without QM atoms and zero-charge MM atoms
     print 'Finalizing charges ...         ',datetime.datetime.now()
     QMMM['pointcharges']=[]
     QMMM['reorder_pc_input']={}
     ipc=0
-    for iatom_input in QMMM['MMpc']:
-      q=QMMM['MMpc'][iatom_input]
+    for iatom_input,q in enumerate(QMMM['MMpc']):
       if q!=0:
         atom=QMMM['MM_coords'][iatom_input]
         QMMM['pointcharges'].append( atom[1:4]+[q] )
@@ -2287,6 +2436,44 @@ def execute_tinker(QMin,ff_file_path):
     #sys.exit(40)
     return QMMM
 
+# ======================================================================= #
+def parse_tinker_qmmm(output,QMMM):
+    '''Reads the MM gradient and the raw MM point charges from TINKER.qmmm in a single pass.
+
+    The "MMGradient" lines are followed by the "MMq" line,
+    after which there is one charge line per MM atom (in MM ordering, after the QM and link atoms) until the "NMM" line.
+    The garbage collector is paused while the many small gradient lists are created.
+
+    Arguments:
+    1 list of strings: content of TINKER.qmmm
+    2 dict: QMMM
+
+    Returns:
+    1 dict: MM gradient in Eh/bohr (input ordering)
+    2 list of float: raw MM point charges (input ordering)'''
+
+    reorder=QMMM['reorder_MM_input']
+    gradient={}
+    charges=[ 0. for i in range(QMMM['natom_table']) ]
+    lines=iter(output)
+    gc.disable()
+    try:
+        for line in lines:
+            if 'MMGradient' in line:
+                s=line.split()
+                gradient[reorder[int(s[1])-1]]=[ float(i)*kcal_to_Eh*au2a for i in s[2:5] ]
+            if 'MMq' in line:
+                break
+        iatom_MM=len(QMMM['QM_atoms'])+len(QMMM['LI_atoms'])
+        for line in lines:
+            if 'NMM' in line:
+                break
+            charges[reorder[iatom_MM]]=float(line.split()[-1])
+            iatom_MM+=1
+    finally:
+        gc.enable()
+    return gradient,charges
+
 # ======================================================================= #
 def coords_same(coord1,coord2):
     thres=1e-5
@@ -2301,20 +2488,24 @@ def coords_same(coord1,coord2):
 def runTINKER(WORKDIR,tinker,savedir,strip=False,ncpu=1):
     prevdir=os.getcwd()
     os.chdir(WORKDIR)
+    # tkr2qm_s is started directly (no shell), with TINKER.in as standard input
     string=os.path.join(tinker,'bin','tkr2qm_s')+' '
     string+=' < TINKER.in'
+    command=[os.path.join(tinker,'bin','tkr2qm_s')]
     os.environ['OMP_NUM_THREADS']=str(ncpu)
     if PRINT or DEBUG:
         starttime=datetime.datetime.now()
         sys.stdout.write('START:\t%s\t%s\t"%s"\n' % (shorten_DIR(WORKDIR),starttime,shorten_DIR(string)))
         sys.stdout.flush()
+    stdinfile=open(os.path.join(WORKDIR,'TINKER.in'))
     stdoutfile=open(os.path.join(WORKDIR,'TINKER.out'),'w')
     stderrfile=open(os.path.join(WORKDIR,'TINKER.err'),'w')
     try:
-        runerror=sp.call(string,shell=True,stdout=stdoutfile,stderr=stderrfile)
+        runerror=sp.call(command,stdin=stdinfile,stdout=stdoutfile,stderr=stderrfile)
     except OSError:
         print 'Call have had some serious problems:',OSError
         sys.exit(41)
+    stdinfile.close()
     stdoutfile.close()
     stderrfile.close()
     if PRINT or DEBUG:
@@ -2759,6 +2950,27 @@ def readQMin(QMinfilename):
     os.environ['PARA_ARCH']='SMP'
     os.environ['PARNODES']=str(QMin['ncpu'])
 
+  # settings for the concurrent execution of independent ricc2 jobs
+  QMin['delay']=0.0
+  line=getsh2cc2key(sh2cc2,'delay')
+  if line[0]:
+    try:
+      QMin['delay']=float(line[1])
+    except ValueError:
+      print 'Submit delay does not evaluate to numerical value!'
+      sys.exit(112)
+
+  QMin['schedule_scaling']=0.9
+  line=getsh2cc2key(sh2cc2,'schedule_scaling')
+  if line[0]:
+    try:
+      x=float(line[1])
+      if 0<x<=1.:
+        QMin['schedule_scaling']=x
+    except ValueError:
+      print '"schedule_scaling" does not evaluate to numerical value!'
+      sys.exit(113)
+
 
   # set TURBOMOLE paths
   QMin['turbodir']=get_sh2cc2_environ(sh2cc2,'turbodir')
@@ -3411,7 +3623,15 @@ def gettasks(QMin):
     # ricc2 calls: 
     # prop={'tmexc_soc','tmexc_dm', 'spectrum','exprop_dm','static_dm','gs_grad','exgrad'}
     jobs=get_jobs(QMin)
+    # the first job (with 'E') converges the excited states, the other jobs restart from it
+    # with more than one CPU, the other jobs run concurrently in copies of JOB
+    parallel=QMin['ncpu']>1 and len(jobs)>2
     for ijob,job in enumerate(jobs):
+      if ijob>0 and parallel:
+        if ijob==1:
+          tasks.append(['ricc2_parallel',jobs[1:]])
+        tasks.append(['get_RICC2out',job,os.path.join(QMin['scratchdir'],'JOB_%i' % (ijob+1))])
+        continue
       tasks.append(['prep_control',job])
       tasks.append(['ricc2'])
       tasks.append(['get_RICC2out',job])
@@ -3453,6 +3673,53 @@ def gettasks(QMin):
 
 
 
+# =============================================================================================== #
+# =============================================================================================== #
+# =========================================== Job Scheduling ==================================== #
+# =============================================================================================== #
+# =============================================================================================== #
+
+def parallel_speedup(N,scaling):
+  # computes the parallel speedup from Amdahls law
+  # with scaling being the fraction of parallelizable work and (1-scaling) being the serial part
+  return 1./((1-scaling)+scaling/N)
+
+def divide_slots(ncpu,ntasks,scaling):
+  # this routine figures out the optimal distribution of the tasks over the CPU cores
+  #   returns the number of rounds (how many jobs each CPU core will contribute to),
+  #   the number of slots which should be set in the Pool,
+  #   and the number of cores for each job.
+  minpar=1
+  ntasks_per_round=ncpu/minpar
+  if ncpu==1:
+    ntasks_per_round=1
+  ntasks_per_round=min(ntasks_per_round,ntasks)
+  optimal={}
+  for i in range(1,1+ntasks_per_round):
+    nrounds=int(math.ceil(float(ntasks)/i))
+    ncores=ncpu/i
+    optimal[i]=nrounds/parallel_speedup(ncores,scaling)
+  best=min(optimal,key=optimal.get)
+  nrounds=int(math.ceil(float(ntasks)/best))
+  ncores=ncpu/best
+
+  cpu_per_run=[0 for i in range(ntasks)]
+  if nrounds==1:
+    itask=0
+    for icpu in range(ncpu):
+      cpu_per_run[itask]+=1
+      itask+=1
+      if itask>=ntasks:
+        itask=0
+    nslots=ntasks
+  else:
+    for itask in range(ntasks):
+      cpu_per_run[itask]=ncores
+    nslots=ncpu/ncores
+  return nrounds,nslots,cpu_per_run
+
+
+
 # =============================================================================================== #
 # =============================================================================================== #
 # =========================================== SUBROUTINES TO RUNEVERYTING ======================= #
@@ -3656,6 +3923,37 @@ def runProgram(string,workdir,outfile,errfile=''):
   os.chdir(prevdir)
   return runerror
 
+# ======================================================================= #
+def runProgram_scan(string,workdir,outfile,pattern):
+  # like runProgram, but stdout is scanned for pattern while it is written to outfile
+  # returns the error code and whether pattern was found
+  prevdir=os.getcwd()
+  if DEBUG:
+    print workdir
+  os.chdir(workdir)
+  if PRINT or DEBUG:
+    starttime=datetime.datetime.now()
+    sys.stdout.write('%s\n\t%s' % (string,starttime))
+    sys.stdout.flush()
+  stdoutfile=open(os.path.join(workdir,outfile),'w')
+  found=False
+  try:
+    proc=sp.Popen(string,shell=True,stdout=sp.PIPE,stderr=sp.STDOUT)
+  except OSError:
+    print 'Call have had some serious problems:',OSError
+    sys.exit(96)
+  for line in iter(proc.stdout.readline,''):
+    stdoutfile.write(line)
+    if not found and pattern in line:
+      found=True
+  runerror=proc.wait()
+  stdoutfile.close()
+  if PRINT or DEBUG:
+    endtime=datetime.datetime.now()
+    sys.stdout.write('\t%s\t\tRuntime: %s\t\tError Code: %i\n\n' % (endtime,endtime-starttime,runerror))
+  os.chdir(prevdir)
+  return runerror,found
+
 # ======================================================================= #
 def define(path,QMin,ricc2=True):
 
@@ -3760,155 +4058,176 @@ all %s
 
   return
 
+# ======================================================================= #
+class ControlFile:
+  '''Turbomole control file, which is read once, edited in memory and written once.
+
+  The file is kept as an ordered list of sections. Each section is a list of lines, the first line being the one
+  with the $ keyword. Lines before the first keyword are kept in a header section.
+  Sections are found by the first keyword line containing the given string, as in the former file-based editing.'''
+
+  def __init__(self,path):
+    self.path=path
+    self.original=readfile(path)
+    self.sections=[[]]
+    for line in self.original:
+      if '$' in line:
+        self.sections.append([])
+      self.sections[-1].append(line)
+
+  def find(self,section):
+    # index of the first section whose keyword line contains section, or -1
+    for isec in range(1,len(self.sections)):
+      if section in self.sections[isec][0]:
+        return isec
+    return -1
+
+  def add_section(self,section):
+    # adds a section keyword before $end
+    # if section does not start with $, $ will be prepended
+    if not section[0]=='$':
+      section='$'+section
+    iend=self.find('$end')
+    self.sections.insert(iend,[section+'\n'])
+
+  def add_option(self,section,newline):
+    # adds an option line at the end of a section, if the section exists and the line is not there yet
+    if not section[0]=='$':
+      section='$'+section
+    isec=self.find(section)
+    if isec==-1:
+      return
+    newline='  '+newline+'\n'
+    if newline in self.sections[isec][1:]:
+      return
+    self.sections[isec].append(newline)
+
+  def has_option(self,section,line):
+    # whether a section contains the option line (as written by add_option)
+    if not section[0]=='$':
+      section='$'+section
+    isec=self.find(section)
+    return isec!=-1 and '  '+line+'\n' in self.sections[isec][1:]
+
+  def remove_option(self,section,line):
+    # removes an option line (as written by add_option) from a section
+    if self.has_option(section,line):
+      if not section[0]=='$':
+        section='$'+section
+      self.sections[self.find(section)].remove('  '+line+'\n')
+
+  def remove_section(self,section):
+    # removes a keyword and its options
+    if not section[0]=='$':
+      section='$'+section
+    isec=self.find(section)
+    if isec!=-1:
+      del self.sections[isec]
+
+  def lines(self):
+    return [ line for sec in self.sections for line in sec ]
+
+  def write(self):
+    # writes the file once, only if anything changed
+    lines=self.lines()
+    if lines==self.original:
+      return
+    if DEBUG:
+      print 'Changes to %s:' % (self.path)
+      sys.stdout.writelines(difflib.unified_diff(self.original,lines,fromfile=self.path,tofile=self.path))
+    writefile(self.path,lines)
+    self.original=lines
+
 # ======================================================================= #
 def add_section_to_control(path,section):
   # adds a section keyword to the control file, before $end
   # if section does not start with $, $ will be prepended
-  if not section[0]=='$':
-    section='$'+section
-  infile=readfile(path)
-
-  # get iline of $end
-  iline=-1
-  while True:
-    iline+=1
-    line=infile[iline]
-    if '$end' in line:
-      break
-
-  outfile=infile[:iline]
-  outfile.append(section+'\n')
-  outfile.extend(infile[iline:])
-  writefile(path,outfile)
+  control=ControlFile(path)
+  control.add_section(section)
+  control.write()
   return
 
 # ======================================================================= #
 def add_option_to_control_section(path,section,newline):
-  if not section[0]=='$':
-    section='$'+section
-  infile=readfile(path)
-  newline='  '+newline
-
-  # get iline where section starts
-  iline=-1
-  while True:
-    iline+=1
-    if iline==len(infile):
-      return
-    line=infile[iline]
-    if section in line:
-      break
-
-  # get jline where section ends
-  jline=iline
-  while True:
-    jline+=1
-    line=infile[jline]
-    if '$' in line:
-      break
-    # do nothing if line is already there
-    if newline+'\n'==line:
-      return
-
-  # splice together new file
-  outfile=infile[:jline]
-  outfile.append(newline+'\n')
-  outfile.extend(infile[jline:])
-  writefile(path,outfile)
+  control=ControlFile(path)
+  control.add_option(section,newline)
+  control.write()
   return
 
 # ======================================================================= #
 def remove_section_in_control(path,section):
   # removes a keyword and its options from control file
-  if not section[0]=='$':
-    section='$'+section
-  infile=readfile(path)
-
-  # get iline where section starts
-  iline=-1
-  while True:
-    iline+=1
-    if iline==len(infile):
-      return
-    line=infile[iline]
-    if section in line:
-      break
-
-  # get jline where section ends
-  jline=iline
-  while True:
-    jline+=1
-    line=infile[jline]
-    if '$' in line:
-      break
-
-  # splice together new file
-  outfile=infile[:iline]+infile[jline:]
-  writefile(path,outfile)
+  control=ControlFile(path)
+  control.remove_section(section)
+  control.write()
   return
 
 # ======================================================================= #
 def modify_control(QMin):
   # this adjusts the control file for the main JOB calculations
-  control=os.path.join(QMin['scratchdir'],'JOB/control')
+  control=ControlFile(os.path.join(QMin['scratchdir'],'JOB/control'))
 
   if 'soc' in QMin:
-    add_section_to_control(control,'$mkl')
+    control.add_section('$mkl')
   if QMin['template']['douglas-kroll']:
-    add_section_to_control(control,'$rdkh')
+    control.add_section('$rdkh')
 
   # add laplace keyword for LT-SOS
   if QMin['template']['spin-scaling']=='lt-sos':
-    add_section_to_control(control,'$laplace')
-    add_option_to_control_section(control,'$laplace','conv=5')
+    control.add_section('$laplace')
+    control.add_option('$laplace','conv=5')
 
-  #remove_section_in_control(control,'$optimize')
-  #add_option_to_control_section(control,'$ricc2','scs')
-  remove_section_in_control(control,'$scfiterlimit')
-  add_section_to_control(control,'$scfiterlimit 100')
+  #control.remove_section('$optimize')
+  #control.add_option('$ricc2','scs')
+  control.remove_section('$scfiterlimit')
+  control.add_section('$scfiterlimit 100')
 
   # QM/MM point charges
   if QMin['qmmm']:
-    add_option_to_control_section(control,'$drvopt','point charges')
-    add_section_to_control(control,'$point_charges file=pc')
-    add_section_to_control(control,'$point_charge_gradients file=pc_grad')
+    control.add_option('$drvopt','point charges')
+    control.add_section('$point_charges file=pc')
+    control.add_section('$point_charge_gradients file=pc_grad')
+  control.write()
   return
 
   #COBRAMM
   if QMin['cobramm']:
-    add_option_to_control_section(control,'$drvopt','point charges')
-    add_section_to_control(control,'$point_charges file=point_charges') #inserire nome file quando deciso
-    add_section_to_control(control,'$point_charge_gradients file=pc_grad')
+    control.add_option('$drvopt','point charges')
+    control.add_section('$point_charges file=point_charges') #inserire nome file quando deciso
+    control.add_section('$point_charge_gradients file=pc_grad')
+  control.write()
   return
 
 
 # ======================================================================= #
-def prep_control(QMin,job):
+def prep_control(QMin,job,workdir=''):
   # prepares the control file to calculate grad, soc, dm
   # job contains: 'tmexc_soc','tmexc_dm', 'spectrum','exprop_dm','static_dm','gsgrad','exgrad', 'E'
+  if not workdir:
+    workdir=os.path.join(QMin['scratchdir'],'JOB')
 
-  control=os.path.join(QMin['scratchdir'],'JOB/control')
+  control=ControlFile(os.path.join(workdir,'control'))
 
   # remove sections to cleanly rewrite them
-  remove_section_in_control(control,'$response')
-  remove_section_in_control(control,'$excitations')
+  control.remove_section('$response')
+  control.remove_section('$excitations')
 
   # add number of states
-  add_section_to_control(control,'$excitations')
-  add_option_to_control_section(control,'$ricc2','maxiter 45')
+  control.add_section('$excitations')
+  control.add_option('$ricc2','maxiter 45')
   nst=QMin['states'][0]-1       # exclude ground state here
   if nst>=1:
     string='irrep=a multiplicity=1 nexc=%i npre=%i nstart=%i' % (nst,nst+1,nst+1)
-    add_option_to_control_section(control,'$excitations',string)
+    control.add_option('$excitations',string)
   if len(QMin['states'])>=3:
     nst=QMin['states'][2]
     if nst>=1:
       string='irrep=a multiplicity=3 nexc=%i npre=%i nstart=%i' % (nst,nst+1,nst+1)
-      add_option_to_control_section(control,'$excitations',string)
+      control.add_option('$excitations',string)
 
   # add response section
   if 'static_dm' or 'gsgrad' in job:
-    add_section_to_control(control,'$response')
+    control.add_section('$response')
 
   # add property lines
   if 'tmexc_soc' in job or 'tmexc_dm' in job:
@@ -3919,36 +4238,36 @@ def prep_control(QMin,job):
     if 'tmexc_dm' in job:
       prop.append('diplen')
     string+=','.join(prop)
-    add_option_to_control_section(control,'$excitations',string)
+    control.add_option('$excitations',string)
   if 'spectrum' in job:
     string='spectrum states=all operators=diplen'
-    add_option_to_control_section(control,'$excitations',string)
+    control.add_option('$excitations',string)
   if 'exprop_dm' in job:
     string='exprop states=all relaxed operators=diplen'
-    add_option_to_control_section(control,'$excitations',string)
+    control.add_option('$excitations',string)
   if 'static_dm' in job:
     string='static relaxed operators=diplen'
-    add_option_to_control_section(control,'$response',string)
+    control.add_option('$response',string)
 
   if QMin['cobramm']:
-    add_option_to_control_section(control,'$drvopt',' point charges')
-    add_section_to_control(control,'$point_charges file=point_charges') #inserire nome file quando deciso
-    add_section_to_control(control,'$point_charge_gradients file=pc_grad')
+    control.add_option('$drvopt',' point charges')
+    control.add_section('$point_charges file=point_charges') #inserire nome file quando deciso
+    control.add_section('$point_charge_gradients file=pc_grad')
 
   # add gradients
   for j in job:
     if 'gsgrad' in j:
       string='gradient'
-      add_option_to_control_section(control,'$response',string)
+      control.add_option('$response',string)
     if 'exgrad' in j:
       string='xgrad states=(a{%i} %i)' % (j[1],j[2]-(j[1]==1))
-      add_option_to_control_section(control,'$excitations',string)
+      control.add_option('$excitations',string)
 
     
   # ricc2 restart
   if not 'E' in job and not 'no_ricc2_restart' in QMin:
-    add_option_to_control_section(control,'$ricc2','restart')
-    restartfile=os.path.join(QMin['scratchdir'],'JOB/restart.cc')
+    control.add_option('$ricc2','restart')
+    restartfile=os.path.join(workdir,'restart.cc')
     try:
       os.remove(restartfile)
     except OSError:
@@ -3956,9 +4275,10 @@ def prep_control(QMin,job):
 
   # D1 and D2 diagnostic
   if DEBUG and 'E' in job:
-    add_option_to_control_section(control,'$ricc2','d1diag')
-    add_section_to_control(control,'$D2-diagnostic')
+    control.add_option('$ricc2','d1diag')
+    control.add_section('$D2-diagnostic')
 
+  control.write()
   return
 
 # ======================================================================= #
@@ -4016,13 +4336,14 @@ def get_AO_OVL(path,QMin):
 
   # call define and then add commands to control file
   define(path,QMin,ricc2=False)
-  controlfile=os.path.join(path,'control')
-  remove_section_in_control(controlfile,'$scfiterlimit')
-  add_section_to_control(controlfile,'$scfiterlimit 0')
-  add_section_to_control(controlfile,'$intsdebug sao')
-  add_section_to_control(controlfile,'$closed shells')
-  add_option_to_control_section(controlfile,'$closed shells','a 1-2')
-  add_section_to_control(controlfile,'$scfmo none')
+  control=ControlFile(os.path.join(path,'control'))
+  control.remove_section('$scfiterlimit')
+  control.add_section('$scfiterlimit 0')
+  control.add_section('$intsdebug sao')
+  control.add_section('$closed shells')
+  control.add_option('$closed shells','a 1-2')
+  control.add_section('$scfmo none')
+  control.write()
 
   # write geometry again because define tries to be too clever with the double geometry
   tofile=os.path.join(path,'coord')
@@ -4129,13 +4450,14 @@ def run_ridft(QMin):
   workdir=os.path.join(QMin['scratchdir'],'JOB')
 
   # add RI settings to control file
-  controlfile=os.path.join(workdir,'control')
-  remove_section_in_control(controlfile,'$maxcor')
-  add_section_to_control(controlfile,'$maxcor %i' % (int(QMin['memory']*0.6)))
-  add_section_to_control(controlfile,'$ricore %i' % (int(QMin['memory']*0.4)))
-  add_section_to_control(controlfile,'$jkbas file=auxbasis')
-  add_section_to_control(controlfile,'$rij')
-  add_section_to_control(controlfile,'$rik')
+  control=ControlFile(os.path.join(workdir,'control'))
+  control.remove_section('$maxcor')
+  control.add_section('$maxcor %i' % (int(QMin['memory']*0.6)))
+  control.add_section('$ricore %i' % (int(QMin['memory']*0.4)))
+  control.add_section('$jkbas file=auxbasis')
+  control.add_section('$rij')
+  control.add_section('$rik')
+  control.write()
 
   if QMin['ncpu']>1:
     string='ridft_smp'
@@ -4147,11 +4469,12 @@ def run_ridft(QMin):
     sys.exit(100)
 
   # remove RI settings from control file
-  controlfile=os.path.join(workdir,'control')
-  remove_section_in_control(controlfile,'$maxcor')
-  add_section_to_control(controlfile,'$maxcor %i' % (QMin['memory']))
-  remove_section_in_control(controlfile,'$rij')
-  remove_section_in_control(controlfile,'$rik')
+  control=ControlFile(os.path.join(workdir,'control'))
+  control.remove_section('$maxcor')
+  control.add_section('$maxcor %i' % (QMin['memory']))
+  control.remove_section('$rij')
+  control.remove_section('$rik')
+  control.write()
 
   return
 
@@ -4206,40 +4529,188 @@ def change_pre_states(workdir,itrials):
   writefile(filename,data2)
 
 # ======================================================================= #
-def run_ricc2(QMin):
-  workdir=os.path.join(QMin['scratchdir'],'JOB')
+def run_ricc2(QMin,workdir=''):
+  if not workdir:
+    workdir=os.path.join(QMin['scratchdir'],'JOB')
 
   # enter loop until convergence of CC2/ADC(2)
+  # each attempt is scanned for non-convergence while ricc2 is writing its output
   itrials=0
+  wasted_wall=0.
+  wasted_cpu=0.
+  # whether the retries added the restart option, which is removed again after the run
+  added_restart=False
   while True:
     if QMin['ncpu']>1:
       string='ricc2_omp'
     else:
       string='ricc2'
-    runerror=runProgram(string,workdir,'ricc2.out')
+    t0=time.time()
+    c0=sum(os.times()[2:4])
+    runerror,found=runProgram_scan(string,workdir,'ricc2.out','NO CONVERGENCE')
     if runerror!=0:
       print 'RICC2 calculation crashed! Error code=%i' % (runerror)
-      ok=False
-    # check for convergence in output file
-    filename=os.path.join(workdir,'ricc2.out')
-    data=readfile(filename)
-    ok=True
-    for line in data:
-      if 'NO CONVERGENCE' in line:
-        ok=False
-        break
-    if ok:
+    if not found:
       break
     # go only here if no convergence
+    wasted_wall+=time.time()-t0
+    wasted_cpu+=sum(os.times()[2:4])-c0
     itrials+=1
     if itrials>max(shift_mask):
+      write_ricc2_metrics(QMin,workdir,itrials,wasted_wall,wasted_cpu,False)
       print 'Not able to obtain convergence in RICC2. Aborting...'
       sys.exit(103)
     print 'No convergence of excited-state calculations! Restarting with modified number of preoptimization states...'
     change_pre_states(workdir,itrials)
+    # restart from the ground state amplitudes and excitation vectors of the failed attempt, unless ricc2 restarts are disabled
+    if not 'no_ricc2_restart' in QMin:
+      control=ControlFile(os.path.join(workdir,'control'))
+      if not control.has_option('$ricc2','restart'):
+        control.add_option('$ricc2','restart')
+        control.write()
+        added_restart=True
+      restartfile=os.path.join(workdir,'restart.cc')
+      try:
+        os.remove(restartfile)
+      except OSError:
+        pass
+
+  if added_restart:
+    control=ControlFile(os.path.join(workdir,'control'))
+    control.remove_option('$ricc2','restart')
+    control.write()
+
+  write_ricc2_metrics(QMin,workdir,itrials,wasted_wall,wasted_cpu,True)
+  return
+
+# ======================================================================= #
+def write_ricc2_metrics_header(QMin):
+  # writes the header of the metrics file in savedir, if the file does not exist yet
+  # called in the main process before ricc2 runs, concurrent ricc2 jobs (see run_ricc2_jobs) only append their lines
+  filename=os.path.join(QMin['savedir'],'ricc2_metrics.dat')
+  if os.path.isfile(filename):
+    return
+  string='#%7s %-10s %8s %16s %16s %10s\n' % ('step','workdir','retries','wasted_wall/s','wasted_cpu/s','converged')
+  try:
+    f=open(filename,'w')
+    f.write(string)
+    f.close()
+  except IOError:
+    print 'Could not write to file %s!' % (filename)
+
+# ======================================================================= #
+def write_ricc2_metrics(QMin,workdir,retries,wasted_wall,wasted_cpu,converged):
+  # appends one line per ricc2 job to the metrics file in savedir
+  filename=os.path.join(QMin['savedir'],'ricc2_metrics.dat')
+  string=' %7s %-10s %8i %16.2f %16.2f %10s\n' % (QMin['step'][0],os.path.basename(workdir),retries,wasted_wall,wasted_cpu,converged)
+  try:
+    f=open(filename,'a')
+    f.write(string)
+    f.close()
+  except IOError:
+    print 'Could not write to file %s!' % (filename)
+
+# ======================================================================= #
+def setup_ricc2_workdir(jobdir,workdir):
+  # creates the work directory of a concurrent ricc2 job from JOB
+  # the read-only input files (RICC2_LINKED_FILES) are hard-linked,
+  # the files which ricc2 or the interface modify (control, restart data of ricc2) are copied,
+  # and the output files of the previous programs (*.out, *.err) are not needed
+  mkdir(workdir)
+  for f in os.listdir(jobdir):
+    fromfile=os.path.join(jobdir,f)
+    tofile=os.path.join(workdir,f)
+    if os.path.splitext(f)[1] in ['.out','.err']:
+      continue
+    if os.path.islink(fromfile):
+      os.symlink(os.readlink(fromfile),tofile)
+    elif os.path.isdir(fromfile):
+      shutil.copytree(fromfile,tofile,symlinks=True)
+    elif f in RICC2_LINKED_FILES:
+      try:
+        os.link(fromfile,tofile)
+      except OSError:
+        shutil.copy(fromfile,tofile)
+    else:
+      shutil.copy(fromfile,tofile)
+
+# ======================================================================= #
+def run_ricc2_jobs(QMin,jobs):
+  # runs independent ricc2 jobs concurrently
+  # each job gets a work directory set up from JOB (converged SCF and excited states of the first job) and a share of the CPUs and memory
+  ntasks=len(jobs)
+  scaling=QMin['schedule_scaling']
+  nrounds,nslots,cpu_per_run=divide_slots(QMin['ncpu'],ntasks,scaling)
+
+  # set up the work directories
+  jobdir=os.path.join(QMin['scratchdir'],'JOB')
+  workdirs=[]
+  for ijob,job in enumerate(jobs):
+    workdir=os.path.join(QMin['scratchdir'],'JOB_%i' % (ijob+2))
+    setup_ricc2_workdir(jobdir,workdir)
+    control=ControlFile(os.path.join(workdir,'control'))
+    control.remove_section('$maxcor')
+    control.add_section('$maxcor %i' % (QMin['memory']/nslots))
+    control.write()
+    prep_control(QMin,job,workdir)
+    workdirs.append(workdir)
+
+  # run
+  if PRINT or DEBUG:
+    print 'Running %i ricc2 jobs in %i slots, CPUs per job: %s' % (ntasks,nslots,cpu_per_run)
+  write_ricc2_metrics_header(QMin)
+  walltime=time.time()
+  pool=Pool(processes=nslots)
+  results=[]
+  for ijob,workdir in enumerate(workdirs):
+    QMin1=dict(QMin)
+    QMin1['ncpu']=cpu_per_run[ijob]
+    results.append(pool.apply_async(run_ricc2_job,[QMin1,workdir]))
+    time.sleep(QMin['delay'])
+  pool.close()
+  pool.join()
+  walltime=time.time()-walltime
+  results=[ r.get() for r in results ]
+
+  string='Error Codes:\n'
+  for workdir,(err,runtime) in zip(workdirs,results):
+    string+='\t%-10s\t%i\t%8.1f s\n' % (os.path.basename(workdir),err,runtime)
+  print string
+  if any( [ err!=0 for err,runtime in results ] ):
+    print 'Some ricc2 jobs did not finish successfully!'
+    print 'See %s:%s for error messages in ricc2 output.' % (gethostname(),QMin['scratchdir'])
+    sys.exit(114)
 
+  if PRINT or DEBUG:
+    print 'Scheduling: %i jobs, %i rounds, %i slots' % (ntasks,nrounds,nslots)
+    # predicted speedup over running the jobs one after the other on all CPUs (Amdahl model of divide_slots)
+    predicted=(ntasks/parallel_speedup(QMin['ncpu'],scaling)) / (nrounds/parallel_speedup(min(cpu_per_run),scaling))
+    string='Predicted speedup: %.2f    ' % (predicted)
+    # observed speedup: the serial reference is the measured wall time of the first ricc2 job (in JOB, on all CPUs) for each job
+    if 'ricc2_walltime' in QMin:
+      serial=ntasks*QMin['ricc2_walltime']
+      string+='Observed speedup: %.2f (serial reference %i x %.1f s)    ' % (serial/max(walltime,1e-6),ntasks,QMin['ricc2_walltime'])
+    string+='Wall time: %.1f s\n' % (walltime)
+    print string
   return
 
+# ======================================================================= #
+def run_ricc2_job(QMin,workdir):
+  # runs one ricc2 job in a pool process, returns error code and runtime
+  os.environ['OMP_NUM_THREADS']=str(QMin['ncpu'])
+  os.environ['PARNODES']=str(QMin['ncpu'])
+  t0=time.time()
+  try:
+    run_ricc2(QMin,workdir)
+  except SystemExit, e:
+    return e.code or 0,time.time()-t0
+  except Exception:
+    print '*'*50+'\nException in run_ricc2_job(%s)!' % (workdir)
+    traceback.print_exc()
+    print '*'*50+'\n'
+    return 1,time.time()-t0
+  return 0,time.time()-t0
+
 # ======================================================================= #
 def copymolden(QMin):
   # run tm2molden in scratchdir
@@ -4339,9 +4810,15 @@ def runeverything(tasks, QMin):
     if task[0]=='prep_control':
       prep_control(QMin,task[1])
     if task[0]=='ricc2':
+      write_ricc2_metrics_header(QMin)
+      t0=time.time()
       run_ricc2(QMin)
+      # wall time of a ricc2 job on all CPUs, serial reference for the concurrent jobs in run_ricc2_jobs
+      QMin['ricc2_walltime']=time.time()-t0
+    if task[0]=='ricc2_parallel':
+      run_ricc2_jobs(QMin,task[1])
     if task[0]=='get_RICC2out':
-      QMout=get_RICC2out(QMin,QMout,task[1])
+      QMout=get_RICC2out(QMin,QMout,*task[1:])
     if task[0]=='get_AO_OVL':
       get_AO_OVL(task[1],QMin)
     if task[0]=='wfoverlap':
@@ -4574,51 +5051,45 @@ class civfl_ana:
       sys.exit(108)
     if not nentry==self.nvir*(self.nocc-self.nfrz):
       print 'ERROR: wrong number of entries found in file: %s' % (filename)
-    # get data
-    state_dict={}
+    # get data: the amplitudes are stored occupied-major, read them in one go
     nact=self.nocc-self.nfrz
-    for iocc in range(nact):
-      for ivirt in range(self.nvir):
-        coef=struct.unpack('d', CCfile.read(8))[0]
-        if self.mult==1:
-          det=self.det_string(iocc+self.nfrz,self.nocc+ivirt,'ab')
-          state_dict[det]= coef
-        elif self.mult==3:
-          det=self.det_string(iocc+self.nfrz,self.nocc+ivirt,'aa')
-          state_dict[det]=coef
+    nvir=self.nvir
+    ncoef=nact*nvir
+    coefs=struct.unpack('%id' % ncoef, CCfile.read(8*ncoef))
+    CCfile.close()
     # renormalize
-    vnorm=0.
-    for i in state_dict:
-      vnorm+=state_dict[i]**2
-    vnorm=math.sqrt(vnorm)
-    # truncate data
-    state_dict2={}
+    sqcoefs=[ c**2 for c in coefs ]
+    vnorm=math.sqrt(sum(sqcoefs))
+    # truncate data: only the surviving (occ,virt) pairs are turned into determinants
+    kept=[]
     norm=0.
-    for i in sorted(state_dict, key=lambda x: state_dict[x]**2, reverse=True):
-      state_dict2[i]=state_dict[i]/vnorm
-      norm+=state_dict2[i]**2
+    for i in sorted(xrange(ncoef), key=sqcoefs.__getitem__, reverse=True):
+      kept.append(i)
+      norm+=(coefs[i]/vnorm)**2
       if norm>self.maxsqnorm:
         break
     # put into general det_dict, also adding the b->a excitation for singlets
+    # (same strings as det_string, but the closed-shell reference is only built once)
+    ref='d'*self.nocc+'e'*(self.nmos-self.nocc)
     if self.mult==1:
-      for i in state_dict2:
-        coef=state_dict2[i]/math.sqrt(2.)
-        j=i.replace('a','t').replace('b','a').replace('t','b')
-        if i in self.det_dict:
-          self.det_dict[i][state]=coef
-        else:
-          self.det_dict[i]={state:coef}
-        if j in self.det_dict:
-          self.det_dict[j][state]=-coef
-        else:
-          self.det_dict[j]={state:-coef}
+      spins=['ab','ba']
     elif self.mult==3:
-      for i in state_dict2:
-        coef=state_dict2[i]
-        if i in self.det_dict:
-          self.det_dict[i][state]=coef
+      spins=['aa']
+    for i in kept:
+      iocc,ivirt=divmod(i,nvir)
+      fromorb=iocc+self.nfrz
+      toorb=self.nocc+ivirt
+      pre,mid,post=ref[:fromorb],ref[fromorb+1:toorb],ref[toorb+1:]
+      coef=coefs[i]/vnorm
+      if self.mult==1:
+        coef/=math.sqrt(2.)
+      for spin in spins:
+        det=pre+spin[0]+mid+spin[1]+post
+        if det in self.det_dict:
+          self.det_dict[det][state]=coef
         else:
-          self.det_dict[i]={state:coef}
+          self.det_dict[det]={state:coef}
+        coef=-coef
 # ================================================== #
   def det_string(self,fromorb,toorb,spin):
     if fromorb>=self.nocc or toorb<self.nocc or fromorb>=self.nmos or toorb>=self.nmos:
@@ -4628,29 +5099,32 @@ class civfl_ana:
     string=string[:fromorb]+spin[0]+string[fromorb+1:toorb]+spin[1]+string[toorb+1:]
     return string
 # ================================================== #
-  def sort_key(self, key):
+  def det_sort_key(self, key):
     """
     For specifying the sorting order of the determinants.
+    Primary key: occupation pattern, read as a base-4 number (d=0, a/b=1, e=3).
+    Secondary key: spin pattern, read as a binary number (d/a=0, b/e=1).
+    Since all determinants have the same length, this is the order of the corresponding strings.
     """
-    return key.replace('d', '0').replace('a', '1').replace('b', '1')    
+    return ( int(key.translate(DETSORTKEY1),4), int(key.translate(DETSORTKEY2),2) )
 # ================================================== #
-  def sort_key2(self, key):
+  def write_det_file(self, nstate, wname='dets', wform=' % 14.10f'):
     """
-    For specifying the sorting order of the determinants.
+    Writes the determinants in one pass.
+    The sort keys are computed once per determinant, the lines are streamed to the file.
     """
-    return key.replace('d', '0').replace('a', '0').replace('b', '1').replace('e', '1')
-# ================================================== #
-  def write_det_file(self, nstate, wname='dets', wform=' % 14.10f'):
-    string='%i %i %i\n' % (nstate,self.nmos,len(self.det_dict))
-    for det in sorted(sorted(self.det_dict, key=self.sort_key2), key=self.sort_key):
-      string+=det
-      for istate in xrange(1, nstate+1):
-        try:
-          string+=wform % (self.det_dict[det][istate])
-        except KeyError:
-          string+=wform % (0.)
-      string+='\n'
-    writefile(wname,string)
+    fmt='%s'+wform*nstate+'\n'
+    states=range(1,nstate+1)
+    lines=( fmt % ( (det,)+tuple( [ self.det_dict[det].get(istate,0.) for istate in states ] ) )
+            for det in sorted(self.det_dict, key=self.det_sort_key) )
+    try:
+      f=open(wname,'w')
+      f.write('%i %i %i\n' % (nstate,self.nmos,len(self.det_dict)))
+      f.writelines(lines)
+      f.close()
+    except IOError:
+      print 'Could not write to file %s!' % (wname)
+      sys.exit(13)
 
 
 